@@ -3,11 +3,20 @@
 """
 
 import sqlite3
+import os
+import socket
+import struct
 from re import match
 #from string import strip
-from collections import defaultdict
+from collections import defaultdict, Counter
+from bisect import bisect_right
+try:
+    from . import lib_database
+except ValueError:
+    import lib_database
 
 DNS_RESOLVERS = ('open', 'google', 'default')
+AS_LIST_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
 def as_ip_min_max(prefix):
@@ -33,15 +42,9 @@ def as_ip_min_max(prefix):
     ip_addr, prefix = match_prefix.groups()
     prefix = int(prefix)
     assert prefix <= 32, 'Prefix is at most 32 bits'
-    bin_prefix = '0b' + ('1' * prefix) + ('0' * (32 - prefix))
-    int_prefix = int(bin_prefix, 2)
-    ip_addr = ip2int(ip_addr)
-    min_ip = ip_addr & int_prefix
-    if prefix == 32:
-        max_ip = ip_addr
-    else:
-        max_ip = min_ip + int('0b' + '1' * (32 - prefix), 2)
-    return min_ip, max_ip
+    host_mask = (1 << (32 - prefix)) - 1
+    min_ip = ip2int(ip_addr) & ~host_mask
+    return min_ip, min_ip | host_mask
 
 def ip2int(ip_addr):
     """Return the int value of IP address
@@ -53,16 +56,26 @@ def ip2int(ip_addr):
     257
     >>> ip2int('255.255.255.255')
     4294967295
+    >>> ip2int('not an ip')
+    0
     """
-    ret = 0
-    ip_matcher = match("(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})", ip_addr)
-    if not ip_matcher:
+    try:
+        return struct.unpack('>I', socket.inet_aton(ip_addr))[0]
+    except (socket.error, TypeError):
         return 0
-    for i in xrange(4):
-        int_group = int(ip_matcher.groups()[i])
-        assert int_group < 256, "Incorrect IP address"
-        ret = (ret << 8) + int_group
-    return ret
+
+def ips2int(ip_addrs):
+    """Return the list of int values of the IP addresses (0 if invalid)
+    >>> ips2int(['0.0.0.1', '255.255.255.255', 'not an ip'])
+    [1, 4294967295, 0]
+    """
+    packed = []
+    for ip_addr in ip_addrs:
+        try:
+            packed.append(socket.inet_aton(ip_addr))
+        except (socket.error, TypeError):
+            packed.append('\0\0\0\0')
+    return list(struct.unpack('>%dI' % len(packed), ''.join(packed)))
 
 def int2ip(int_ip_addr):
     """Return the string value of an IP address in int form
@@ -73,49 +86,66 @@ def int2ip(int_ip_addr):
     >>> int2ip(4294967295)
     '255.255.255.255'
     """
-    bin_ip_addr = bin(int_ip_addr).split('0b')[1].rjust(32, '0')
-    ip_addr = []
-    for i in xrange(4):
-        ip_addr.append(str(int(bin_ip_addr[8 * i:8 * (i + 1)], 2)))
-    return '.'.join(ip_addr)
+    return socket.inet_ntoa(struct.pack('>I', int_ip_addr))
 
-def construct_ip_map(goo_file='as_list_goo.txt',
-                     you_eu_file='as_list_you_eu.txt'):
+def construct_ip_map(goo_file=os.path.join(AS_LIST_DIR, 'as_list_goo.txt'),
+                     you_eu_file=os.path.join(AS_LIST_DIR,
+                                              'as_list_you_eu.txt')):
     """Fills the IP MAP for Google and YouTube according to extraction of BGP in
     the input text files
     """
     ip_map = {}
     for name, as_file in (('GOO', goo_file), ('YT_EU', you_eu_file)):
         with open(as_file) as input_file:
-            ip_map[name] = map(as_ip_min_max, input_file.readlines())
+            ip_map[name] = filter(None, map(as_ip_min_max,
+                                            input_file.readlines()))
     return ip_map
 
+def construct_prefix_index(ip_map):
+    """Return the (starts, ends, as_names) sorted lists of the disjoint IP
+    ranges of the map, each range being given the AS of its most specific
+    prefix (alphabetical order of the ASes in case of equality)
+    >>> construct_prefix_index({'A': [(0, 255)], 'B': [(16, 31)]})
+    ([0, 16, 32], [15, 31, 255], ['A', 'B', 'A'])
+    """
+    prefixes = [(max_ip - min_ip, as_name, min_ip, max_ip)
+                for as_name, int_prefixes in ip_map.items()
+                for min_ip, max_ip in int_prefixes]
+    bounds = sorted(set([min_ip for _, _, min_ip, _ in prefixes]
+                        + [max_ip + 1 for _, _, _, max_ip in prefixes]))
+    starts, ends, as_names = [], [], []
+    for start, next_start in zip(bounds, bounds[1:]):
+        # prefixes are nested or disjoint: the range is inside the prefixes
+        # covering its start
+        covering = [(size, as_name) for size, as_name, min_ip, max_ip
+                    in prefixes if min_ip <= start <= max_ip]
+        if not covering:
+            continue
+        as_name = min(covering)[1]
+        if as_names and ends[-1] == start - 1 and as_names[-1] == as_name:
+            ends[-1] = next_start - 1
+        else:
+            starts.append(start)
+            ends.append(next_start - 1)
+            as_names.append(as_name)
+    return starts, ends, as_names
+
 IP_MAP = construct_ip_map()
+PREFIX_INDEX = construct_prefix_index(IP_MAP)
 
 def match_ip(ip_addr):
-    "Return the AS of the IP according to the IP_MAP"
-    list_as_found = []
+    """Return the AS of the IP according to the IP_MAP
+    >>> match_ip('8.8.8.8')
+    'GOO'
+    >>> match_ip('127.0.0.1')
+    """
     if type(ip_addr) == str:
         ip_addr = ip2int(ip_addr)
-    for as_name, int_prefixes in IP_MAP.items():
-        most_specific = 2**32
-        as_found = None
-        for min_ip, max_ip in int_prefixes:
-            if ip_addr >= min_ip and ip_addr <= max_ip:
-                as_found = as_name
-                if (max_ip - min_ip) < most_specific:
-                    most_specific = (max_ip - min_ip)
-                #print 'match on %s, %s' % tuple(map(int2ip, (min_ip, max_ip)))
-        if as_found:
-            list_as_found.append((most_specific, as_found))
-    if len(list_as_found) > 1:
-        print 'multiple ASes found for this IP: %s' % int2ip(ip_addr)
-        # smallest matching prefix will be first
-        list_as_found.sort()
-    if not list_as_found:
+    starts, ends, as_names = PREFIX_INDEX
+    index = bisect_right(starts, ip_addr) - 1
+    if index < 0 or ip_addr > ends[index]:
         return None
-    else:
-        return list_as_found[0][1]
+    return as_names[index]
 
 def as_data(db_file):
     """Function to plot the data in the database. Creates sub plots for
@@ -124,15 +154,17 @@ def as_data(db_file):
     conn = sqlite3.connect(str(db_file),
                            detect_types=sqlite3.PARSE_DECLTYPES)
     cur = conn.cursor()
-    user_table = cur.execute('select name from sqlite_master '
-                             'where type = "table"').fetchall()[0][0]
+    user_table = lib_database.crawl_table_name(cur, first=True)
+    # indexes and resolver table of the current schema
+    lib_database.upgrade_schema(conn, user_table)
     data = dict()
     #find the number of resolvers used.
     for resolver in DNS_RESOLVERS:
-        cmd = ' '.join(("select IP from", user_table,
-                        "where Resolver LIKE '%%%s%%';" % resolver))
+        cmd = ' '.join(("select IP from", user_table, "where",
+                        lib_database.resolver_condition(cur, user_table,
+                                                        resolver)))
         cur.execute(cmd)
-        data[resolver] = [ip2int(x[0]) for x in cur.fetchall()]
+        data[resolver] = ips2int([x[0] for x in cur.fetchall()])
     return data
 
 def compute_stats_db(db_file):
@@ -140,9 +172,7 @@ def compute_stats_db(db_file):
     data = as_data(db_file)
     output = dict()
     for resolver, ips in data.items():
-        as_list = map(match_ip, ips)
-        output[resolver] = [(as_name, len([x for x in as_list if x == as_name]))
-                            for as_name in set(as_list)]
+        output[resolver] = Counter(map(match_ip, ips)).items()
     return output
 
 if __name__ == '__main__':
@@ -21,9 +21,169 @@ except ImportError:
     plt = None
 # <= AO 201221010 (due to error in win)
 from itertools import cycle
+from bisect import bisect_left
+from math import ceil
+import random
 
 _VERSION = '2.0'
 
+# accuracy of the quantile sketches: the rank error is about 1.7/k
+CDF_SKETCH_K = 200
+# max nb of points of a plotted cdf line
+CDF_MAX_POINTS = 500
+
+class QuantileSketch(object):
+    '''Mergeable streaming quantile sketch (KLL)
+    The values are kept in compactors of increasing weight: when the sketch
+    is full, the values of a compactor are sorted and one out of two (chosen
+    at random) is moved to the next one, with twice the weight.
+    The sketch is exact while it holds less than k values.
+    >>> sketch = QuantileSketch(xrange(1, 101))
+    >>> len(sketch), sketch.quantile(.5), sketch.quantile(1)
+    (100, 50, 100)
+    >>> other = QuantileSketch(xrange(101, 100001))
+    >>> sketch.merge(other)
+    >>> len(sketch), sketch.min, sketch.max
+    (100000, 1, 100000)
+    >>> abs(sketch.quantile(.9) - 90000) < 2000
+    True
+    >>> values, cdf = sketch.cdf_points(max_points=10)
+    >>> len(values), cdf[0], cdf[-1]
+    (11, 0.0, 1.0)
+    '''
+
+    def __init__(self, values=(), k=CDF_SKETCH_K):
+        self.k = k
+        # compactors[h] holds values of weight 2 ** h
+        self.compactors = []
+        self.size = 0
+        self.max_size = 0
+        # nb of values fed and their exact extrema
+        self.count = 0
+        self.min = None
+        self.max = None
+        self._grow()
+        self.extend(values)
+
+    def _grow(self):
+        'Add a compactor of higher weight'
+        self.compactors.append([])
+        self.max_size = sum(self._capacity(height)
+                            for height in xrange(len(self.compactors)))
+
+    def _capacity(self, height):
+        'Return the capacity of the compactor (smaller for low weights)'
+        depth = len(self.compactors) - height - 1
+        return int(ceil((2 / 3) ** depth * self.k)) + 1
+
+    def _compress(self):
+        'Compact the compactors over capacity until the sketch is not full'
+        while self.size >= self.max_size:
+            for height, compactor in enumerate(self.compactors):
+                if len(compactor) >= self._capacity(height):
+                    break
+            if height + 1 >= len(self.compactors):
+                self._grow()
+            compactor.sort()
+            # odd length: the last value stays in the compactor
+            kept = compactor.pop() if len(compactor) % 2 else None
+            self.compactors[height + 1].extend(
+                                compactor[random.random() < .5::2])
+            del compactor[:]
+            if kept is not None:
+                compactor.append(kept)
+            self.size = sum(len(compactor) for compactor in self.compactors)
+
+    def update(self, value):
+        'Add a value (None is ignored)'
+        self.extend((value,))
+
+    def extend(self, values):
+        'Add the values of an iterable (None values are ignored)'
+        new_values = [value for value in values if value is not None]
+        if not new_values:
+            return
+        self.count += len(new_values)
+        low, high = min(new_values), max(new_values)
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self.compactors[0].extend(new_values)
+        self.size += len(new_values)
+        self._compress()
+
+    def feed(self, cursor, column=0, batch_size=10000):
+        'Add the values of a column of the rows of a db cursor'
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            self.extend(row[column] for row in rows)
+
+    def merge(self, other):
+        'Add the values of another sketch'
+        if not other.count:
+            return
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for compactor, other_compactor in zip(self.compactors,
+                                              other.compactors):
+            compactor.extend(other_compactor)
+        self.count += other.count
+        self.min = (other.min if self.min is None
+                    else min(self.min, other.min))
+        self.max = (other.max if self.max is None
+                    else max(self.max, other.max))
+        self.size = sum(len(compactor) for compactor in self.compactors)
+        self._compress()
+
+    def __len__(self):
+        return self.count
+
+    def weighted_values(self):
+        'Return the sorted values and their cumulated weights'
+        items = sorted((value, 2 ** height)
+                       for height, compactor in enumerate(self.compactors)
+                       for value in compactor)
+        cumulated = []
+        total = 0
+        for _, weight in items:
+            total += weight
+            cumulated.append(total)
+        return [value for value, _ in items], cumulated
+
+    def quantile(self, probability):
+        'Return the value of the probability quantile, None if empty'
+        values, cumulated = self.weighted_values()
+        if not values:
+            return None
+        index = bisect_left(cumulated, probability * cumulated[-1])
+        return values[min(index, len(values) - 1)]
+
+    def cdf_points(self, max_points=CDF_MAX_POINTS):
+        '''Return the (values, cdf) lists to plot the cdf with at most
+        max_points + 1 points in steps (first cdf value is 0)'''
+        values, cumulated = self.weighted_values()
+        if not values:
+            return [], []
+        total = cumulated[-1]
+        if len(values) > max_points:
+            # values at regularly spaced quantiles
+            indexes = [min(bisect_left(cumulated, point * total / max_points),
+                           len(values) - 1)
+                       for point in xrange(1, max_points + 1)]
+            values = [values[index] for index in indexes]
+            cumulated = [cumulated[index] for index in indexes]
+        # the extrema are exact
+        values[0] = min(values[0], self.min)
+        values.append(self.max)
+        return values, [0.] + [weight / total for weight in cumulated]
+
+def as_sketch(data_in):
+    'Return the data as a QuantileSketch (if not already one)'
+    if isinstance(data_in, QuantileSketch):
+        return data_in
+    return QuantileSketch(data_in)
+
 # possibility to place legend outside graph:
 #pylab.subfigure(111)
 #pylab.subplots_adjust(right=0.8) or (top=0.8)
@@ -71,37 +231,33 @@ class CdfFigure(object):
         self._axis.set_ylim(*args, **kwargs)
 
     def cdfplot(self, data_in, name='Data', finalize=False):
-        """Plot the cdf of a data array
+        """Plot the cdf of a data array or QuantileSketch
         Wrapper to call the plot method of axes
         """
-        data = sorted(filter(lambda x: x is not None, data_in))
-        data_len = len(data)
-        if data_len == 0:
+        sketch = as_sketch(data_in)
+        if not sketch.count:
             print("no data to plot", file=sys.stderr)
             return
-        cdf = np.arange(data_len + 1) / data_len
-        # to have cdf up to 1
-        data.append(data[-1])
+        # the last value is repeated to have cdf up to 1
+        data, cdf = sketch.cdf_points()
         line = self._axis.plot(data, cdf, drawstyle='steps',
-                              label=name + ': %d' % len(data))
+                              label=name + ': %d' % sketch.count)
         self._lines[name] = line[0]
         if finalize:
             self.adjust_plot()
 
     def ccdfplot(self, data_in, name='Data', finalize=False):
-        """Plot the cdf of a data array
+        """Plot the ccdf of a data array or QuantileSketch
         Wrapper to call the plot method of axes
         """
-        data = sorted(filter(lambda x: x is not None, data_in))
-        data_len = len(data)
-        if data_len == 0:
+        sketch = as_sketch(data_in)
+        if not sketch.count:
             print("no data to plot", file=sys.stderr)
             return
-        ccdf = 1 - np.arange(data_len + 1) / data_len
-        # to have cdf up to 1
-        data.append(data[-1])
+        data, cdf = sketch.cdf_points()
+        ccdf = [1 - value for value in cdf]
         line = self._axis.plot(data, ccdf, drawstyle='steps',
-                              label=name + ': %d' % len(data))
+                              label=name + ': %d' % sketch.count)
         self._lines[name] = line[0]
         if finalize:
             self.adjust_plot()
@@ -300,3 +456,6 @@ def bin_plot(datas, title='Bin Plot', xlabel='X', ylabel='Y',
     figure.adjust_plot()
     return figure
 
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
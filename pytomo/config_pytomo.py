@@ -19,13 +19,30 @@ BATCH_MODE = False
 PROVIDER = ''
 
 RESULT_DIR = 'results'
+# the results are written as JSON lines (see lib_result_stream), compressed if
+# the file name ends with .gz
 RESULT_FILE = None
-#RESULT_FILE = 'pytomo.result'
+#RESULT_FILE = 'pytomo.result.jsonl.gz'
+# the lines of the result file are written when this nb of bytes is pending
+# or after this period (in seconds)
+RESULT_BUFFER_SIZE = 64 * 1024
+RESULT_FLUSH_PERIOD = 10
 
 DATABASE_DIR = 'databases'
 DATABASE = 'pytomo_database.db'
 # DO NOT USE ANY . OR - IN THE TABLE NAME
 TABLE = 'pytomo_crawl'
+# the records of the crawl are committed by batches: when this number of
+# records is pending, when the oldest pending record is older than the
+# period (in seconds) or when no more records are waiting to be stored
+DB_BATCH_SIZE = 50
+DB_BATCH_PERIOD = 30
+# use the Write-Ahead Log journal so that the database can be read (web
+# interface, plots) while the crawl writes in it
+DB_WAL = False
+# nb of stats waiting in the queue of each result sink (database, result
+# file, snmp): the crawl blocks (or the snmp sink drops the stats) beyond
+SINK_QUEUE_SIZE = 1000
 
 LOG_DIR = 'logs'
 # log file use '-' for standard output
@@ -73,6 +90,26 @@ PDF_FILE = 'report.pdf'
 PDF_DIR = 'pdfs'
 # graphical interface default port to run on
 WEB_DEFAULT_PORT = '5555'
+# the reports of the graphical interface are rebuilt in background once the
+# database is unchanged for REPORT_DEBOUNCE seconds (or after REPORT_MAX_DELAY
+# seconds if it keeps changing)
+REPORT_DEBOUNCE = 10
+REPORT_MAX_DELAY = 90
+# max time in seconds a page waits for the first report of a database
+REPORT_WAIT = 300
+# nb of processes rendering the graphs and pdfs of the reports (None for the
+# nb of cores, 1 to render them in the web server process)
+REPORT_PROCESSES = None
+# max time in seconds the processes have to render the graphs or pdfs of a
+# report (they are then rendered in the web server process)
+REPORT_TIMEOUT = 600
+
+# aggregation of the databases received from the probes (start_aggregate.py)
+AGGREGATE_DATABASE = 'pytomo_aggregate.db'
+# DO NOT USE ANY . OR - IN THE TABLE NAME
+AGGREGATE_TABLE = 'pytomo_aggregate'
+# nb of processes extracting the archives (None for the nb of cores)
+AGGREGATE_PROCESSES = None
 
 
 STD_HEADERS = {
@@ -111,11 +148,35 @@ MAX_ROUND_DURATION = 600
 
 IPADDR_TIMEOUT = 5
 URL_TIMEOUT = 5
+# persistent connections of the metadata requests (lib_http_pool): max nb of
+# connections per host and max idle time (in seconds) before closing them
+HTTP_POOL_MAX_PER_HOST = 4
+HTTP_POOL_IDLE_TIMEOUT = 30
 AS_URL_TIMEOUT = 15
+# the AS of the IP prefixes are kept AS_CACHE_TTL seconds in this file (in the
+# database directory)
+AS_CACHE_FILE = 'as_cache.db'
+AS_CACHE_TTL = 7 * 24 * 3600
+# max time (in seconds) to wait for the AS of an IP when its stats are
+# computed: the AS is resolved in background during the measurements
+AS_LOOKUP_WAIT = 0
 
 # choose between 'youtube' and 'dailymotion'
 CRAWL_SERVICE = 'youtube'
 
+# nb of videos crawled in parallel (1 for sequential crawl)
+WORKERS = 1
+# max nb of parallel downloads on the same cache server
+MAX_DOWNLOADS_PER_SERVER = 2
+# keep the redirect chains of the cache servers of the videos for this time
+# (in seconds, 0 to disable), useful in loop mode: at most REDIRECT_CACHE_SIZE
+# chains are kept and REDIRECT_CACHE_REFRESH is the fraction of the chains
+# retrieved again anyway (the CacheServerDelay of the measurements reusing a
+# chain is NULL)
+REDIRECT_CACHE_TTL = 0
+REDIRECT_CACHE_SIZE = 1000
+REDIRECT_CACHE_REFRESH = 0.1
+
 
 ################################################################################
 # for lib_cache_url.py
@@ -172,10 +233,17 @@ HTTP_REDIRECT_CODE_LIST = (
 # for lib_ping.py
 # nb of packets to send for ping stats
 PING_PACKETS = 10
+# delay (in seconds) between two echo requests to the same IP and max wait for
+# the replies of the last ones
+PING_INTERVAL = 1.0
+PING_TIMEOUT = 2.0
 
 ################################################################################
 # for lib_youtube_download.py
 DOWNLOAD_TIME = 30.0
+# size (in bytes) of the buffer the video is received in (the largest block
+# read at once)
+DOWNLOAD_BUFFER_SIZE = 256 * 1024
 FREQ_FULL_DOWNLOAD = None
 #FREQ_FULL_DOWNLOAD = 40
 MAX_DOWNLOAD_TIME = 600.0
@@ -204,6 +272,12 @@ HD_FIRST = False
 # for snmp
 SNMP = False
 ROOT_OID = '.1.3.6.1.3.53.5.9'
+# the url tables keep the rows of the SNMP_TABLE_SIZE latest videos measured
+# in the last SNMP_TABLE_WINDOW seconds (0 for no limit), the IP and AS
+# tables count their downloads on the same window (gauges instead of
+# counters); with no limit at all, the rows are kept and counted forever
+SNMP_TABLE_SIZE = 0
+SNMP_TABLE_WINDOW = 0
 
 # Table of global stats
 snmp_pytomoGblStats = '.'.join((ROOT_OID, '1'))
@@ -262,6 +336,14 @@ snmp_pytomoASStats = '.'.join((ROOT_OID, '4', '1', '1'))
 snmp_pytomoASName = '.'.join((snmp_pytomoASStats,'1'))
 snmp_pytomoASCount = '.'.join((snmp_pytomoASStats,'2'))
 
+#Time spent in each phase of the crawl (in ms)
+snmp_pytomoPhaseStats = '.'.join((ROOT_OID, '5', '1', '1'))
+snmp_pytomoPhaseName = '.'.join((snmp_pytomoPhaseStats, '1'))
+snmp_pytomoPhaseCount = '.'.join((snmp_pytomoPhaseStats, '2'))
+snmp_pytomoPhaseTotalTime = '.'.join((snmp_pytomoPhaseStats, '3'))
+snmp_pytomoPhaseMeanTime = '.'.join((snmp_pytomoPhaseStats, '4'))
+snmp_pytomoPhaseMaxTime = '.'.join((snmp_pytomoPhaseStats, '5'))
+
 
 
 
@@ -270,6 +352,7 @@ URL_IDX = 2
 TS_IDX = 0
 IP_IDX = 5
 AS_IDX = 8
+DOWNLOAD_TIME_IDX = 12
 STATS_IDX = (
     2, #Url
     0, #TIMESTAMP
@@ -5,6 +5,7 @@
 # python-agentX module
 
 import ctypes, ctypes.util
+import bisect
 import signal
 import sys
 import time
@@ -135,6 +136,8 @@ OID_LEN				= MAX_OID_LEN*2+1
 TABLE_INDEX_INTEGER		= 1
 TABLE_INDEX_STRING		= 2
 
+OID_REGEX = re.compile("^(\.)?((\.\d+)+)$")
+
 
 # types 
 # oid type definition
@@ -246,10 +249,12 @@ class Oid:
         """
 	def __init__(self, oid_str):
 		oid_str = '.' + oid_str
-		regex = re.compile("^(\.)?((\.\d+)+)$")
-		if(regex.match(oid_str)):
-			oid_str = regex.match(oid_str).group(2)
+		match = OID_REGEX.match(oid_str)
+		if(match):
+			oid_str = match.group(2)
 			self.oid_array =  map(int, oid_str[1:].split('.'))
+			#tuples compare like oids: a suboid succeeds its parent
+			self.key = tuple(self.oid_array)
 		 	self.print_oid =  oid_str
 			self.next_oid = None
 			self.is_walkable = True
@@ -258,16 +263,7 @@ class Oid:
 
 
 	def __gt__(self, oid):
-		for i in range(0,min(len(self.oid_array), len(oid.oid_array))):
-			if self.oid_array[i] > oid.oid_array[i]:
-				return True
-			elif self.oid_array[i] < oid.oid_array[i]:
-				return False
-		#Cas ou un des oid est un suboid d'un autre
-		if(len(self.oid_array) > len(oid.oid_array)):
-			return True
-		else:
-			return False
+		return self.key > oid.key
 
 	def __eq__(self,oid):
 		return self.print_oid == oid.print_oid
@@ -373,6 +369,19 @@ class OidTable(dict):
 		* the array must contain as much elements as the value of number_of_index passed in constructor
 		* if it's a simple indexation (number_of_index = 1), you can pass only a single instance (integer or string)
 		""" 
+		return self.snmpdata.registerVar(self.indexOid(indexes),vtype, value)
+
+
+	def unregisterValue(self, indexes):
+		"""
+		Remove the value registered in table for indexes (see registerValue)
+		Returns False if there was no value for indexes
+		"""
+		return self.snmpdata.unregisterVar(self.indexOid(indexes))
+
+
+	def indexOid(self, indexes):
+		#returns the oid string of the value of indexes in table
 		def encode_str(str):
 			str = '{0}'.format(str)
 			ar = [] 
@@ -392,8 +401,7 @@ class OidTable(dict):
 			oid += '.' + '.'.join(map(encode_str,indexes))
 		else:
 			raise('Unsupported indexation type {0} '.format(self.index))
-
-		return self.snmpdata.registerVar(oid,vtype, value)
+		return oid
 
 
 
@@ -409,6 +417,9 @@ class SnmpData(dict):
 		rootobj = Oid(root)
                 self[root] = rootobj
                 self.root = rootobj
+		#sorted keys of all oids, and oid object of each key
+		self.keys_sorted = [rootobj.key]
+		self.oid_for_key = {rootobj.key: rootobj}
 
 
 	def addNode(self,oidstr):
@@ -426,17 +437,19 @@ class SnmpData(dict):
 			return oidobj
 
 
-	#insert oid in string
+	#insert oid in sorted keys (and in string of oids)
 	def insertOid(self, oid):
-		previous = self.root
-		while(not previous.getNext() is None and oid > previous.getNext()):
-			previous =  previous.getNext()
-		#at the end of this loop we have previous < oid and previous.getNext > oid
-                #or previous <oid and previous.getNext = None
+		position = bisect.bisect_right(self.keys_sorted, oid.key)
+		if position == 0:
+			raise BadOidException("Oid {0} precedes root oid".format(oid))
+		previous = self.oid_for_key[self.keys_sorted[position - 1]]
 		oldnext = previous.getNext()
                 previous.setNext(oid)
                 if not oldnext is None:
                 	oid.setNext(oldnext)
+		#oid object is set before its key can be found by readers
+		self.oid_for_key[oid.key] = oid
+		self.keys_sorted.insert(position, oid.key)
 
 
 	# register variable
@@ -468,6 +481,30 @@ class SnmpData(dict):
 			return oid
 
 
+	def unregisterVar(self, oidstr):
+		"""
+		Remove the value of oid (registered with registerVar) from snmpdata
+		Returns False if oid has no value
+		*oidstr: string representation ex: .1.2.3.5.6.1..0
+		"""
+		if not self.has_key(oidstr) or not self[oidstr].value_set_for_oid():
+			return False
+		oid = self[oidstr]
+		self.removeOid(oid)
+		del self[oidstr]
+		return True
+
+
+	#remove oid from sorted keys (and from string of oids)
+	def removeOid(self, oid):
+		position = bisect.bisect_left(self.keys_sorted, oid.key)
+		previous = self.oid_for_key[self.keys_sorted[position - 1]]
+		previous.next_oid = oid.getNext()
+		#key is removed before its oid object: readers may see the oid of a removed key
+		del self.keys_sorted[position]
+		del self.oid_for_key[oid.key]
+
+
 	def addTable(self, tableroot, index = TABLE_INDEX_INTEGER, number_of_index = 1):
 		"""
 		Insert a table in snmpdata
@@ -493,12 +530,33 @@ class SnmpData(dict):
 	def getNextValue(self, oidstr):
 		#returns OidValue object that succeed oidstr
 		#nodes (oid that not contain values) are skipped
-		if not self.has_key(oidstr):
+		#oidstr may have been removed (by unregisterVar) since it was walked
+		key = self.getKey(oidstr)
+		if key is None:
 			return None
-		oid = self[oidstr].getNext()
-		while((not oid is None) and (not oid.value_set_for_oid() or not oid.is_walkable)):
-			oid = oid.getNext()
-		return oid
+		keys_sorted = self.keys_sorted
+		position = bisect.bisect_right(keys_sorted, key)
+		while True:
+			try:
+				oid = self.oid_for_key.get(keys_sorted[position])
+			except IndexError:
+				return None
+			if not oid is None and oid.value_set_for_oid() and oid.is_walkable:
+				return oid
+			position += 1
+
+
+	def getKey(self, oidstr):
+		#returns the key of oidstr if it is in the subtree of the root, None otherwise
+		if self.has_key(oidstr):
+			return self[oidstr].key
+		try:
+			key = Oid(oidstr).key
+		except BadOidException:
+			return None
+		if key[:len(self.root.key)] != self.root.key:
+			return None
+		return key
 
 
 	def getRootAsStr(self):
@@ -534,7 +592,7 @@ class MultipleData:
 
 	def getNextValue(self, oid):
 		for snmpdata in self.snmpdatas:
-			if snmpdata.has_key(oid):
+			if not snmpdata.getKey(oid) is None:
 				return snmpdata.getNextValue(oid)
 		return None
 
@@ -623,26 +681,25 @@ class PassPersist:
 						
 		elif self.oidreg.match(line):
 			success = False
-			if self.snmpdata.has_key(line):
-								
-				if self.mode == 'get':
-					oid = self.snmpdata[line]
-					if oid.value_set_for_oid():
-						vtype = oid.get_str_for_type()
-						if not vtype is None:
-							print oid
-							print vtype
-							print oid.value
-							success = True
-				elif self.mode == 'getnext':
-					if not self.snmpdata.getNextValue(line) is None:
-						oid = self.snmpdata.getNextValue(line)
-						vtype = oid.get_str_for_type()
-						if not vtype is None:
-							print oid
-							print vtype
-							print oid.value
-							success = True
+			if self.mode == 'get' and self.snmpdata.has_key(line):
+				oid = self.snmpdata[line]
+				if oid.value_set_for_oid():
+					vtype = oid.get_str_for_type()
+					if not vtype is None:
+						print oid
+						print vtype
+						print oid.value
+						success = True
+			elif self.mode == 'getnext':
+				#the walked oid may have been removed
+				oid = self.snmpdata.getNextValue(line)
+				if not oid is None:
+					vtype = oid.get_str_for_type()
+					if not vtype is None:
+						print oid
+						print vtype
+						print oid.value
+						success = True
 			
 			if not success:
 				print 'NONE'
@@ -723,8 +780,10 @@ class AgentX(object):
 						axl.snmp_set_var_typed_value(r.requestvb, vtype, pvalue, size)	
 			
 			elif reqmode == SNMP_MSG_GETNEXT:
-				if snmpdata.has_key(str_oid):
-					if snmpdata.getNextValue(str_oid) is None:
+				#the walked oid may have been removed
+				next_oid = snmpdata.getNextValue(str_oid)
+				if snmpdata.has_key(str_oid) or not next_oid is None:
+					if next_oid is None:
 						# only set current objid
 						oid_list = snmpdata.get(str_oid).oid_array
                 				oidOID = (oid_t * len(oid_list)) (*oid_list)
@@ -732,7 +791,7 @@ class AgentX(object):
 
 					else:
 						# req.SetNext changes req.oid value
-						oid = snmpdata.getNextValue(str_oid)
+						oid = next_oid
 						oid_list = oid.oid_array
 						oidOID = (oid_t * len(oid_list)) (*oid_list)
 						axl.snmp_set_var_objid(r.requestvb, oidOID,  len(oidOID))
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+"""Module to aggregate the databases received from the probes
+
+   The to_send.tbz archives uploaded by the probes (or their extracted
+   databases) are decompressed and checked by a pool of processes, then
+   their records are appended into one aggregate database: the rows are
+   copied by sqlite itself (INSERT ... SELECT on the attached database) so
+   that they are never loaded in memory.
+   Each record is stored once per (Probe, ID, IP), and the archives already
+   aggregated (same name, size and modification time) are skipped: only the
+   new archives are processed at each run.
+
+   Usage:
+       ./start_aggregate.py [-v] [-d aggregate_database] [-p processes]
+                            incoming_dir [incoming_dir ...]
+
+       import pytomo.lib_aggregate as lib_aggregate
+       lib_aggregate.aggregate(['incoming'], 'pytomo_aggregate.db')
+"""
+
+from __future__ import with_statement, absolute_import, print_function
+
+import logging
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import tarfile
+import tempfile
+import time
+from itertools import imap
+from optparse import OptionParser
+
+try:
+    from . import config_pytomo
+except ValueError:
+    import config_pytomo
+try:
+    from . import lib_database
+except ValueError:
+    import lib_database
+try:
+    from .lib_io import file_signature
+except ValueError:
+    from lib_io import file_signature
+
+ARCHIVE_EXTENSION = '.tbz'
+# table of the archives already aggregated
+ARCHIVES_TABLE = 'AggregatedArchives'
+# nb of dot separated fields of the archive and database names after the
+# probe name: service[_provider].date.time.file_pattern.extension
+NAME_FIELDS = 5
+
+def probe_name(file_name):
+    '''Return the name of the probe of the archive or database (the hostname
+    prefix of its name)
+    >>> probe_name('/incoming/ATS-VM-MARS.youtube_orange.2013-01-24.08_00_00'
+    ...            '.to_send.tbz')
+    'ATS-VM-MARS'
+    >>> probe_name('probe.example.com.dailymotion.2013-01-24.08_00_00'
+    ...            '.pytomo_database.db')
+    'probe.example.com'
+    >>> probe_name('pytomo_database.db')
+    'pytomo_database'
+    '''
+    name = os.path.basename(file_name)
+    fields = name.rsplit('.', NAME_FIELDS)
+    if len(fields) <= NAME_FIELDS:
+        return os.path.splitext(name)[0]
+    return fields[0]
+
+def is_archive(file_name):
+    'Return True if the file is an archive or a database of a probe'
+    return (file_name.endswith(ARCHIVE_EXTENSION)
+            or file_name.endswith(config_pytomo.DATABASE))
+
+def list_archives(paths):
+    '''Return the sorted list of the archives and databases given, or
+    contained in the directories given'''
+    archives = set()
+    for path in paths:
+        if os.path.isdir(path):
+            archives.update(os.path.join(path, file_name)
+                            for file_name in os.listdir(path)
+                            if is_archive(file_name))
+        elif os.path.isfile(path):
+            archives.add(path)
+        else:
+            config_pytomo.LOG.warning('No such file or directory: %s' % path)
+    return sorted(archives)
+
+def extract_database(archive, work_dir):
+    '''Extract the database of the archive in work_dir and return its path
+    The database of a plain database file is the file itself.'''
+    if not archive.endswith(ARCHIVE_EXTENSION):
+        return archive
+    with tarfile.open(archive, 'r:bz2') as tar_file:
+        for member in tar_file:
+            if (member.isfile()
+                and member.name.endswith(config_pytomo.DATABASE)):
+                break
+        else:
+            raise IOError('no database in archive')
+        # do not trust the path of the member
+        db_file = os.path.join(work_dir, '.'.join((os.path.basename(archive),
+                                                   'db')))
+        with open(db_file, 'wb') as f_db:
+            shutil.copyfileobj(tar_file.extractfile(member), f_db)
+    return db_file
+
+def prepare_archive(job):
+    '''Extract and check the database of the archive (run in the pool)
+    Return (archive, database, crawl table, columns, error): columns is the
+    list of (name, type) of the crawl table, error is None if the database
+    can be aggregated.'''
+    archive, work_dir = job
+    db_file = None
+    try:
+        db_file = extract_database(archive, work_dir)
+        connection = sqlite3.connect(db_file)
+        try:
+            cursor = connection.cursor()
+            integrity = cursor.execute('PRAGMA quick_check').fetchone()[0]
+            if integrity != 'ok':
+                raise sqlite3.DatabaseError(integrity)
+            table = lib_database.crawl_table_name(cursor)
+            if not table:
+                raise sqlite3.DatabaseError('no crawl table')
+            columns = [(column[1], column[2]) for column in
+                       cursor.execute('PRAGMA table_info(%s)' % table)]
+        finally:
+            connection.close()
+    except (tarfile.TarError, IOError, OSError, EOFError,
+            sqlite3.Error), mes:
+        return archive, db_file, None, None, str(mes)
+    return archive, db_file, table, columns, None
+
+class AggregateDatabase(object):
+    '''Database of the records of all the probes
+    The records are stored in table with a Probe column and the columns of
+    all the crawl tables aggregated.
+    >>> aggregate_db = AggregateDatabase(':memory:')
+    >>> aggregate_db.is_new('/incoming/a.to_send.tbz', (1.0, 10))
+    True
+    >>> aggregate_db.mark_seen('/incoming/a.to_send.tbz', (1.0, 10), 'a', 3)
+    >>> aggregate_db.is_new('/other/a.to_send.tbz', (1.0, 10))
+    False
+    >>> aggregate_db.is_new('/incoming/a.to_send.tbz', (2.0, 10))
+    True
+    '''
+
+    def __init__(self, aggregate_file, table=None):
+        self.table = table or config_pytomo.AGGREGATE_TABLE
+        # transactions are explicit: attach is not possible in a transaction
+        self.connection = sqlite3.connect(aggregate_file, isolation_level=None)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS %s (Probe text, '
+                            'ID TIMESTAMP, IP text)' % self.table)
+        self.cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS %s_record ON '
+                            '%s(Probe, ID, IP)' % (self.table, self.table))
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS %s_ID ON %s(ID)'
+                            % (self.table, self.table))
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS %s (Name text '
+                            'PRIMARY KEY, MTime real, Size int, Probe text, '
+                            'NbRecords int, Error text, Aggregated real)'
+                            % ARCHIVES_TABLE)
+        self.columns = lib_database.table_columns(self.cursor, self.table)
+
+    def close(self):
+        'Close the aggregate database'
+        self.connection.close()
+
+    def is_new(self, archive, signature):
+        'Return True if the archive has not been aggregated yet'
+        seen = self.cursor.execute('SELECT MTime, Size FROM %s WHERE Name = ?'
+                                   % ARCHIVES_TABLE,
+                                   (os.path.basename(archive),)).fetchone()
+        return seen != signature
+
+    def mark_seen(self, archive, signature, probe, nb_records, error=None):
+        'Record the archive as aggregated'
+        mtime, size = signature
+        self.cursor.execute('INSERT OR REPLACE INTO %s VALUES '
+                            '(?, ?, ?, ?, ?, ?, ?)' % ARCHIVES_TABLE,
+                            (os.path.basename(archive), mtime, size, probe,
+                             nb_records, error, time.time()))
+
+    def add_columns(self, columns):
+        'Add to the aggregate table the columns it does not have yet'
+        for name, column_type in columns:
+            if name not in self.columns:
+                self.cursor.execute('ALTER TABLE %s ADD COLUMN %s %s'
+                                    % (self.table, name, column_type))
+                self.columns.add(name)
+
+    def append(self, archive, signature, db_file, table, columns):
+        '''Append the records of the crawl table of the database which are
+        not aggregated yet and return their number
+        The archive is recorded as seen in the same transaction.'''
+        probe = probe_name(archive)
+        self.add_columns(columns)
+        names = [name for name, _ in columns if name not in ('ID', 'IP')]
+        # a NULL IP would not be unique
+        selected = ', '.join(['ID', "COALESCE(IP, '')"] + names)
+        self.cursor.execute('ATTACH DATABASE ? AS source', (db_file,))
+        try:
+            self.cursor.execute('BEGIN')
+            try:
+                nb_changes = self.connection.total_changes
+                self.cursor.execute('INSERT OR IGNORE INTO %s (%s) SELECT ?, '
+                                    '%s FROM source.%s'
+                                    % (self.table, ', '.join(['Probe', 'ID',
+                                                              'IP'] + names),
+                                       selected, table), (probe,))
+                nb_records = self.connection.total_changes - nb_changes
+                self.mark_seen(archive, signature, probe, nb_records)
+            except:
+                self.cursor.execute('ROLLBACK')
+                raise
+            self.cursor.execute('COMMIT')
+        finally:
+            self.cursor.execute('DETACH DATABASE source')
+        return nb_records
+
+def imap_pool(function, jobs, processes=None):
+    '''Return an iterator on function(job) for each job, computed by a pool
+    of processes (config_pytomo.AGGREGATE_PROCESSES, all the cores if None)
+    in the order they complete, and the pool (None if not used)
+    >>> results, pool = imap_pool(abs, [-1, 2, -3], processes=1)
+    >>> sorted(results), pool
+    ([1, 2, 3], None)
+    '''
+    if processes is None:
+        processes = config_pytomo.AGGREGATE_PROCESSES
+    jobs = list(jobs)
+    if processes != 1 and len(jobs) > 1:
+        try:
+            pool = multiprocessing.Pool(processes)
+        except (OSError, ImportError, NotImplementedError), mes:
+            config_pytomo.LOG.warning('Could not start the process pool: %s'
+                                      % mes)
+        else:
+            return pool.imap_unordered(function, jobs), pool
+    return imap(function, jobs), None
+
+def aggregate(paths, aggregate_file, processes=None):
+    '''Append the records of the new archives and databases of the paths into
+    the aggregate database and return the nb of records added'''
+    archives = list_archives(paths)
+    aggregate_db = AggregateDatabase(aggregate_file)
+    signatures = dict((archive, file_signature(archive))
+                      for archive in archives)
+    new_archives = [archive for archive in archives
+                    if aggregate_db.is_new(archive, signatures[archive])]
+    config_pytomo.LOG.info('%d new archives out of %d'
+                           % (len(new_archives), len(archives)))
+    # extract on the disk of the aggregate database
+    work_dir = tempfile.mkdtemp(prefix='pytomo_aggregate',
+                                dir=os.path.dirname(
+                                    os.path.abspath(aggregate_file)))
+    jobs = [(archive, work_dir) for archive in new_archives]
+    results, pool = imap_pool(prepare_archive, jobs, processes=processes)
+    nb_records = 0
+    try:
+        for archive, db_file, table, columns, error in results:
+            signature = signatures[archive]
+            if error:
+                config_pytomo.LOG.error('Unable to aggregate %s: %s'
+                                        % (archive, error))
+                # corrupted archives are retried only if they are replaced
+                aggregate_db.mark_seen(archive, signature,
+                                       probe_name(archive), None, error)
+            else:
+                try:
+                    nb_added = aggregate_db.append(archive, signature,
+                                                   db_file, table, columns)
+                except sqlite3.Error, mes:
+                    config_pytomo.LOG.error('Unable to aggregate %s: %s'
+                                            % (archive, mes))
+                else:
+                    nb_records += nb_added
+                    config_pytomo.LOG.debug('%d records added from %s'
+                                            % (nb_added, archive))
+            if db_file and db_file != archive:
+                os.remove(db_file)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+        aggregate_db.close()
+    return nb_records
+
+def configure_log():
+    'Log on the standard error'
+    config_pytomo.LOG = logging.getLogger('pytomo_aggregate')
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(filename)s:'
+                                           '%(lineno)d - %(levelname)s - '
+                                           '%(message)s'))
+    config_pytomo.LOG.addHandler(handler)
+    config_pytomo.LOG.setLevel(logging.INFO)
+
+def create_options(parser):
+    'Add the different options to the parser'
+    parser.add_option('-d', '--database', dest='aggregate_file',
+                      default=config_pytomo.AGGREGATE_DATABASE,
+                      help=('Aggregate database (default: %s)'
+                            % config_pytomo.AGGREGATE_DATABASE))
+    parser.add_option('-p', '--processes', dest='processes', type='int',
+                      default=config_pytomo.AGGREGATE_PROCESSES,
+                      help=('Nb of processes extracting the archives '
+                            '(default: nb of cores)'))
+    parser.add_option('-v', '--verbose', dest='verbose',
+                      action='store_true', default=False,
+                      help='verbose')
+
+def main(argv=None):
+    'Program wrapper'
+    if argv is None:
+        argv = sys.argv[1:]
+    usage = ('%prog [-v] [-d aggregate_database] [-p processes] '
+             'incoming_dir [incoming_dir ...]')
+    parser = OptionParser(usage=usage)
+    create_options(parser)
+    (options, args) = parser.parse_args(argv)
+    if not args:
+        parser.error('Must provide at least one incoming directory or archive')
+    if not config_pytomo.LOG:
+        configure_log()
+    if options.verbose:
+        config_pytomo.LOG.setLevel(logging.DEBUG)
+    start = time.time()
+    nb_records = aggregate(args, options.aggregate_file,
+                           processes=options.processes)
+    config_pytomo.LOG.info('%d records added to %s in %.2fs'
+                           % (nb_records, options.aggregate_file,
+                              time.time() - start))
+    return 0
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
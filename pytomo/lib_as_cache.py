@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""Module to cache the AS numbers of the IP prefixes
+
+   The AS of an IP address is requested to RIPEstat by a background thread
+   so that the measurements are not delayed. The announced prefix and its
+   AS are kept in memory for a longest prefix match and stored in a sqlite
+   file to be reused by the next crawls until the entry expires.
+
+   Usage:
+       import pytomo.lib_as_cache as lib_as_cache
+       as_cache = lib_as_cache.AsCache()
+       as_cache.open('as_cache.db')
+       as_cache.request('173.194.20.56')
+       # later
+       as_nb = as_cache.lookup('173.194.20.56')
+       as_cache.close()
+"""
+
+from __future__ import with_statement, absolute_import
+
+import json
+import socket
+import sqlite3
+import struct
+import threading
+import time
+import urllib2
+import Queue
+
+from . import config_pytomo
+
+AS_REQUEST_URL = r'http://stat.ripe.net/data/routing-status/data.json?resource='
+# prefix length stored when RIPEstat does not give the announced prefix
+DEFAULT_PREFIX_LENGTH = 24
+
+def ip2int(ip_address):
+    '''Return the integer value of the IPv4 address, None if invalid
+    >>> ip2int('1.2.3.4')
+    16909060
+    >>> ip2int('::1')
+    '''
+    try:
+        return struct.unpack('>I', socket.inet_aton(ip_address))[0]
+    except (socket.error, TypeError):
+        return None
+
+def parse_prefix(prefix, ip_address):
+    '''Return the (network, length) tuple of the prefix "a.b.c.d/len"
+    The /24 of ip_address is returned if prefix cannot be parsed.
+    >>> parse_prefix('173.194.0.0/16', '173.194.20.56') == (
+    ...                                         ip2int('173.194.0.0'), 16)
+    True
+    >>> parse_prefix(None, '1.2.3.4') == (ip2int('1.2.3.0'), 24)
+    True
+    '''
+    try:
+        network, length = prefix.split('/')
+        network, length = ip2int(network), int(length)
+    except (AttributeError, ValueError):
+        network, length = None, None
+    if network is None or not 0 <= length <= 32:
+        network, length = ip2int(ip_address), DEFAULT_PREFIX_LENGTH
+    return network & prefix_mask(length), length
+
+def prefix_mask(length):
+    'Return the network mask of the prefix length'
+    return (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF
+
+def fetch_as(ip_address):
+    '''Return a tuple (network, length, as_nb) for the ip address announced
+    prefix as seen by RIPEstat'''
+    data = json.load(urllib2.urlopen(AS_REQUEST_URL + ip_address,
+                                     timeout=config_pytomo.AS_URL_TIMEOUT))
+    # HARD CODED fields of json data
+    last_seen = data['data']['last_seen']
+    network, length = parse_prefix(last_seen.get('prefix'), ip_address)
+    return network, length, int(last_seen['origin'])
+
+class AsCache(object):
+    '''Longest prefix match cache of the AS numbers
+    >>> as_cache = AsCache(ttl=60)
+    >>> as_cache.store(ip2int('10.0.0.0'), 8, 1)
+    >>> as_cache.store(ip2int('10.1.0.0'), 16, 2)
+    >>> as_cache.lookup('10.1.2.3'), as_cache.lookup('10.2.3.4')
+    (2, 1)
+    >>> as_cache.lookup('11.0.0.1')
+    '''
+
+    def __init__(self, ttl=None, fetch=fetch_as):
+        self.ttl = ttl or config_pytomo.AS_CACHE_TTL
+        self._fetch = fetch
+        # prefix length -> {network: (as_nb, expiry time)}
+        self._prefixes = dict()
+        # ip address -> event set when its resolution is over
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._db = None
+
+    def open(self, cache_file):
+        'Load the valid entries of the cache file and store the new ones'
+        try:
+            db = sqlite3.connect(cache_file, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute('CREATE TABLE IF NOT EXISTS AsPrefix ('
+                       'Network INTEGER, Length INTEGER, ASNumber INTEGER, '
+                       'Expiry REAL, PRIMARY KEY (Network, Length))')
+            db.execute('DELETE FROM AsPrefix WHERE Expiry < ?', (time.time(),))
+            entries = db.execute('SELECT Network, Length, ASNumber, Expiry '
+                                 'FROM AsPrefix').fetchall()
+        except sqlite3.Error, mes:
+            config_pytomo.LOG.error('Unable to use AS cache file %s: %s',
+                                    cache_file, mes)
+            return
+        with self._lock:
+            self._db = db
+            for network, length, as_nb, expiry in entries:
+                self._prefixes.setdefault(length, dict())[network] = (as_nb,
+                                                                      expiry)
+        config_pytomo.LOG.debug('Loaded %d AS prefixes from %s',
+                                len(entries), cache_file)
+
+    def close(self):
+        'Stop the resolutions and close the cache file'
+        if self._thread:
+            self._queue.put(None)
+            self._thread = None
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+    def store(self, network, length, as_nb):
+        'Add the AS of the prefix to the cache'
+        expiry = time.time() + self.ttl
+        with self._lock:
+            self._prefixes.setdefault(length, dict())[network] = (as_nb,
+                                                                  expiry)
+            if self._db:
+                try:
+                    self._db.execute('INSERT OR REPLACE INTO AsPrefix '
+                                     'VALUES (?, ?, ?, ?)',
+                                     (network, length, as_nb, expiry))
+                except sqlite3.Error, mes:
+                    config_pytomo.LOG.error('Unable to store AS prefix: %s',
+                                            mes)
+
+    def _match(self, ip_int):
+        'Return the AS of the longest valid prefix matching the ip'
+        now = time.time()
+        with self._lock:
+            for length in sorted(self._prefixes, reverse=True):
+                network = ip_int & prefix_mask(length)
+                entry = self._prefixes[length].get(network)
+                if not entry:
+                    continue
+                as_nb, expiry = entry
+                if expiry < now:
+                    del self._prefixes[length][network]
+                    continue
+                return as_nb
+        return None
+
+    def lookup(self, ip_address, wait=0):
+        '''Return the AS of the ip address, None if unknown
+        If the resolution of the ip is running, wait at most wait seconds for
+        its result.'''
+        ip_int = ip2int(ip_address)
+        if ip_int is None:
+            return None
+        as_nb = self._match(ip_int)
+        if as_nb is None and wait:
+            with self._lock:
+                event = self._pending.get(ip_address)
+            if event and event.wait(wait):
+                as_nb = self._match(ip_int)
+        return as_nb
+
+    def request(self, ip_address):
+        'Resolve the AS of the ip address in background if unknown'
+        ip_int = ip2int(ip_address)
+        if ip_int is None or self._match(ip_int) is not None:
+            return
+        with self._lock:
+            if ip_address in self._pending:
+                return
+            self._pending[ip_address] = threading.Event()
+            if not self._thread:
+                self._thread = threading.Thread(target=self._resolve,
+                                                name='AsResolver')
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put(ip_address)
+
+    def _resolve(self):
+        'Resolve the requested ip addresses until the cache is closed'
+        while True:
+            ip_address = self._queue.get()
+            if ip_address is None:
+                break
+            try:
+                # another ip of the same prefix may have been resolved
+                if self._match(ip2int(ip_address)) is None:
+                    network, length, as_nb = self._fetch(ip_address)
+                    self.store(network, length, as_nb)
+                    config_pytomo.LOG.debug('IP %s resolved as AS: %d',
+                                            ip_address, as_nb)
+            except Exception, mes:
+                config_pytomo.LOG.error('Unable to resolve AS of %s: %s',
+                                        ip_address, mes)
+            finally:
+                with self._lock:
+                    event = self._pending.pop(ip_address)
+                event.set()
+
+    def __len__(self):
+        return sum(len(networks) for networks in self._prefixes.values())
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
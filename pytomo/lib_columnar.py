@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""Module to export the crawl tables in a columnar format for the analysis
+
+   The crawl table of a database is written in a directory with one numpy
+   array file per column: the timestamps (ID) are seconds from epoch (UTC),
+   the numeric columns are float arrays (nan for the missing values) and the
+   text columns are dictionary encoded (int32 codes, -1 for the missing
+   values, and the list of the distinct strings).
+   The rows are exported in the order of their timestamp, in batches, and
+   the arrays are read back memory-mapped: loading a column does not read
+   the file.
+
+   Usage:
+       python lib_columnar.py [-o export_dir] database [database ...]
+
+       import pytomo.lib_columnar as lib_columnar
+       export_dir = lib_columnar.export_table('pytomo_database.db')
+       table = lib_columnar.ColumnarTable(export_dir)
+       table.column('DownloadTime').mean()
+       table.contains('Resolver', 'google')
+"""
+
+from __future__ import with_statement, absolute_import, print_function
+
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+from optparse import OptionParser
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from . import lib_database
+except ValueError:
+    import lib_database
+
+COLUMNAR_EXTENSION = '.columns'
+# description of the exported table
+META_FILE = 'table.json'
+FORMAT_VERSION = 1
+# kinds of the exported columns
+TIME, NUMBER, STRING = 'time', 'number', 'string'
+# declared types of the text columns (sqlite type affinity rules)
+TEXT_TYPES = ('CHAR', 'CLOB', 'TEXT')
+# nb of rows read from the database at a time
+EXPORT_BATCH = 10000
+
+def column_kind(name, declared_type):
+    '''Return the kind of the exported column
+    >>> column_kind('ID', 'TIMESTAMP'), column_kind('IP', 'text')
+    ('time', 'string')
+    >>> column_kind('DownloadBytes', 'int')
+    'number'
+    '''
+    if name == 'ID':
+        return TIME
+    if any(text_type in declared_type.upper() for text_type in TEXT_TYPES):
+        return STRING
+    return NUMBER
+
+def column_expression(name, kind):
+    'Return the SQL expression selecting the exported value of the column'
+    if kind == TIME:
+        # exact seconds and their milliseconds (%f is rounded)
+        return ("CAST(strftime('%%s', %s) AS REAL) + MIN(strftime('%%f', %s) "
+                "- CAST(strftime('%%S', %s) AS INTEGER), 0.999)"
+                % (name, name, name))
+    if kind == NUMBER:
+        # empty strings are missing values
+        return "CAST(NULLIF(%s, '') AS REAL)" % name
+    return name
+
+def is_columnar(path):
+    'Return True if path is a table exported by export_table'
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+def export_table(db_file, export_dir=None, batch_size=EXPORT_BATCH):
+    '''Export the crawl table of the database in export_dir (db_file with
+    COLUMNAR_EXTENSION by default) and return export_dir
+    A previous export is replaced once the new one is complete.'''
+    if export_dir is None:
+        export_dir = ''.join((db_file, COLUMNAR_EXTENSION))
+    connection = sqlite3.connect(db_file)
+    # the count and the rows are read in the same transaction: the rows
+    # committed meanwhile by a crawl are not exported
+    connection.isolation_level = None
+    cursor = connection.cursor()
+    cursor.execute('BEGIN')
+    table = lib_database.crawl_table_name(cursor)
+    if not table:
+        connection.close()
+        raise sqlite3.DatabaseError('No crawl table in %s' % db_file)
+    columns = [(column[1], column_kind(column[1], column[2])) for column
+               in cursor.execute('PRAGMA table_info(%s)' % table).fetchall()]
+    nb_rows = cursor.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+    export_dir = os.path.abspath(export_dir)
+    tmp_dir = tempfile.mkdtemp(prefix='.'.join((os.path.basename(export_dir),
+                                                'tmp')),
+                               dir=os.path.dirname(export_dir))
+    try:
+        arrays = []
+        for name, kind in columns:
+            dtype = np.int32 if kind == STRING else np.float64
+            arrays.append(np.lib.format.open_memmap(
+                                os.path.join(tmp_dir, '%s.npy' % name),
+                                mode='w+', dtype=dtype, shape=(nb_rows,)))
+        # distinct string -> code of each text column
+        codes = dict((name, dict()) for name, kind in columns
+                     if kind == STRING)
+        selected = ', '.join(column_expression(name, kind)
+                             for name, kind in columns)
+        cursor.execute(' '.join(('SELECT', selected, 'FROM', table,
+                                 'ORDER BY ID')))
+        start = 0
+        while start < nb_rows:
+            rows = cursor.fetchmany(min(batch_size, nb_rows - start))
+            if not rows:
+                break
+            end = start + len(rows)
+            for index, (name, kind) in enumerate(columns):
+                values = [row[index] for row in rows]
+                if kind == STRING:
+                    column_codes = codes[name]
+                    values = [-1 if value is None
+                              else column_codes.setdefault(value,
+                                                           len(column_codes))
+                              for value in values]
+                arrays[index][start:end] = values
+            start = end
+        for array in arrays:
+            array.flush()
+        del arrays
+        for name, column_codes in codes.items():
+            dictionary = sorted(column_codes, key=column_codes.get)
+            with open(os.path.join(tmp_dir, '%s.json' % name), 'w') as f_dict:
+                json.dump(dictionary, f_dict)
+        with open(os.path.join(tmp_dir, META_FILE), 'w') as f_meta:
+            json.dump({'version': FORMAT_VERSION, 'table': table,
+                       'nb_rows': nb_rows, 'columns': columns}, f_meta)
+        if os.path.isdir(export_dir):
+            shutil.rmtree(export_dir)
+        os.rename(tmp_dir, export_dir)
+    except:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    finally:
+        connection.close()
+    return export_dir
+
+class ColumnarTable(object):
+    '''Reader of a table exported by export_table
+    >>> db_dir = tempfile.mkdtemp()
+    >>> db_file = os.path.join(db_dir, 'doc_test.pytomo_database.db')
+    >>> connection = sqlite3.connect(db_file)
+    >>> _ = connection.execute('CREATE TABLE pytomo_crawl (ID TIMESTAMP, '
+    ...                        'Resolver text, PingMin real, StatusCode int)')
+    >>> _ = connection.executemany('INSERT INTO pytomo_crawl VALUES '
+    ...                            '(?, ?, ?, ?)',
+    ...         [('2012-06-25 14:55:30.5', 'google', '', None),
+    ...          ('2012-06-25 14:54:57', '_default_open_dns', 10, 200)])
+    >>> connection.commit()
+    >>> table = ColumnarTable(export_table(db_file, batch_size=1))
+    >>> len(table), table.column_names
+    (2, [u'ID', u'Resolver', u'PingMin', u'StatusCode'])
+    >>> table.column('ID').tolist(), table.column('PingMin').tolist()
+    ([1340636097.0, 1340636130.5], [10.0, nan])
+    >>> table.strings('Resolver').tolist()
+    [u'_default_open_dns', u'google']
+    >>> table.contains('Resolver', 'OPEN').tolist()
+    [True, False]
+    >>> shutil.rmtree(db_dir)
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f_meta:
+            meta = json.load(f_meta)
+        if meta['version'] != FORMAT_VERSION:
+            raise ValueError('Unknown columnar format version: %s'
+                             % meta['version'])
+        self.table = meta['table']
+        self.nb_rows = meta['nb_rows']
+        self.kinds = dict(meta['columns'])
+        self.column_names = [name for name, _ in meta['columns']]
+        self._arrays = dict()
+        self._dictionaries = dict()
+
+    def __len__(self):
+        return self.nb_rows
+
+    def column(self, name):
+        '''Return the memory-mapped array of the column: the values of the
+        time and numeric columns, the codes of the text columns'''
+        if name not in self._arrays:
+            if name not in self.kinds:
+                raise KeyError('No column %s in %s' % (name, self.path))
+            self._arrays[name] = np.load(os.path.join(self.path,
+                                                      '%s.npy' % name),
+                                         mmap_mode='r')
+        return self._arrays[name]
+
+    def dictionary(self, name):
+        'Return the list of the distinct strings of the text column'
+        if name not in self._dictionaries:
+            with open(os.path.join(self.path, '%s.json' % name)) as f_dict:
+                self._dictionaries[name] = json.load(f_dict)
+        return self._dictionaries[name]
+
+    def strings(self, name):
+        'Return the object array of the values of the text column'
+        # code -1 (missing value) is the last item
+        return np.array(self.dictionary(name) + [None],
+                        dtype=object)[self.column(name)]
+
+    def contains(self, name, text):
+        '''Return the boolean mask of the records whose value of the text
+        column contains text (case insensitive like LIKE '%text%' of sqlite)
+        The strings are compared on the dictionary only.'''
+        matches = [text.lower() in value.lower()
+                   for value in self.dictionary(name)]
+        return np.array(matches + [False], dtype=bool)[self.column(name)]
+
+def create_options(parser):
+    'Add the different options to the parser'
+    parser.add_option('-o', '--export_dir', dest='export_dir', default=None,
+                      help=('Directory of the export (only with one database, '
+                            'default: database%s)' % COLUMNAR_EXTENSION))
+
+def main(argv=None):
+    'Program wrapper'
+    if argv is None:
+        argv = sys.argv[1:]
+    usage = '%prog [-o export_dir] database [database ...]'
+    parser = OptionParser(usage=usage)
+    create_options(parser)
+    (options, args) = parser.parse_args(argv)
+    if not args:
+        parser.error('Must provide at least one database')
+    if options.export_dir and len(args) > 1:
+        parser.error('The export directory can be set for one database only')
+    for db_file in args:
+        try:
+            export_dir = export_table(db_file, options.export_dir)
+        except (sqlite3.Error, IOError, OSError, ValueError), mes:
+            print('Unable to export %s: %s' % (db_file, mes))
+            return 1
+        print('The crawl table of %s has been exported to %s'
+              % (db_file, export_dir))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Module to crawl several videos at once
+
+   This module provides the pieces used by start_pytomo when more than one
+   worker is configured (--workers option), the stats being stored by the
+   sinks of lib_result_sinks:
+       * ServerSlots: per cache server semaphores to limit the number of
+         parallel downloads on the same server
+       * run_workers: a bounded pool of threads processing a set of urls
+
+   Usage:
+       import pytomo.lib_crawl_pool as lib_crawl_pool
+       lib_crawl_pool.run_workers(crawl_function, urls, 4)
+"""
+
+from __future__ import with_statement, absolute_import
+
+import sys
+import threading
+import Queue
+
+from . import config_pytomo
+
+# period (in seconds) to check the workers (allows Ctrl-C to be caught)
+JOIN_PERIOD = 1.0
+
+class ServerSlots(object):
+    '''Limit the number of concurrent downloads per cache server
+    >>> slots = ServerSlots(max_per_server=1)
+    >>> with slots.slot('1.2.3.4'):
+    ...     slots.slot('1.2.3.4').acquire(False)
+    False
+    >>> slots.slot('1.2.3.4').acquire(False)
+    True
+    '''
+
+    def __init__(self, max_per_server=None):
+        self.max_per_server = max_per_server
+        self._semaphores = dict()
+        self._lock = threading.Lock()
+
+    def _get_semaphore(self, server):
+        'Return the semaphore of the server, create it if needed'
+        with self._lock:
+            if server not in self._semaphores:
+                max_per_server = (self.max_per_server
+                                  or config_pytomo.MAX_DOWNLOADS_PER_SERVER)
+                self._semaphores[server] = threading.BoundedSemaphore(
+                                                        max(1, max_per_server))
+            return self._semaphores[server]
+
+    def slot(self, server):
+        'Return a context manager holding one download slot of the server'
+        return self._get_semaphore(server)
+
+def join_thread(thread):
+    'Wait for the end of the thread without blocking signals'
+    while thread.is_alive():
+        thread.join(JOIN_PERIOD)
+
+def run_workers(function, items, nb_workers):
+    '''Apply function to each item with at most nb_workers threads
+    Return the list of the results (in completion order).
+    The first exception raised by a worker stops the distribution of new items
+    and is raised again once the running calls are finished.
+    >>> sorted(run_workers(lambda x: 2 * x, [1, 2, 3], 2))
+    [2, 4, 6]
+    >>> def check(x):
+    ...     if x == 3:
+    ...         raise ValueError(x)
+    ...     return x
+    >>> run_workers(check, [1, 2, 3], 2)
+    Traceback (most recent call last):
+        ...
+    ValueError: 3
+    '''
+    todo = Queue.Queue()
+    for item in items:
+        todo.put(item)
+    results = []
+    errors = []
+    stop = threading.Event()
+    def worker():
+        'Process items until none is left or an error occured'
+        while not stop.is_set():
+            try:
+                item = todo.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                results.append(function(item))
+            except Exception:
+                errors.append(sys.exc_info())
+                stop.set()
+    threads = [threading.Thread(target=worker, name='CrawlWorker-%d' % index)
+               for index in xrange(max(1, min(nb_workers, todo.qsize())))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for thread in threads:
+            join_thread(thread)
+    except KeyboardInterrupt:
+        # let the running downloads end quietly
+        stop.set()
+        raise
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    return results
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -134,6 +134,8 @@ from __future__ import with_statement, absolute_import, print_function
 import sqlite3
 from pprint import pprint
 import operator
+import threading
+from contextlib import contextmanager
 
 # only for logging
 import logging
@@ -147,6 +149,20 @@ try:
 except ValueError:
     import config_pytomo
 
+# version of the schema of the crawl table, stored as user_version of the
+# database file: see upgrade_schema
+SCHEMA_VERSION = 2
+INDEXED_COLUMNS = ('ID', 'Url', 'IP', 'ASNumber')
+# families of DNS resolvers shown in the reports: a record belongs to each
+# family whose name is part of its (concatenated) Resolver field
+RESOLVER_NAMES = ('open', 'google', 'default')
+# table linking the records to their resolver families
+RESOLVER_TABLE_SUFFIX = '_resolvers'
+CRAWL_TABLES_CONDITION = ("type = 'table' AND name NOT GLOB '*%s'"
+                          % RESOLVER_TABLE_SUFFIX)
+CRAWL_TABLES_QUERY = ' '.join(("SELECT name FROM sqlite_master WHERE",
+                               CRAWL_TABLES_CONDITION))
+
 class PytomoDatabase:
     ''' Pytomo database class
         The columns of the file pytomo_table are as follows:
@@ -156,7 +172,8 @@ class PytomoDatabase:
         Url     - The url of the webpage
         CacheUrl- The Url of the cache server hosting the video
         CacheServerDelay- the delay to obtain the cache server url (from the
-                    initial web page)
+                    initial web page), NULL if the url was reused from the
+                    redirect cache
         IP      - The IP address of the cache server from which the video is
                   downloaded
         Resolver- The DNS resolver used to get obtain the IP address of the
@@ -195,14 +212,26 @@ class PytomoDatabase:
     _table_name = None
     created = None
 
-    def __init__(self, database_file=config_pytomo.DATABASE_TIMESTAMP):
-        '''Initialize the database object'''
+    def __init__(self, database_file=config_pytomo.DATABASE_TIMESTAMP,
+                 wal=None):
+        '''Initialize the database object
+        With wal (default config_pytomo.DB_WAL), the database is switched to
+        the Write-Ahead Log journal mode.
+        '''
+        # records waiting to be inserted in batch mode
+        self._pending = []
+        self._pending_since = None
+        self._batch_depth = 0
+        self._batch_lock = threading.RLock()
         # Intialize the logger for standalone testing Logging
         if not config_pytomo.LOG:
             self.logger_db()
         try:
             # isolation_level in order to auto-commit
-            self.py_conn = sqlite3.connect(database_file, isolation_level=None)
+            # the records of the crawl are inserted by the thread of
+            # lib_result_sinks.DatabaseSink
+            self.py_conn = sqlite3.connect(database_file, isolation_level=None,
+                                           check_same_thread=False)
         except sqlite3.Error, mes:
             config_pytomo.LOG.exception(''.join((
                 'Unable to connect to the database: ', database_file,
@@ -213,6 +242,14 @@ class PytomoDatabase:
                                 "Database:", os.path.basename(database_file))))
         self.created = True
         self.py_cursor = self.py_conn.cursor()
+        if wal is None:
+            wal = config_pytomo.DB_WAL
+        if wal:
+            try:
+                self.py_cursor.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.Error, mes:
+                config_pytomo.LOG.error('Unable to set WAL journal mode: %s',
+                                        mes)
 
     def create_pytomo_table(self, table=config_pytomo.TABLE_TIMESTAMP):
         '''  Function to create a table'''
@@ -262,23 +299,110 @@ class PytomoDatabase:
                                    % (table_name, mes))
         else:
             config_pytomo.LOG.info("Creating table : %s" % table_name)
+        upgrade_schema(self.py_conn, table)
+
+    def _insert_command(self):
+        '''Return the insert statement of the table (the same string is
+        returned so that sqlite reuses the prepared statement)'''
+        if getattr(self, '_insert_table', None) != self._table_name:
+            self._insert_table = self._table_name
+            self._insert_cmd = ''.join(("INSERT INTO ", self._table_name,
+                                        " VALUES(?",
+                                        ',?' * config_pytomo.NB_FIELDS, ')'))
+        return self._insert_cmd
 
     def insert_record(self, row):
-        ''' Function to insert a record'''
+        ''' Function to insert a record
+        In batch mode, the record is only queued.'''
+        self.insert_records([row])
+
+    def insert_records(self, rows):
+        '''Insert the records in a single transaction
+        In batch mode, the records are queued and inserted when
+        config_pytomo.DB_BATCH_SIZE records are pending or the oldest is
+        older than config_pytomo.DB_BATCH_PERIOD seconds.
+        >>> doc_db = PytomoDatabase(':memory:')
+        >>> doc_db.create_pytomo_table('doc_batch_table')
+        >>> row = (None,) * (config_pytomo.NB_FIELDS + 1)
+        >>> with doc_db.batch():
+        ...     doc_db.insert_records([row, row])
+        ...     doc_db.count_rows()
+        0
+        >>> doc_db.count_rows()
+        2
+        '''
         if not self.created:
             config_pytomo.LOG.warn('Database could not be created\n'
                                    'Insertion aborted')
             return
-        cmd = ''.join(("INSERT INTO ", self._table_name,
-                       " VALUES(?",
-                       ',?' * config_pytomo.NB_FIELDS, ')'))
+        with self._batch_lock:
+            if not self._batch_depth:
+                self._execute_inserts(rows)
+                return
+            if not self._pending:
+                self._pending_since = time.time()
+            self._pending.extend(rows)
+            if (len(self._pending) >= config_pytomo.DB_BATCH_SIZE
+                or (time.time() - self._pending_since
+                    >= config_pytomo.DB_BATCH_PERIOD)):
+                self.flush()
+
+    def _execute_inserts(self, rows):
+        '''Insert the rows in one transaction, row by row in case of
+        error to keep the valid ones'''
+        if not rows:
+            return
+        cmd = self._insert_command()
         try:
-            self.py_cursor.execute(cmd, row)
+            self.py_cursor.execute('BEGIN')
+            self.py_cursor.executemany(cmd, rows)
+            self.py_cursor.execute('COMMIT')
         except sqlite3.Error, mes:
-            config_pytomo.LOG.error('unable to add row: %s with error: %s'
-                                    % (row, mes))
+            config_pytomo.LOG.error('unable to add %d rows with error: %s'
+                                    % (len(rows), mes))
+            try:
+                self.py_cursor.execute('ROLLBACK')
+            except sqlite3.Error:
+                # no transaction started
+                pass
+            for row in rows:
+                try:
+                    self.py_cursor.execute(cmd, row)
+                except sqlite3.Error, mes:
+                    config_pytomo.LOG.error('unable to add row: %s with '
+                                            'error: %s' % (row, mes))
         else:
-            config_pytomo.LOG.debug('row added to table')
+            config_pytomo.LOG.debug('%d rows added to table', len(rows))
+
+    def flush(self):
+        'Insert the pending records of the batch mode'
+        with self._batch_lock:
+            pending = self._pending
+            self._pending = []
+            self._pending_since = None
+            if self.created:
+                self._execute_inserts(pending)
+
+    def start_batch(self):
+        'Queue the records until the end of the batch (nested batches allowed)'
+        with self._batch_lock:
+            self._batch_depth += 1
+
+    def end_batch(self):
+        'Insert the pending records when the outer batch ends'
+        with self._batch_lock:
+            self._batch_depth = max(0, self._batch_depth - 1)
+            if not self._batch_depth:
+                self.flush()
+
+    @contextmanager
+    def batch(self):
+        'Context manager queuing the records inserted within'
+        self.start_batch()
+        try:
+            yield self
+        finally:
+            self.end_batch()
 
     def fetch_all(self):
         ''' Function to print all the records of the table'''
@@ -287,7 +411,7 @@ class PytomoDatabase:
                                    'Fetch aborted')
             return
         if not self._table_name:
-            cmd = "select name from sqlite_master"
+            cmd = CRAWL_TABLES_QUERY
             self.py_cursor.execute(cmd)
             table = self.py_cursor.fetchall()
             if len(table) == 1:
@@ -307,14 +431,15 @@ class PytomoDatabase:
                                    'Fetch aborted')
             return
         if not self._table_name:
-            cmd = "SELECT name FROM sqlite_master"
+            cmd = CRAWL_TABLES_QUERY
             self.py_cursor.execute(cmd)
             table = self.py_cursor.fetchall()
             if len(table) == 1:
                 self._table_name = table[0][0]
             else:
                 print("No tables found in database")
-        cmd = "SELECT sql FROM sqlite_master WHERE type = 'table'"
+        cmd = ' '.join(("SELECT sql FROM sqlite_master WHERE",
+                        CRAWL_TABLES_CONDITION))
         self.py_cursor.execute(cmd)
         for record in self.py_cursor:
             pprint(record)
@@ -328,7 +453,7 @@ class PytomoDatabase:
                                    'Fetch aborted')
             return -1
         if not self._table_name:
-            cmd = "SELECT name FROM sqlite_master"
+            cmd = CRAWL_TABLES_QUERY
             self.py_cursor.execute(cmd)
             table = self.py_cursor.fetchall()
             if len(table) == 1:
@@ -349,7 +474,7 @@ class PytomoDatabase:
                                    'Fetch aborted')
             return
         if not self._table_name:
-            cmd = "select name from sqlite_master"
+            cmd = CRAWL_TABLES_QUERY
             self.py_cursor.execute(cmd)
             table = self.py_cursor.fetchall()
             if len(table) == 1:
@@ -362,6 +487,27 @@ class PytomoDatabase:
         self.py_cursor.execute(cmd)
         return sorted(self.py_cursor.fetchall(), key=operator.itemgetter(0))
 
+    def fetch_crawled_urls(self):
+        '''Return the list of (url, nb of records) for the records with stats
+        '''
+        if not self.created:
+            config_pytomo.LOG.warn('Database could not be created\n'
+                                   'Fetch aborted')
+            return []
+        if not self._table_name:
+            cmd = CRAWL_TABLES_QUERY
+            self.py_cursor.execute(cmd)
+            table = self.py_cursor.fetchall()
+            if len(table) == 1:
+                self._table_name = table[0][0]
+            else:
+                print("No tables found in database")
+                return []
+        cmd = ' '.join(('SELECT Url, COUNT(*) FROM', self._table_name,
+                        'WHERE DownloadTime > 0 GROUP BY Url'))
+        self.py_cursor.execute(cmd)
+        return self.py_cursor.fetchall()
+
     def fetch_single_parameter(self, parameter):
         '''Function to save (timestamp,parameter) in a sorted list of tuples'''
         if not self.created:
@@ -369,7 +515,7 @@ class PytomoDatabase:
                                    'Fetch aborted')
             return
         if not self._table_name:
-            cmd = "select name from sqlite_master"
+            cmd = CRAWL_TABLES_QUERY
             self.py_cursor.execute(cmd)
             table = self.py_cursor.fetchall()
             if len(table) == 1:
@@ -385,12 +531,25 @@ class PytomoDatabase:
     def fetch_all_parameters(self, parameters):
         '''Function to save (parameter_1, ..., parameter_n, timestamp) in a
         sorted list of tuples dependent on timestamp'''
+        fetched = self.fetch_new_parameters(parameters)
+        if fetched is None:
+            return
+        return fetched[0]
+
+    def fetch_new_parameters(self, parameters, since_rowid=None):
+        '''Return the (parameter_1, ..., parameter_n, timestamp) of the
+        records inserted after the since_rowid (all the records if None),
+        sorted on timestamp, and the rowid of the last record inserted
+        (since_rowid if there is none)
+        The records are selected in insertion order: with several crawl
+        workers, a record can be inserted after a record with a later
+        timestamp (ID).'''
         if not self.created:
             config_pytomo.LOG.warn('Database could not be created\n'
                                    'Fetch aborted')
             return
         if not self._table_name:
-            cmd = "select name from sqlite_master"
+            cmd = CRAWL_TABLES_QUERY
             self.py_cursor.execute(cmd)
             table = self.py_cursor.fetchall()
             if len(table) == 1:
@@ -399,16 +558,23 @@ class PytomoDatabase:
                 print("No tables found in database")
                 return
         # create the command to extract all the specified parameters
-        # timestamp is the last element of each tuple
+        # timestamp is the last element of each tuple, once the rowid removed
         join_parameters = ', '.join(parameters)
-        cmd = ' '.join(("SELECT %s, ID FROM" % join_parameters,
+        cmd = ' '.join(("SELECT %s, ID, rowid FROM" % join_parameters,
                         self._table_name))
+        args = ()
+        if since_rowid is not None:
+            cmd = ' '.join((cmd, "WHERE rowid > ?"))
+            args = (since_rowid,)
         config_pytomo.LOG.debug('Select command: %s' % cmd)
-        self.py_cursor.execute(cmd)
+        self.py_cursor.execute(cmd, args)
         all_parameters = self.py_cursor.fetchall()
         #config_pytomo.LOG.debug('Extracted: %s' %
         #        str(all_parameters))
-        return sorted(all_parameters, key=operator.itemgetter(-1))
+        last_rowid = max([since_rowid] + [row[-1] for row in all_parameters])
+        return (sorted([row[:-1] for row in all_parameters],
+                       key=operator.itemgetter(-1)),
+                last_rowid)
 
     def fetch_start_time(self):
         '''Function to return the first timestamp in the database in linux
@@ -419,7 +585,7 @@ class PytomoDatabase:
                                    'Fetch aborted')
             return
         if not self._table_name:
-            cmd = "select name from sqlite_master"
+            cmd = CRAWL_TABLES_QUERY
             self.py_cursor.execute(cmd)
             table = self.py_cursor.fetchall()
             if len(table) == 1:
@@ -441,6 +607,7 @@ class PytomoDatabase:
             config_pytomo.LOG.warn('Database could not be created\n'
                                    'Close aborted')
             return
+        self.flush()
         self.py_conn.close()
 
     @staticmethod
@@ -468,6 +635,205 @@ class PytomoDatabase:
         handler.setFormatter(log_formatter)
         config_pytomo.LOG.addHandler(handler)
 
+class CrawledUrls(object):
+    '''Index of the urls already crawled
+    Holds the same information as fetch_single_parameter_with_stats('Url'):
+    the urls with download stats and the number of such records, so that the
+    crawl does not query the whole table for each video.
+    The index is only updated under the lock of the result pipeline.
+    >>> crawled_urls = CrawledUrls()
+    >>> stats = [None] * config_pytomo.NB_FIELDS
+    >>> stats[config_pytomo.URL_IDX] = 'http://youtu.be/a'
+    >>> stats[config_pytomo.DOWNLOAD_TIME_IDX] = 2.5
+    >>> crawled_urls.add_rows([stats, stats])
+    >>> stats[config_pytomo.DOWNLOAD_TIME_IDX] = None
+    >>> stats[config_pytomo.URL_IDX] = 'http://youtu.be/b'
+    >>> crawled_urls.add_rows([stats])
+    >>> len(crawled_urls), 'http://youtu.be/a' in crawled_urls
+    (2, True)
+    >>> 'http://youtu.be/b' in crawled_urls
+    False
+    '''
+
+    def __init__(self):
+        self.urls = set()
+        self.count = 0
+
+    def seed(self, data_base):
+        'Reset the index with the urls stored in the database'
+        self.urls = set()
+        self.count = 0
+        if not data_base:
+            return
+        try:
+            crawled = data_base.fetch_crawled_urls()
+        except sqlite3.Error, mes:
+            config_pytomo.LOG.error('Unable to extract crawled urls: %s', mes)
+            return
+        for url, nb_records in crawled:
+            self.urls.add(url)
+            self.count += nb_records
+        config_pytomo.LOG.debug('Loaded %d crawled urls', self.count)
+
+    def add_rows(self, rows):
+        'Update the index with the formatted stats rows'
+        for row in rows:
+            if row[config_pytomo.DOWNLOAD_TIME_IDX] > 0:
+                self.urls.add(row[config_pytomo.URL_IDX])
+                self.count += 1
+
+    def __contains__(self, url):
+        return url in self.urls
+
+    def __len__(self):
+        return self.count
+
+def crawl_table_name(cursor, first=False):
+    '''Return the name of the crawl table of the database, None if there is
+    not exactly one (the first one if first is set and there are several)'''
+    cursor.execute(CRAWL_TABLES_QUERY)
+    tables = cursor.fetchall()
+    if len(tables) == 1 or (first and tables):
+        return tables[0][0]
+    return None
+
+def schema_version(cursor):
+    'Return the version of the schema of the database'
+    return cursor.execute('PRAGMA user_version').fetchone()[0]
+
+def table_upgraded(cursor, table):
+    '''Return True if the resolver table and trigger of the crawl table
+    exist (the schema version is the one of the file, not of each table)'''
+    names = (''.join((table, RESOLVER_TABLE_SUFFIX)),
+             '%s_split_resolver' % table)
+    return cursor.execute('SELECT COUNT(*) FROM sqlite_master WHERE name IN '
+                          '(?, ?)', names).fetchone()[0] == len(names)
+
+def table_columns(cursor, table):
+    'Return the set of the column names of the table'
+    return set(column[1] for column
+               in cursor.execute('PRAGMA table_info(%s)' % table).fetchall())
+
+def _add_indexes(cursor, table):
+    'Version 1: index the columns used to select the records'
+    columns = table_columns(cursor, table)
+    for column in INDEXED_COLUMNS:
+        # very old tables do not have all the columns
+        if column in columns:
+            cursor.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s(%s)'
+                           % (table, column, table, column))
+
+def _split_resolvers(cursor, table):
+    '''Version 2: store the resolver families of each record in a separate
+    table, filled by a trigger for the new records'''
+    resolver_table = ''.join((table, RESOLVER_TABLE_SUFFIX))
+    cursor.execute('CREATE TABLE IF NOT EXISTS %s (RecordId INTEGER, '
+                   'Resolver text)' % resolver_table)
+    cursor.execute('CREATE INDEX IF NOT EXISTS %s_Resolver ON %s(Resolver, '
+                   'RecordId)' % (resolver_table, resolver_table))
+    names = ' UNION ALL '.join("SELECT '%s' AS Name" % name
+                               for name in RESOLVER_NAMES)
+    cursor.execute(' '.join(('CREATE TRIGGER IF NOT EXISTS',
+                             '%s_split_resolver' % table,
+                             'AFTER INSERT ON', table,
+                             'BEGIN INSERT INTO', resolver_table,
+                             'SELECT new.rowid, Name FROM (', names, ')',
+                             "WHERE new.Resolver LIKE '%' || Name || '%';",
+                             'END')))
+    cursor.execute(' '.join(('INSERT INTO', resolver_table,
+                             'SELECT', '.'.join((table, 'rowid')),
+                             ', Name FROM', table,
+                             ', (', names, ')',
+                             "WHERE Resolver LIKE '%' || Name || '%'")))
+
+# (version, function upgrading the table to this version)
+MIGRATIONS = ((1, _add_indexes),
+              (2, _split_resolvers))
+
+def upgrade_schema(connection, table):
+    '''Upgrade in place the crawl table to SCHEMA_VERSION
+    Each migration is applied once, all in one transaction.
+    Return True if the schema is up to date.
+    >>> connection = sqlite3.connect(':memory:')
+    >>> _ = connection.execute('CREATE TABLE old_table (ID TIMESTAMP, '
+    ...                        'Url text, IP text, Resolver text)')
+    >>> _ = connection.execute("INSERT INTO old_table VALUES "
+    ...                        "(NULL, 'url', 'ip', '_default_open_dns')")
+    >>> upgrade_schema(connection, 'old_table')
+    True
+    >>> cursor = connection.cursor()
+    >>> schema_version(cursor) == SCHEMA_VERSION
+    True
+    >>> crawl_table_name(cursor)
+    u'old_table'
+    >>> sorted(cursor.execute('SELECT * FROM old_table_resolvers'))
+    [(1, u'default'), (1, u'open')]
+    >>> _ = connection.execute("INSERT INTO old_table VALUES "
+    ...                        "(NULL, 'url', 'ip', '_google_public_dns')")
+    >>> cursor.execute(' '.join(('SELECT COUNT(*) FROM old_table WHERE',
+    ...                 resolver_condition(cursor, 'old_table', 'google')))
+    ...               ).fetchone()
+    (1,)
+
+    A second crawl table of an upgraded file is upgraded too:
+    >>> _ = connection.execute('CREATE TABLE new_table (ID TIMESTAMP, '
+    ...                        'Url text, IP text, Resolver text)')
+    >>> upgrade_schema(connection, 'new_table'), table_upgraded(cursor,
+    ...                                                         'new_table')
+    (True, True)
+    >>> upgrade_schema(connection, None)
+    False
+    '''
+    if not table:
+        return False
+    cursor = connection.cursor()
+    version = schema_version(cursor)
+    if table_upgraded(cursor, table):
+        if version >= SCHEMA_VERSION:
+            return True
+    elif version >= SCHEMA_VERSION:
+        # table created after the upgrade of the file
+        version = 0
+    isolation_level = connection.isolation_level
+    # the transaction is handled here (the sqlite3 module would commit
+    # before each CREATE statement)
+    connection.isolation_level = None
+    try:
+        cursor.execute('BEGIN')
+        for migration_version, migration in MIGRATIONS:
+            if version < migration_version:
+                migration(cursor, table)
+        cursor.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        cursor.execute('COMMIT')
+    except Exception, mes:
+        config_pytomo.LOG.error('Unable to upgrade table %s from version %d:'
+                                ' %s', table, version, mes)
+        try:
+            cursor.execute('ROLLBACK')
+        except sqlite3.Error:
+            # no transaction started
+            pass
+        return False
+    finally:
+        connection.isolation_level = isolation_level
+    config_pytomo.LOG.info('Upgraded table %s from version %d to %d',
+                           table, version, SCHEMA_VERSION)
+    return True
+
+def resolver_condition(cursor, table, resolver):
+    '''Return the SQL condition selecting the records of the table obtained
+    with the resolver family
+    The index on the resolver table is used when the table is upgraded.
+    >>> cursor = sqlite3.connect(':memory:').cursor()
+    >>> resolver_condition(cursor, 'old_table', 'open')
+    "Resolver LIKE '%open%'"
+    '''
+    if resolver in RESOLVER_NAMES and table_upgraded(cursor, table):
+        return ''.join(("rowid IN (SELECT RecordId FROM ", table,
+                        RESOLVER_TABLE_SUFFIX, " WHERE Resolver = '",
+                        resolver, "')"))
+    return ''.join(("Resolver LIKE '%", resolver, "%'"))
+
 # TODO
 def time_to_epoch(timestamp):
     ''' Function to transform to seconds from epoch time represented by a
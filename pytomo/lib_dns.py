@@ -19,6 +19,7 @@
 from __future__ import with_statement, absolute_import
 
 from urlparse import urlsplit
+from operator import itemgetter
 import sys
 import time
 
@@ -26,6 +27,10 @@ from .dns import resolver as dns_resolver
 from .dns import exception as dns_exception
 
 from . import config_pytomo
+from . import lib_crawl_pool
+
+# answer of a server which did not respond in time
+TIMEOUT = 'timeout'
 
 def get_default_name_servers():
     """Return a list of IP addresses of default name servers
@@ -55,61 +60,77 @@ def reduce_addresses(data):
             req_times[ip_address] = req_duration
     return [(ip, result[ip], req_times[ip]) for ip in result]
 
+def resolve(hostname, name, server):
+    '''Return a tuple (address, resolver, resolution time) of the hostname
+    resolved by the server, the TIMEOUT string in case of timeout, None in
+    case of error'''
+    config_pytomo.LOG.debug("DNS resolution using %s on this address %s"
+                            % (name, server))
+    # one resolver per server as the queries are run in parallel
+    resolver = dns_resolver.Resolver()
+    #Set the lifetime of the DNS query. The default is 30 seconds.
+    if config_pytomo.DNS_TIMEOUT:
+        resolver.lifetime = config_pytomo.DNS_TIMEOUT
+    resolver.nameservers = [server]
+    start_resol_time = time.time()
+    try:
+        rdatas = resolver.query(hostname)
+        end_resol_time = time.time()
+    except dns_resolver.Timeout:
+        config_pytomo.LOG.info("DNS timeout for %s" % name)
+        return TIMEOUT
+    except dns_exception.DNSException, mes:
+        config_pytomo.LOG.exception('Uncaught DNS Exception: %s' % mes)
+        return None
+    except Exception, mes:
+        config_pytomo.LOG.exception('Uncaught non-DNS Exception: %s' % mes)
+        return None
+    if not rdatas:
+        return None
+    try:
+        address = rdatas[0].address
+    except AttributeError, mes:
+        config_pytomo.LOG.error('DNS failed: %s' % mes)
+        return None
+    config_pytomo.LOG.debug("URL %s resolved as: %s" % (hostname, address))
+    return (address, '_'.join((name, server)),
+            end_resol_time - start_resol_time)
+
 def get_ip_addresses(url):
     """
     Return a list of tuples with the IP address and the resolver used
+    The name servers are queried in parallel: each resolution time is measured
+    independently and the call lasts at most DNS_TIMEOUT.
     """
     if not url.startswith('http://'):
         url = 'http://'.join(('', url))
     hostname = urlsplit(url).netloc
-    results = []
     # Set the DNS Server
-    resolver = dns_resolver.Resolver()
-    #Set the lifetime of the DNS query. The default is 30 seconds.
-    if config_pytomo.DNS_TIMEOUT:
-        resolver.lifetime = config_pytomo.DNS_TIMEOUT
     default_resolver = ('%s_default' % config_pytomo.PROVIDER,
                         get_default_name_servers())
     dns_servers = ([default_resolver] +
                   config_pytomo.EXTRA_NAME_SERVERS_CC)
-    for (name, server) in dns_servers:
-        config_pytomo.LOG.debug("DNS resolution using %s on this address %s"
-                                % (name, server))
-        start_resol_time = time.time()
-        resolver.nameservers = [server]
-        try:
-            rdatas = resolver.query(hostname)
-            end_resol_time = time.time()
-        except dns_resolver.Timeout:
-            config_pytomo.LOG.info("DNS timeout for %s" % name)
-            rdatas = None
-            # If we get a timeout then we ignore the DNS server for the rest of
-            # the current round.
-            for i, (lname, _) in enumerate(
-                                config_pytomo.EXTRA_NAME_SERVERS_CC):
-                if lname == name:
-                    del config_pytomo.EXTRA_NAME_SERVERS_CC[i]
-                    config_pytomo.LOG.info("Ignoring %s for current round of "
-                                           "crawl" %name)
-            continue
-        except dns_exception.DNSException, mes:
-            config_pytomo.LOG.exception('Uncaught DNS Exception: %s' % mes)
-            rdatas = None
-            continue
-        except Exception, mes:
-            config_pytomo.LOG.exception('Uncaught non-DNS Exception: %s' % mes)
-            rdatas = None
-            continue
-        if rdatas:
-            try:
-                address = rdatas[0].address
-            except AttributeError, mes:
-                config_pytomo.LOG.error('DNS failed: %s' % mes)
-                continue
-            config_pytomo.LOG.debug("URL %s resolved as: %s"
-                                    % (hostname, address))
-            results.append((address, '_'.join((name, server)),
-                            end_resol_time - start_resol_time))
+    def resolve_server((index, (name, server))):
+        'Return the answer of the server with its index and name'
+        return index, name, resolve(hostname, name, server)
+    answers = lib_crawl_pool.run_workers(resolve_server, enumerate(dns_servers),
+                                         len(dns_servers))
+    # keep the order of the servers for the resolver names
+    answers.sort()
+    timeouts = set(name for (_, name, answer) in answers if answer == TIMEOUT)
+    # If we get a timeout then we ignore the DNS server for the rest of
+    # the current round.
+    # the list is rebuilt (not modified in place) as it may be read by
+    # other crawl workers
+    if timeouts.intersection(map(itemgetter(0),
+                                 config_pytomo.EXTRA_NAME_SERVERS_CC)):
+        config_pytomo.EXTRA_NAME_SERVERS_CC = [
+            (lname, lserver) for (lname, lserver)
+            in config_pytomo.EXTRA_NAME_SERVERS_CC if lname not in timeouts]
+        config_pytomo.LOG.info("Ignoring %s for current round of crawl"
+                               % ', '.join(sorted(timeouts)))
+    results = [answer for (_, _, answer) in answers
+               if answer and answer != TIMEOUT]
     return reduce_addresses(results)
 
 if __name__ == '__main__':
@@ -10,25 +10,24 @@ calculate the data downloaded within that time
 """
 
 from __future__ import with_statement, absolute_import
+import errno
 import httplib
 import math
 import socket
 import sys
 import time
 import urllib2
-import tempfile
 import os
 from urlparse import urlsplit
 #import cookielib
 
-from . import kaa_metadata
-from .kaa_metadata.core import ParseError
-
 #from .flvlib.scripts import debug_flv
 from .flvlib import tags
 
 from . import config_pytomo
 from . import lib_links_extractor
+from . import lib_header_sniffer
+from .lib_timing import TIMINGS, monotonic
 
 # video download is a FSM with the following states
 INITIAL_BUFFERING_STATE = 0
@@ -64,19 +63,163 @@ class ContentTooShortError(Exception):
     """
     pass
 
-def get_video_type(meta_file_name):
-    "Determine the video type"
-    video_type = None
+class DownloadBuffer(object):
+    """In memory file-like object holding the downloaded data to be parsed.
+
+    The data is appended by write without moving the read position, and the
+    data before the read position is dropped at each write: only the part
+    not yet parsed (the current flv tag) is kept in memory.
+
+    >>> buf = DownloadBuffer()
+    >>> buf.write('FLV\\x01')
+    >>> buf.read(3)
+    'FLV'
+    >>> buf.tell()
+    3
+    >>> buf.read(3)
+    '\\x01'
+    >>> buf.seek(3)
+    >>> buf.write('\\x05abc')
+    >>> buf.read(2), len(buf)
+    ('\\x01\\x05', 5)
+    >>> buf.seek(0)
+    Traceback (most recent call last):
+        ...
+    IOError: data before offset 3 has been dropped
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # stream offset of self._buffer[0]
+        self._offset = 0
+        self._position = 0
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def write(self, data_block):
+        """Append the data block, keep the read position"""
+        drop = min(self._position - self._offset, len(self._buffer))
+        if drop > 0:
+            del self._buffer[:drop]
+            self._offset += drop
+        self._buffer.extend(data_block)
+
+    def read(self, size=-1):
+        """Read at most size bytes from the read position"""
+        start = self._position - self._offset
+        if size < 0:
+            end = len(self._buffer)
+        else:
+            end = start + size
+        data = memoryview(self._buffer)[start:end].tobytes()
+        self._position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Move the read position (may be set after the end of data)"""
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._offset + len(self._buffer)
+        if offset < self._offset:
+            raise IOError('data before offset %d has been dropped'
+                          % self._offset)
+        self._position = offset
+
+    def tell(self):
+        """Return the read position"""
+        return self._position
+
+    def close(self):
+        """Free the memory"""
+        self._buffer = bytearray()
+
+def raw_response(data):
+    """Return the httplib.HTTPResponse of the urllib2 response if its body
+    can be received directly from the socket: not chunked and not buffered
+    by the urllib2 file object. Return None otherwise.
+    >>> import StringIO
+    >>> raw_response(StringIO.StringIO('data'))
+    """
     try:
-        with open(meta_file_name) as meta_file:
-            info = kaa_metadata.parse(meta_file)
-        video_type = str(info.mime.split('/')[1])
-    except ParseError, mes:
-        config_pytomo.LOG.debug('Video type could not be determined: %s'
-                               % mes)
+        response = data.fp._sock
+        sock = response.fp._sock
+        buffered = data.fp._rbuf.getvalue()
     except AttributeError:
-        config_pytomo.LOG.debug('mime not found')
-    return video_type
+        return None
+    if (not isinstance(response, httplib.HTTPResponse) or response.chunked
+        or buffered or not hasattr(sock, 'recv_into')):
+        return None
+    return response
+
+class BlockReader(object):
+    """Reader of the body of an urllib2 response in a reused buffer
+
+    The body is received with recv_into directly from the socket when
+    possible (see raw_response), once the bytes read by httplib with the
+    headers are consumed; its length is then tracked here. Otherwise it is
+    read from the response and copied in the buffer.
+    Each block is a memoryview of the buffer: it is valid until the next
+    read.
+
+    >>> import StringIO
+    >>> reader = BlockReader(StringIO.StringIO('FLV\\x01\\x05'),
+    ...                      buffer_size=3)
+    >>> reader.read_block().tobytes(), reader.read_block().tobytes()
+    ('FLV', '\\x01\\x05')
+    >>> len(reader.read_block())
+    0
+    """
+
+    def __init__(self, data, buffer_size=None):
+        self.buffer = bytearray(buffer_size
+                                or config_pytomo.DOWNLOAD_BUFFER_SIZE)
+        self._view = memoryview(self.buffer)
+        # file the blocks are read from until recv_into can be used
+        self._file = data
+        self._recv_into = None
+        # nb of bytes to read from self._file before using recv_into
+        self._buffered = 0
+        # nb of bytes of the body not received yet (None if unknown)
+        self.remaining = None
+        response = raw_response(data)
+        if response is not None:
+            self._file = response
+            self._recv_into = response.fp._sock.recv_into
+            self._buffered = len(response.fp._rbuf.getvalue())
+            self.remaining = response.length
+
+    def read_block(self):
+        """Return the next bytes of the body (empty at the end)"""
+        size = len(self.buffer)
+        if self._buffered:
+            # httplib keeps the length of the body up to date
+            data_block = self._file.read(min(size, self._buffered))
+            nb_bytes = len(data_block)
+            self.buffer[:nb_bytes] = data_block
+            self._buffered = self._buffered - nb_bytes if nb_bytes else 0
+            self.remaining = self._file.length
+            return self._view[:nb_bytes]
+        if not self._recv_into:
+            data_block = self._file.read(size)
+            nb_bytes = len(data_block)
+            self.buffer[:nb_bytes] = data_block
+            return self._view[:nb_bytes]
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+            if size <= 0:
+                return self._view[:0]
+        while True:
+            try:
+                nb_bytes = self._recv_into(self.buffer, size)
+                break
+            except socket.error, mes:
+                if mes.args[0] != errno.EINTR:
+                    raise
+        if self.remaining is not None:
+            self.remaining -= nb_bytes
+        return self._view[:nb_bytes]
 
 class FileDownloader(object):
     """File Downloader class.
@@ -173,6 +316,11 @@ class FileDownloader(object):
         self.flv_timestamp = None
         self.previous_timestamp = None
         self.time_to_get_first_byte = None
+        self._total_bytes = 0
+        # time spent parsing the data during the transfer
+        self.parse_time = 0
+        # fed with each data block to find the video duration
+        self.header_sniffer = lib_header_sniffer.HeaderSniffer()
         try:
             self.download_time = int(download_time)
         except ValueError:
@@ -555,23 +703,26 @@ template')
             pass
         return True
 
-    def compute_encoding_rate(self, meta_file_name):
+    def update_data_duration(self, data_block):
+        """Feed the data block to the header sniffer and set the data duration
+        as soon as it is found in the video headers
+        """
+        if not self.data_duration and not self.header_sniffer.done:
+            self.data_duration = self.header_sniffer.feed(data_block)
+            if self.header_sniffer.done and not self.data_duration:
+                config_pytomo.LOG.info('no data duration in %s headers'
+                                       % self.header_sniffer.container)
+        return self.data_duration
+
+    def compute_encoding_rate(self):
         """Compute the encoding rate
-        if found in the temp file, close the file and set the value in the
-        object
+        if the data duration has been found, set the value in the object
         """
-        try:
-            data_duration = get_data_duration(meta_file_name)
-        except ParseError, mes:
-            config_pytomo.LOG.debug('data duration not yet found: %s'
-                                   % mes)
-            data_duration = None
-        if data_duration:
-            self.data_duration = data_duration
+        if self.data_duration and self.data_len:
             # AO 20121030 encoding rate should be in kbps
             # (as in metadata of flv)
             # data len in Bytes
-            self.encoding_rate = 8 * self.data_len / data_duration / 1000
+            self.encoding_rate = 8 * self.data_len / self.data_duration / 1000
             config_pytomo.LOG.debug("Encoding rate is: %.2fkb/s"
                                     % self.encoding_rate)
 
@@ -583,8 +734,9 @@ template')
         config_pytomo.LOG.debug('Downloading url: %s, on this ip: %s'
                                 % (url, ip_address))
         #status_code = None
-        connection_time = time.time()
-        status_code, data = self.establish_connection(url, ip_address)
+        connection_time = monotonic()
+        with TIMINGS.span('connect'):
+            status_code, data = self.establish_connection(url, ip_address)
         if not data:
             config_pytomo.LOG.error('could not establish connection to url: %s'
                                     % url)
@@ -596,37 +748,33 @@ template')
             self.redirect_url = data.geturl()
             return status_code, None
         duration = None
-        with tempfile.NamedTemporaryFile() as meta_file:
-            # just to get a temporary file name in the current dir
-            # cannot use the file stream directly because it is not permitted
-            # to open a temporary file already open
-            # and the delete parameter available in 2.7 only
-            meta_file_name = meta_file.name
+        # the body is received in the same buffer by the flv attempt and the
+        # other formats
+        reader = BlockReader(data)
+        transfer_start = monotonic()
+        # the data is parsed in memory: nothing is written on disk
+        meta_file = DownloadBuffer()
         try:
-            duration = self.process_download_flv(data, meta_file_name,
-                                                 connection_time)
+            duration = self.process_download_flv(data, meta_file,
+                                                 connection_time, reader)
             self.video_type = 'FLV'
         except tags.MalformedFLV:
             config_pytomo.LOG.info('Not FLV')
+        finally:
+            meta_file.close()
         if not self.video_type:
-            self.video_type = get_video_type(meta_file_name)
             try:
-                duration = self.process_download_other(data, meta_file_name,
-                                                       connection_time)
+                duration = self.process_download_other(data, connection_time,
+                                                       reader)
             except OSError, mes:
                 config_pytomo.LOG.exception(mes)
+            self.video_type = self.header_sniffer.video_type
         #self.set_total_bytes(byte_counter)
+        # the parsing time is not counted in the transfer
+        TIMINGS.add('metadata', self.parse_time)
+        TIMINGS.add('download',
+                    monotonic() - transfer_start - self.parse_time)
         config_pytomo.LOG.info("nb of interruptions: %d" % self.interruptions)
-        # Delete the file once download analysis is completed
-        # AO 15112012 should try/catch because statistics are retrieved even if
-        # temporary file cannot be deleted (moved from download functions)
-        # check problems if file is already closed
-        meta_file.close()
-        try:
-            os.remove(meta_file_name)
-        except OSError, mes:
-            config_pytomo.LOG.exception('Could not remove temporary file %s\n%s'
-                                        % (meta_file_name, mes))
         return status_code, duration
 
     def update_without_tags(self):
@@ -757,7 +905,8 @@ template')
                 break
             if (not self.encoding_rate
                 and tries <= config_pytomo.MAX_NB_TRIES_ENCODING):
-                self.compute_encoding_rate(meta_file_name)
+                self.update_data_duration(data_block)
+                self.compute_encoding_rate()
                 tries += 1
             data_block_len = len(data_block)
             if data_block_len == 0:
@@ -810,51 +959,47 @@ template')
         self.initial_rate = initial_rate
         return after - start
 
-    def process_download_other(self, data, meta_file_name, connection_time):
-        """Take care of downloading part  for non flv files"""
-        block_size = 1024
+    def process_download_other(self, data, connection_time, reader=None):
+        """Take care of downloading part  for non flv files
+        The data is only given to the header sniffer: it is not stored.
+        The bytes already read by the reader (flv attempt) are counted.
+        """
+        if not reader:
+            reader = BlockReader(data)
         # content-length in bytes
         self.data_len = float(data.info().get('Content-length', None))
         config_pytomo.LOG.debug('Content-length: %s' % self.data_len)
-        meta_file = open(meta_file_name, 'ab+')
-        tries = 0
-        self._total_bytes = 0
         self.state = INITIAL_BUFFERING_STATE
-        start = time.time()
+        start = before = after = monotonic()
         while True:
-            # Download and write
-            before = time.time()
             if (before - start) > self.download_time:
                 config_pytomo.LOG.debug('\nDownloaded %i seconds from video'
                                         'stopping' % (before - start))
                 break
             # read in bytes
-            data_block = data.read(block_size)
+            data_block = reader.read_block()
+            after = monotonic()
             if not self.time_to_get_first_byte:
-                first_byte_time = time.time()
-                self.time_to_get_first_byte = first_byte_time - connection_time
-            if (not self.encoding_rate
-                and tries <= config_pytomo.MAX_NB_TRIES_ENCODING):
-                self.compute_encoding_rate(meta_file_name)
-                tries += 1
-            write_no_seek(meta_file, data_block)
+                self.time_to_get_first_byte = after - connection_time
             data_block_len = len(data_block)
             #config_pytomo.LOG.debug('\ndata_block_len=%s' % data_block_len)
             if data_block_len == 0:
                 config_pytomo.LOG.debug('\nDowloaded complete video')
                 break
+            if not self.header_sniffer.done:
+                # only the blocks of the headers are copied
+                read_time = after
+                self.update_data_duration(data_block.tobytes())
+                after = monotonic()
+                self.parse_time += after - read_time
+            if not self.encoding_rate:
+                self.compute_encoding_rate()
             self._total_bytes += data_block_len
             self.update_without_tags()
-            after = time.time()
-            if not self.data_duration:
-                try:
-                    self.data_duration = get_data_duration(meta_file_name)
-                except ParseError, mes:
-                    config_pytomo.LOG.info('no data duration: %s' % mes)
             self.current_time = after - start
             time_difference = after - before
+            before = after
             self.update_state(time_difference)
-            block_size = self.best_block_size(time_difference, data_block_len)
             instant_thp = (8e-3 * data_block_len / (time_difference)
                            if (time_difference) != 0 else None)
             #config_pytomo.LOG.debug('max_instant_thp=%skb/s; instant_thp=%skb/s'
@@ -867,9 +1012,9 @@ template')
                     'percent_str': self.calc_percent(self._total_bytes,
                                                      self.data_len),
                     'data_len_str': self.format_bytes(self.data_len),
-                    'eta_str': self.calc_eta(start, time.time(), self.data_len,
+                    'eta_str': self.calc_eta(start, after, self.data_len,
                                              self._total_bytes),
-                    'speed_str': self.calc_speed(start, time.time(),
+                    'speed_str': self.calc_speed(start, after,
                                                  self._total_bytes),
                     # in order to avoid None convertion to float in
                     # report_progress and still have information
@@ -880,58 +1025,54 @@ template')
                 self.report_progress(progress_stats)
         return after - start
 
-    def process_download_flv(self, data, meta_file_name, connection_time):
+    def process_download_flv(self, data, meta_file, connection_time,
+                             reader=None):
         """Take care of downloading part
+        The data is written in meta_file (a DownloadBuffer) to parse the flv
+        tags.
         """
+        if not reader:
+            reader = BlockReader(data)
         # content-length in bytes
         self.data_len = float(data.info().get('Content-length', None))
         config_pytomo.LOG.debug('Content-length: %s' % self.data_len)
-        #meta_file = open(meta_file_name, 'ab')
-        meta_file = open(meta_file_name, 'ab+')
         flv_tags = tags.FLV(meta_file)
         self._total_bytes = 0
         #nb_zero_data = 0
         self.state = INITIAL_BUFFERING_STATE
-        #block_size = 1024
-        block_size = 1
-        start = time.time()
+        start = before = after = monotonic()
         config_pytomo.LOG.debug('start time: %s' % start)
         while True:
-            # Download and write
-            before = time.time()
             if (before - start) > self.download_time:
                 config_pytomo.LOG.debug('Downloaded video during %i seconds, '
                                         'stopping' % (before - start))
                 break
             # read in bytes
-            data_block = data.read(block_size)
+            data_block = reader.read_block()
+            read_time = monotonic()
             if not self.time_to_get_first_byte:
-                first_byte_time = time.time()
-                self.time_to_get_first_byte = first_byte_time - connection_time
-                block_size = 1024
+                self.time_to_get_first_byte = read_time - connection_time
             data_block_len = len(data_block)
             if data_block_len == 0:
                 config_pytomo.LOG.debug('\nFinished downloading video')
                 break
-            write_no_seek(meta_file, data_block)
+            meta_file.write(data_block)
+            # before parsing the tags: the data is kept by the sniffer in case
+            # the video is not an flv
+            if not self.header_sniffer.done:
+                self.update_data_duration(data_block.tobytes())
             self._total_bytes += data_block_len
             self.update_with_tags(flv_tags)
-            after = time.time()
-            if not self.data_duration:
-                try:
-                    self.data_duration = get_data_duration(meta_file_name)
-                except ParseError, mes:
-                    config_pytomo.LOG.info('data duration not yet found: %s'
-                                           % mes)
+            after = monotonic()
+            self.parse_time += after - read_time
             self.current_time = after - start
             time_difference = after - before
+            before = after
             self.update_state(time_difference)
-            block_size = self.best_block_size(time_difference, data_block_len)
             instant_thp = (8e-3 * data_block_len / (time_difference)
                            if (time_difference) != 0 else None)
             if time_difference > MAX_TH_MIN_UPDATE_TIME:
                 self.max_instant_thp = max(self.max_instant_thp, instant_thp)
-        meta_file.close()
         return after - start
 
 class InfoExtractor(object):
@@ -1001,14 +1142,6 @@ class InfoExtractor(object):
         """Real extraction process. Redefine in subclasses."""
         pass
 
-def write_no_seek(meta_file, data_block):
-    """Write the data block at the end of file but do not change position"""
-    position = meta_file.tell()
-    # seek 0 bytes from the end of file (2)
-    meta_file.seek(0, 2)
-    meta_file.write(data_block)
-    meta_file.seek(position)
-
 def read_next_tag_or_seek(flv_tags):
     """Read the next flv tag and return it
     in case of incomplete tag (not enough data) seek the file
@@ -1025,20 +1158,6 @@ def read_next_tag_or_seek(flv_tags):
         raise tags.EndOfFile
     return tag
 
-def get_data_duration(meta_file_name):
-    """Return the length (duration) of data or None
-    when found, close the file
-    """
-    try:
-        with open(meta_file_name) as meta_file:
-            info = kaa_metadata.parse(meta_file)
-    except IOError:
-        config_pytomo.LOG.error('Unable to open tempfile for kaa_metadata')
-
-    if (info and 'length' in info):
-        data_duration = info.length
-        return data_duration
-
 def get_download_stats(cache_uri, ip_address,
                        download_time=config_pytomo.DOWNLOAD_TIME):
                        #redirect=False):
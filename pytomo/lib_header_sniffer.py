@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""Module to find the duration of a video out of its container headers
+
+   The data blocks of the download are fed once to a HeaderSniffer object
+   which parses only the box/element holding the duration:
+       * MP4: moov/mvhd
+       * WebM/Matroska: Segment/Info (TimecodeScale and Duration)
+       * FLV: onMetaData script tag
+   This avoids re-parsing the downloaded data with kaa_metadata after each
+   block.
+
+   Usage:
+       import pytomo.lib_header_sniffer as lib_header_sniffer
+       sniffer = lib_header_sniffer.HeaderSniffer()
+       for data_block in blocks:
+           duration = sniffer.feed(data_block)
+           if sniffer.done:
+               break
+"""
+
+from __future__ import with_statement, absolute_import
+
+import struct
+from cStringIO import StringIO
+
+from .flvlib.astypes import get_script_data_variable
+
+# the header has to be found in the first bytes of the video
+MAX_HEADER_SIZE = 2 ** 20
+
+MP4_TOP_BOXES = ('ftyp', 'moov', 'mdat', 'free', 'skip', 'wide', 'pnot')
+# brand of the Quicktime files (the others are MPEG-4)
+MP4_QUICKTIME_BRAND = 'qt  '
+
+EBML_MAGIC = '\x1a\x45\xdf\xa3'
+EBML_ID_SEGMENT = 0x18538067
+EBML_ID_INFO = 0x1549A966
+EBML_ID_TIMECODE_SCALE = 0x2AD7B1
+EBML_ID_DURATION = 0x4489
+EBML_ID_CLUSTER = 0x1F43B675
+# default TimecodeScale in nanoseconds
+EBML_DEFAULT_TIMECODE_SCALE = 1000000
+
+FLV_MAGIC = 'FLV'
+FLV_HEADER_SIZE = 9
+FLV_TAG_HEADER_SIZE = 11
+FLV_PREVIOUS_TAG_SIZE = 4
+FLV_TAG_SCRIPT = 18
+
+def read_vint(data, index, keep_marker=False):
+    '''Return a tuple of the value of the EBML variable size integer starting
+    at index and its length, or None if data is too short
+    For sizes, None is returned as value in case of unknown size.
+    >>> read_vint('\\x81', 0)
+    (1, 1)
+    >>> read_vint('\\x1a\\x45\\xdf\\xa3', 0, keep_marker=True) == (
+    ...                                                     0x1A45DFA3, 4)
+    True
+    >>> read_vint('\\x40\\x02', 0)
+    (2, 2)
+    >>> read_vint('\\x40', 0)
+    >>> read_vint('\\x01\\xff\\xff\\xff\\xff\\xff\\xff\\xff', 0)
+    (None, 8)
+    '''
+    if index >= len(data):
+        return None
+    first = ord(data[index])
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        length += 1
+        mask >>= 1
+    if length > 8 or index + length > len(data):
+        return None
+    value = first if keep_marker else first & (mask - 1)
+    for byte in data[index + 1:index + length]:
+        value = (value << 8) | ord(byte)
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        # all bits set: unknown size
+        value = None
+    return value, length
+
+class HeaderSniffer(object):
+    '''Incremental parser of the video container headers
+    The data is given block by block to feed, which returns the duration (in
+    seconds) as soon as it is found, None otherwise.
+    done is set when the duration is found or cannot be found.
+    video_type is named as the subtype of the kaa_metadata mime type.
+    >>> mvhd = struct.pack('>I4sB3xIIII', 28, 'mvhd', 0, 0, 0, 1000, 5500)
+    >>> video = (struct.pack('>I4s4s', 12, 'ftyp', 'isom')
+    ...          + struct.pack('>I4s', 8 + len(mvhd), 'moov') + mvhd)
+    >>> sniffer = HeaderSniffer()
+    >>> [sniffer.feed(video[index:index + 7])
+    ...  for index in range(0, len(video), 7)][-3:]
+    [None, None, 5.5]
+    >>> sniffer.container, sniffer.video_type, sniffer.done
+    ('mp4', 'mp4', True)
+    >>> sniffer = HeaderSniffer()
+    >>> sniffer.feed('<html></html>')
+    >>> sniffer.container, sniffer.done
+    (None, True)
+
+    A zero-size Duration or a truncated mvhd box give no duration:
+    >>> sniffer = HeaderSniffer()
+    >>> sniffer.feed('\\x1a\\x45\\xdf\\xa3\\x80' '\\x18\\x53\\x80\\x67\\xff'
+    ...              '\\x15\\x49\\xa9\\x66\\x83' '\\x44\\x89\\x80')
+    >>> sniffer.container, sniffer.done
+    ('matroska', True)
+    >>> sniffer = HeaderSniffer()
+    >>> sniffer.feed(struct.pack('>I4s', 20, 'moov')
+    ...              + struct.pack('>I4sB3x', 12, 'mvhd', 0) + 'free')
+    >>> sniffer.container, sniffer.done
+    ('mp4', True)
+    '''
+
+    def __init__(self, max_header_size=MAX_HEADER_SIZE):
+        self.container = None
+        self.video_type = None
+        self.duration = None
+        self.done = False
+        self.max_header_size = max_header_size
+        # data received and not yet parsed: self._data[0] is the byte at
+        # offset self._start of the stream
+        self._data = ''
+        self._start = 0
+        # offset of the next box/element/tag to parse
+        self._position = 0
+        self._parse_step = self._detect_container
+        # Matroska values
+        self._info_end = None
+        self._timecode_scale = None
+        self._ebml_duration = None
+
+    def feed(self, data_block):
+        'Parse the new data block and return the duration if known'
+        if self.done:
+            return self.duration
+        self._data += data_block
+        self._trim()
+        while not self.done and self._parse_step():
+            pass
+        self._trim()
+        if (not self.done and (self._position > self.max_header_size
+                               or len(self._data) > self.max_header_size)):
+            # header not found where expected
+            self.done = True
+        if self.done:
+            self._data = ''
+        return self.duration
+
+    def _trim(self):
+        'Drop the data already parsed or skipped'
+        drop = min(self._position - self._start, len(self._data))
+        if drop > 0:
+            self._data = self._data[drop:]
+            self._start += drop
+
+    def _peek(self, size):
+        'Return size bytes at the current position or None if not received'
+        index = self._position - self._start
+        if index < 0 or len(self._data) - index < size:
+            return None
+        return self._data[index:index + size]
+
+    def _found(self, duration):
+        'Store the duration and stop parsing'
+        self.duration = duration if duration > 0 else None
+        self.done = True
+
+    def _detect_container(self):
+        'Select the parser according to the first bytes of data'
+        start = self._peek(8)
+        if start is None:
+            return False
+        if start.startswith(FLV_MAGIC):
+            self.container = 'flv'
+            self.video_type = 'flv'
+            self._parse_step = self._parse_flv_header
+        elif start.startswith(EBML_MAGIC):
+            self.container = 'matroska'
+            self.video_type = 'mkv'
+            self._parse_step = self._parse_ebml
+        elif start[4:8] in MP4_TOP_BOXES:
+            self.container = 'mp4'
+            self.video_type = 'quicktime'
+            self._parse_step = self._parse_mp4
+        else:
+            self.done = True
+        return True
+
+    def _parse_mp4(self):
+        'Parse the next box: descend into moov, skip the others'
+        header = self._peek(8)
+        if header is None:
+            return False
+        size, box_type = struct.unpack('>I4s', header)
+        header_len = 8
+        if size == 1:
+            header = self._peek(16)
+            if header is None:
+                return False
+            size = struct.unpack('>Q', header[8:16])[0]
+            header_len = 16
+        if box_type == 'ftyp' and self._position == 0:
+            brand = self._peek(header_len + 4)
+            if brand is None:
+                return False
+            if brand[header_len:] != MP4_QUICKTIME_BRAND:
+                self.video_type = 'mp4'
+        if box_type == 'moov':
+            self._position += header_len
+            return True
+        if box_type == 'mvhd':
+            box = self._peek(max(size, header_len + 1))
+            if box is None:
+                return False
+            if ord(box[header_len]) == 1:
+                values = box[header_len + 20:header_len + 32]
+                values_format = '>IQ'
+            else:
+                values = box[header_len + 12:header_len + 20]
+                values_format = '>II'
+            if size < header_len + 1 or len(values) < struct.calcsize(
+                                                            values_format):
+                # truncated box: no duration
+                self.done = True
+                return True
+            timescale, duration = struct.unpack(values_format, values)
+            self._found(float(duration) / timescale if timescale else 0)
+            return True
+        if size < header_len:
+            # box up to the end of file (size 0) or corrupted
+            self.done = True
+            return True
+        self._position += size
+        return True
+
+    def _parse_ebml(self):
+        'Parse the next element: descend into Segment and Info'
+        index = self._position - self._start
+        element_id = read_vint(self._data, index, keep_marker=True)
+        if element_id is None:
+            return False
+        element_id, id_len = element_id
+        size = read_vint(self._data, index + id_len)
+        if size is None:
+            return False
+        size, size_len = size
+        header_len = id_len + size_len
+        if element_id == EBML_ID_SEGMENT:
+            self._position += header_len
+            return True
+        if element_id == EBML_ID_INFO:
+            self._position += header_len
+            if size is not None:
+                self._info_end = self._position + size
+            return True
+        if element_id == EBML_ID_CLUSTER or size is None:
+            # media data reached without Info
+            self._finish_ebml()
+            return True
+        if element_id in (EBML_ID_TIMECODE_SCALE, EBML_ID_DURATION):
+            element = self._peek(header_len + size)
+            if element is None:
+                return False
+            payload = element[header_len:]
+            if element_id == EBML_ID_DURATION:
+                if size == 0:
+                    self._ebml_duration = 0.0
+                elif size in (4, 8):
+                    self._ebml_duration = struct.unpack(
+                                    '>f' if size == 4 else '>d', payload)[0]
+                else:
+                    # not a float: no duration
+                    self.done = True
+                    return True
+            else:
+                self._timecode_scale = 0
+                for byte in payload:
+                    self._timecode_scale = ((self._timecode_scale << 8)
+                                            | ord(byte))
+        self._position += header_len + size
+        if (self._ebml_duration is not None
+            and (self._timecode_scale is not None
+                 or (self._info_end and self._position >= self._info_end))):
+            self._finish_ebml()
+        return True
+
+    def _finish_ebml(self):
+        'Compute the duration out of the Info values'
+        if self._ebml_duration is None:
+            self.done = True
+            return
+        self._found(self._ebml_duration
+                    * (self._timecode_scale or EBML_DEFAULT_TIMECODE_SCALE)
+                    / 1e9)
+
+    def _parse_flv_header(self):
+        'Skip the FLV header'
+        header = self._peek(FLV_HEADER_SIZE)
+        if header is None:
+            return False
+        data_offset = struct.unpack('>I', header[5:9])[0]
+        self._position += data_offset + FLV_PREVIOUS_TAG_SIZE
+        self._parse_step = self._parse_flv_tag
+        return True
+
+    def _parse_flv_tag(self):
+        'Look for the onMetaData tag'
+        header = self._peek(FLV_TAG_HEADER_SIZE)
+        if header is None:
+            return False
+        tag_type = ord(header[0]) & 0x1f
+        size = struct.unpack('>I', '\x00' + header[1:4])[0]
+        if tag_type == FLV_TAG_SCRIPT:
+            tag = self._peek(FLV_TAG_HEADER_SIZE + size)
+            if tag is None:
+                return False
+            # the name of a script tag is always preceded by a string marker
+            payload = tag[FLV_TAG_HEADER_SIZE + 1:]
+            try:
+                name, variable = get_script_data_variable(
+                                    StringIO(payload), max_offset=len(payload))
+            except Exception:
+                name, variable = None, None
+            if name == 'onMetaData':
+                try:
+                    self._found(float(variable['duration']))
+                except (KeyError, TypeError, ValueError):
+                    self.done = True
+                return True
+        self._position += FLV_TAG_HEADER_SIZE + size + FLV_PREVIOUS_TAG_SIZE
+        return True
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
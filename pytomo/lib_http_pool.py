@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""Module to reuse the HTTP connections between the metadata requests
+
+   The requests on the web pages and cache servers (video info, HEAD on the
+   redirects, links extraction) are sent on persistent connections kept per
+   host (and proxy) so that they do not pay a TCP/TLS handshake each.
+   The responses are read entirely and returned in a form compatible with
+   the urllib2 responses; the HTTP errors are raised as urllib2.HTTPError.
+
+   Usage:
+       import pytomo.lib_http_pool as lib_http_pool
+       response = lib_http_pool.open_url('http://www.youtube.com/',
+                                         method='HEAD')
+       response.code, response.geturl()
+       data = lib_http_pool.open_url('http://www.youtube.com/').read()
+"""
+
+from __future__ import with_statement, absolute_import
+
+import base64
+import httplib
+import socket
+import threading
+import time
+import urllib2
+from collections import namedtuple
+from cStringIO import StringIO
+from urllib import unquote
+from urlparse import urlsplit, urljoin
+
+from . import config_pytomo
+from . import lib_crawl_pool
+
+# exceptions of a kept connection closed by the server
+STALE_CONNECTION_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest,
+                           httplib.ResponseNotReady, socket.error)
+
+# redirect response not followed
+NoRedirectResponse = namedtuple('NoRedirectResponse', ['code', 'location'])
+
+class PooledResponse(object):
+    '''Response read from a pooled connection
+    It provides the attributes of the urllib2 responses used by pytomo.'''
+
+    def __init__(self, url, response, body):
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+        # file object of the body (as urllib2.HTTPError expects)
+        self.fp = StringIO(body)
+
+    def geturl(self):
+        'Return the url of the response (after the redirects)'
+        return self.url
+
+    def getcode(self):
+        'Return the HTTP status code'
+        return self.code
+
+    def info(self):
+        'Return the headers of the response'
+        return self.headers
+
+    def read(self, size=-1):
+        'Return the body of the response'
+        return self.fp.read(size)
+
+    def close(self):
+        'Nothing to release: the body is already read'
+        pass
+
+# proxy of a scheme, authorization is the value of the Proxy-Authorization
+# header (None if the proxy has no credentials)
+Proxy = namedtuple('Proxy', ['host', 'port', 'authorization'])
+
+def proxy_for(scheme):
+    '''Return the Proxy configured for the scheme, None if there is none
+    >>> config_pytomo.PROXIES = {'http': 'http://proxy.example.com:3128/',
+    ...                          'https': 'user:pa%3Ass@proxy.example.com'}
+    >>> proxy_for('http')
+    Proxy(host='proxy.example.com', port=3128, authorization=None)
+    >>> proxy_for('https').authorization
+    'Basic dXNlcjpwYTpzcw=='
+    >>> config_pytomo.PROXIES = None
+    >>> proxy_for('http')
+    '''
+    if not config_pytomo.PROXIES or scheme not in config_pytomo.PROXIES:
+        return None
+    proxy = urlsplit(config_pytomo.PROXIES[scheme])
+    if not proxy.hostname:
+        # proxy given as [user:password@]host:port
+        proxy = urlsplit('//' + config_pytomo.PROXIES[scheme])
+    authorization = None
+    if proxy.username is not None:
+        credentials = ':'.join((unquote(proxy.username),
+                                unquote(proxy.password or '')))
+        authorization = ' '.join(('Basic', base64.b64encode(credentials)))
+    return Proxy(proxy.hostname, proxy.port or httplib.HTTP_PORT,
+                 authorization)
+
+class ConnectionPool(object):
+    '''Persistent HTTP connections kept per host
+    At most max_per_host connections are used at the same time on a host and
+    the connections idle for more than idle_timeout seconds are closed.
+    '''
+
+    def __init__(self, max_per_host=None, idle_timeout=None):
+        self.max_per_host = max_per_host or config_pytomo.HTTP_POOL_MAX_PER_HOST
+        self.idle_timeout = (idle_timeout
+                             or config_pytomo.HTTP_POOL_IDLE_TIMEOUT)
+        # key -> list of (connection, time of last use)
+        self._idle = dict()
+        self._lock = threading.Lock()
+        self._slots = lib_crawl_pool.ServerSlots(
+                                            max_per_server=self.max_per_host)
+
+    def _get_connection(self, key, timeout):
+        'Return an idle connection of the key or a new one and its reuse flag'
+        now = time.time()
+        with self._lock:
+            connections = self._idle.get(key, [])
+            while connections:
+                connection, last_use = connections.pop()
+                if now - last_use < self.idle_timeout:
+                    if connection.sock:
+                        connection.sock.settimeout(timeout)
+                    return connection, True
+                connection.close()
+        scheme, host, port, proxy = key
+        if scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        if proxy and scheme == 'https':
+            connection = connection_class(proxy.host, proxy.port,
+                                          timeout=timeout)
+            tunnel_headers = None
+            if proxy.authorization:
+                tunnel_headers = {'Proxy-Authorization': proxy.authorization}
+            connection.set_tunnel(host, port, headers=tunnel_headers)
+        elif proxy:
+            connection = connection_class(proxy.host, proxy.port,
+                                          timeout=timeout)
+        else:
+            connection = connection_class(host, port, timeout=timeout)
+        return connection, False
+
+    def _release(self, key, connection):
+        'Keep the connection for the next requests'
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.max_per_host:
+                connections.append((connection, time.time()))
+                return
+        connection.close()
+
+    def close(self):
+        'Close all the idle connections'
+        with self._lock:
+            for connections in self._idle.values():
+                for connection, _ in connections:
+                    connection.close()
+            self._idle.clear()
+
+    def _send(self, method, url, headers, timeout):
+        'Send the request on a pooled connection and read the response'
+        parsed_url = urlsplit(url)
+        scheme = parsed_url.scheme or 'http'
+        default_port = (httplib.HTTPS_PORT if scheme == 'https'
+                        else httplib.HTTP_PORT)
+        proxy = proxy_for(scheme)
+        key = (scheme, parsed_url.hostname, parsed_url.port or default_port,
+               proxy)
+        if proxy and scheme != 'https':
+            # the proxy needs the absolute url
+            target = url
+        else:
+            target = parsed_url.path or '/'
+            if parsed_url.query:
+                target = '?'.join((target, parsed_url.query))
+        headers = dict(headers or {})
+        headers.setdefault('Host', parsed_url.netloc)
+        if proxy and scheme != 'https' and proxy.authorization:
+            headers['Proxy-Authorization'] = proxy.authorization
+        with self._slots.slot(key[:3]):
+            while True:
+                connection, reused = self._get_connection(key, timeout)
+                try:
+                    connection.request(method, target, headers=headers)
+                    response = connection.getresponse()
+                    body = response.read()
+                except STALE_CONNECTION_ERRORS, mes:
+                    connection.close()
+                    if reused:
+                        # closed by the server while idle: try another one
+                        config_pytomo.LOG.debug('Stale connection to %s: %s',
+                                                key[1], mes)
+                        continue
+                    raise urllib2.URLError(mes)
+                except:
+                    connection.close()
+                    raise
+                break
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(key, connection)
+        return PooledResponse(url, response, body)
+
+    def open_url(self, url, method='GET', headers=None, follow_redirect=True,
+                 timeout=None):
+        '''Return the response of the request like urllib2.urlopen
+        Without follow_redirect, a NoRedirectResponse (code, location) is
+        returned for the redirect codes.
+        '''
+        if timeout is None:
+            timeout = config_pytomo.URL_TIMEOUT
+        if headers is None:
+            headers = config_pytomo.STD_HEADERS
+        for _ in xrange(config_pytomo.MAX_NB_REDIRECT + 1):
+            response = self._send(method, url, headers, timeout)
+            if response.code in config_pytomo.HTTP_REDIRECT_CODE_LIST:
+                location = response.headers.getheader('location')
+                if not follow_redirect:
+                    return NoRedirectResponse(response.code, location)
+                if location:
+                    url = urljoin(url, location)
+                    continue
+            if response.code >= 400:
+                raise urllib2.HTTPError(url, response.code, response.msg,
+                                        response.headers, response.fp)
+            return response
+        raise urllib2.HTTPError(url, response.code, 'Too many redirects',
+                                response.headers, response.fp)
+
+POOL = None
+POOL_LOCK = threading.Lock()
+
+def get_pool():
+    'Return the connection pool shared by the modules'
+    global POOL
+    with POOL_LOCK:
+        if POOL is None:
+            POOL = ConnectionPool()
+        return POOL
+
+def open_url(url, method='GET', headers=None, follow_redirect=True,
+             timeout=None):
+    'Send the request on the shared connection pool'
+    return get_pool().open_url(url, method=method, headers=headers,
+                               follow_redirect=follow_redirect,
+                               timeout=timeout)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
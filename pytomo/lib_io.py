@@ -15,6 +15,7 @@ import re
 import logging
 import sys
 import os
+import multiprocessing
 from itertools import chain
 from datetime import datetime
 from operator import itemgetter
@@ -224,6 +225,133 @@ class PytomoFPDF(FPDF, HTMLMixin):
     def close_pdf(self):
         self.output(self.pdf_name, WRITE_TO_FILE)
 
+# signature of the inputs of the pdfs created (key: pdf file name)
+PDF_SIGNATURES = {}
+
+# pool of processes rendering the reports (see start_pool)
+POOL = None
+
+def start_pool(processes=None):
+    '''Start the pool of processes used by run_parallel
+    (config_pytomo.REPORT_PROCESSES, all the cores if None)
+    It must be started before any thread: a process forked while another
+    thread holds a lock (logging) would deadlock on it.'''
+    global POOL
+    if processes is None:
+        processes = config_pytomo.REPORT_PROCESSES
+    if POOL is not None or processes == 1:
+        return POOL
+    try:
+        POOL = multiprocessing.Pool(processes)
+    except (OSError, ImportError, NotImplementedError), mes:
+        config_pytomo.LOG.warning('Could not start the process pool: %s'
+                                  % mes)
+    return POOL
+
+def stop_pool():
+    'Stop the pool of processes'
+    global POOL
+    pool, POOL = POOL, None
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+
+def run_parallel(function, jobs, timeout=None):
+    '''Return the list of function(job) for each job, computed by the pool
+    of processes if it is started (see start_pool)
+    The jobs are run in this process if there is no pool or only one job, or
+    if the pool does not complete them in timeout seconds
+    (config_pytomo.REPORT_TIMEOUT): the pool is then stopped.
+    >>> run_parallel(abs, [-1, 2, -3])
+    [1, 2, 3]
+    >>> pool = start_pool(2)
+    >>> run_parallel(abs, [-1, 2, -3])
+    [1, 2, 3]
+    >>> stop_pool()
+    '''
+    if timeout is None:
+        timeout = config_pytomo.REPORT_TIMEOUT
+    jobs = list(jobs)
+    pool = POOL
+    if pool is not None and len(jobs) > 1:
+        try:
+            return pool.map_async(function, jobs).get(timeout)
+        except multiprocessing.TimeoutError:
+            config_pytomo.LOG.error('The process pool did not render the '
+                                    'reports in %s seconds: rendering them '
+                                    'in this process' % timeout)
+            if pool is POOL:
+                stop_pool()
+    return map(function, jobs)
+
+def file_signature(file_name):
+    '''Return the (modification time, size) of the file, None if it does not
+    exist
+    >>> file_signature('/non/existent/file')
+    '''
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+def pdf_signature(timestamp, average_values, parameters):
+    'Return the signature of the inputs of the pdf of the parameters'
+    if parameters[0] in [LINKS_KEY, DB_KEY]:
+        plotted = ALL_PLOTS[MAIN_KEY]
+    else:
+        plotted = parameters
+    return (timestamp, tuple(average_values), tuple(parameters),
+            tuple(file_signature(plot_filename(parameter, timestamp))
+                  for parameter in plotted))
+
+def create_pdf_job(job):
+    '''Create the pdf of the job (pdf_name, timestamp, average_values,
+    parameters): return None if created, the error message otherwise
+    (run in the processes of the pool)'''
+    pdf_name, timestamp, average_values, parameters = job
+    try:
+        create_pdf(pdf_name, timestamp, average_values, *parameters)
+    except Exception, mes:
+        return str(mes)
+    return None
+
+def create_pdfs(timestamp, average_values, pages):
+    '''Create in parallel the pdfs of the pages, a list of (parameter,
+    parameters to plot), and return a dict of the relative path of the pdf
+    of each parameter (only for the pdfs created)
+    The pdfs whose inputs did not change since their creation are kept.
+    '''
+    pdf_links = dict()
+    jobs = []
+    pending = []
+    for parameter, parameters in pages:
+        try:
+            pdf_name = pdf_filename(parameter, timestamp)
+        except IOError, mes:
+            config_pytomo.LOG.error('Could not create PDF, error: %s' % mes)
+            continue
+        rel_pdf_name = HTTP_CONNECTOR.join((config_pytomo.PDF_DIR,
+                                            os.path.basename(pdf_name)))
+        signature = pdf_signature(timestamp, average_values, parameters)
+        if (PDF_SIGNATURES.get(pdf_name) == signature
+                and os.path.getsize(pdf_name)):
+            pdf_links[parameter] = rel_pdf_name
+            continue
+        jobs.append((pdf_name, timestamp, average_values, parameters))
+        pending.append((parameter, pdf_name, rel_pdf_name, signature))
+    config_pytomo.LOG.debug('Create %d pdfs, %d unchanged'
+                            % (len(jobs), len(pdf_links)))
+    for (parameter, pdf_name, rel_pdf_name, signature), error in zip(pending,
+                                    run_parallel(create_pdf_job, jobs)):
+        if error:
+            PDF_SIGNATURES.pop(pdf_name, None)
+            config_pytomo.LOG.error('Could not create PDF, error: %s' % error)
+            continue
+        PDF_SIGNATURES[pdf_name] = signature
+        pdf_links[parameter] = rel_pdf_name
+    return pdf_links
+
 def create_pdf(pdf_name, timestamp, average_values, *parameters):
     config_pytomo.LOG.debug('pdf_name = %s; timestamp = %s; parameters = %s' %
                            (pdf_name, timestamp, str(parameters)))
@@ -735,48 +863,27 @@ def write_index(timestamp, database, db_dir=config_pytomo.DATABASE_DIR):
     # parameter represents either a list (a key in the dictionary ALL_PLOTS),
     # a single parameter that can be plotted or the LINKS_KEY / DB_KEY
     # if anything else is given, the main graphs are plotted
-    for parameter, f_index in \
-                        zip(ALL_PLOTS.keys(), f_param[:len(ALL_PLOTS.keys())]):
+    pages = ([(parameter, tuple(ALL_PLOTS[parameter]))
+              for parameter in ALL_PLOTS.keys()]
+             + [(parameter, (parameter,)) for parameter in
+                chain(ALL_PLOTS[ALL_KEY], [LINKS_KEY, DB_KEY])])
+    if timestamp:
+        # TODO: function is not properly checked, this must be removed
+        pdf_links = create_pdfs(timestamp, avg_values, pages)
+    else:
+        pdf_links = dict()
+    for (parameter, parameters), f_index in zip(pages, f_param):
         # TODO: must be moved back to middle column
         # the middle column div
         f_index.write((' ' * NR_DIV_SPACES + DIV_START_TAG + END_LINE) %
                                                                 MID_COL_NAME)
-        if timestamp:
-            # TODO: function is not properly checked, this must be removed
-            try:
-                pdf_name = pdf_filename(parameter, timestamp)
-                rel_pdf_name = HTTP_CONNECTOR.join((config_pytomo.PDF_DIR,
-                                            os.path.basename(pdf_name)))
-                create_pdf(pdf_name, timestamp, avg_values,
-                           *ALL_PLOTS[parameter])
-                f_index.write((' ' * NR_INNER_SPACES + P_TAG + END_LINE) %
-                              PDF_MSG)
-                f_index.write((' ' * NR_INNER_SPACES + A_TAG + END_LINE) %
-                              (rel_pdf_name, rel_pdf_name))
-            except Exception, mes:
-                config_pytomo.LOG.error('Could not create PDF, error: %s' % mes)
+        if parameter in pdf_links:
+            f_index.write((' ' * NR_INNER_SPACES + P_TAG + END_LINE) %
+                          PDF_MSG)
+            f_index.write((' ' * NR_INNER_SPACES + A_TAG + END_LINE) %
+                          (pdf_links[parameter], pdf_links[parameter]))
         write_middle_column(f_index, timestamp, links_data, db_dir,
-                            *ALL_PLOTS[parameter])
-    for parameter, f_index in zip(chain(ALL_PLOTS[ALL_KEY],
-                        [LINKS_KEY, DB_KEY]), f_param[len(ALL_PLOTS.keys()):]):
-        # TODO: must be moved back to middle column
-        # the middle column div
-        f_index.write((' ' * NR_DIV_SPACES + DIV_START_TAG + END_LINE) %
-                                                                MID_COL_NAME)
-        if timestamp:
-            # TODO: function is not properly checked, this must be removed
-            try:
-                pdf_name = pdf_filename(parameter, timestamp)
-                rel_pdf_name = HTTP_CONNECTOR.join((config_pytomo.PDF_DIR,
-                                            os.path.basename(pdf_name)))
-                create_pdf(pdf_name, timestamp, avg_values, parameter)
-                f_index.write((' ' * NR_INNER_SPACES + P_TAG + END_LINE) %
-                              PDF_MSG)
-                f_index.write((' ' * NR_INNER_SPACES + A_TAG + END_LINE) %
-                              (rel_pdf_name, rel_pdf_name))
-            except Exception, mes:
-                config_pytomo.LOG.error('Could not create PDF, error: %s' % mes)
-        write_middle_column(f_index, timestamp, links_data, db_dir, parameter)
+                            *parameters)
     # add the left, right columns and the footer to each index
     for f_index in f_param:
         # left column - links to plots
@@ -19,12 +19,13 @@ import logging
 import socket
 from optparse import OptionParser
 from httplib import BadStatusLine
-from collections import namedtuple
 # global config
 try:
     from . import config_pytomo
+    from . import lib_http_pool
 except ValueError:
     import config_pytomo
+    import lib_http_pool
 
 CONTENT_TYPE_HEADER = 'Content-type'
 TEXT_HTML_TYPE = 'text/html'
@@ -53,21 +54,7 @@ class LinksExtractor(htmllib.HTMLParser):
         return self.links
 
 
-class HeadRequest(urllib2.Request):
-    ''' Class to return only the header of a request'''
-    def get_method(self):
-        return "HEAD"
-
-NoRedirectResponse = namedtuple('NoRedirectResponse', ['code', 'location'])
-
-class NoRedirectHandler(urllib2.HTTPRedirectHandler):
-    'Class to not follow redirects'
-    def http_error_x(self, req, fp, code, msg, headers):
-        return NoRedirectResponse(code, headers['location'])
-
-for redirect_code in config_pytomo.HTTP_REDIRECT_CODE_LIST:
-    setattr(NoRedirectHandler, 'http_error_%d' % redirect_code,
-            NoRedirectHandler.http_error_x)
+NoRedirectResponse = lib_http_pool.NoRedirectResponse
 
 
 def configure_proxy():
@@ -78,15 +65,13 @@ def configure_proxy():
         urllib2.install_opener(opener)
 
 def retrieve_header(url, follow_redirect=True):
-    ''' Return only the response header of an url'''
-    if follow_redirect:
-        opener = urllib2.build_opener()
-    else:
-        opener = urllib2.build_opener(NoRedirectHandler)
-    request = HeadRequest(url, None, config_pytomo.STD_HEADERS)
+    ''' Return only the response header of an url
+    Without follow_redirect, a NoRedirectResponse (code, location) is returned
+    in case of redirect.
+    The request is sent on a persistent connection of lib_http_pool.'''
     try:
-        #response = urllib2.urlopen(request, timeout=config_pytomo.URL_TIMEOUT)
-        response = opener.open(request, timeout=config_pytomo.URL_TIMEOUT)
+        response = lib_http_pool.open_url(url, method='HEAD',
+                                          follow_redirect=follow_redirect)
     except urllib2.URLError, mes:
         config_pytomo.LOG.warn('URLError in getting HEAD of this url: %s'
                                '\nError message: %s' % (url, mes))
@@ -125,9 +110,7 @@ def get_all_links(url):
         if content_type:
             if TEXT_HTML_TYPE in content_type:
                 try:
-                    data = urllib2.urlopen(urllib2.Request(url, None,
-                                           config_pytomo.STD_HEADERS),
-                                           timeout=config_pytomo.URL_TIMEOUT)
+                    data = lib_http_pool.open_url(response.geturl())
                 # socket.error is a child of IOError only in 2.6
                 except (socket.error, IOError), mes:
                     config_pytomo.LOG.warn('Problem in getting links of this'
@@ -3,6 +3,9 @@
 
    This module provides two functions that enable us to get the ping statistics
    of an IP address on any system(Linux, Windows, Mac)
+   The echo requests are sent from an ICMP socket (unprivileged datagram
+   socket if allowed, raw socket otherwise) to all the IP addresses at once.
+   The system ping command is used when no ICMP socket can be opened.
 
    Usage:
        import pytomo.lib_ping as lib_ping
@@ -15,6 +18,7 @@
        ip_address = '127.0.0.1'
        lib_ping.configure_ping_options(nb_packets)
        lib_ping.ping_ip(ip_address, nb_packets)
+       lib_ping.ping_ips(['127.0.0.1', '127.0.0.2'], nb_packets)
 """
 
 
@@ -22,8 +26,29 @@
 from __future__ import with_statement, absolute_import
 import os
 import re
+import socket
+import struct
+import select
+import errno
+import threading
+import itertools
+import time
+from math import sqrt
 
 from . import config_pytomo
+from . import lib_crawl_pool
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMP_HEADER_FORMAT = '>BBHHH'
+ICMP_HEADER_SIZE = struct.calcsize(ICMP_HEADER_FORMAT)
+ICMP_PAYLOAD = 'pytomo'.ljust(48, '.')
+# None until the first ping: True if an ICMP socket can be opened
+NATIVE_PING = None
+# distinguish the echo requests of the sockets opened at the same time (raw
+# sockets receive all the replies)
+ICMP_IDS = itertools.count(os.getpid())
+ICMP_IDS_LOCK = threading.Lock()
 
 RTT_MATCH_LINUX = r"rtt min/avg/max/mdev = "
 RTT_PATTERN_LINUX = r"(\d+.\d+)/(\d+.\d+)/(\d+.\d+)/\d+.\d+ ms"
@@ -79,8 +104,162 @@ def configure_ping_options(ping_packets=config_pytomo.PING_PACKETS):
         return None
     config_pytomo.RTT = True
 
+def checksum(data):
+    '''Return the internet checksum of the data
+    >>> hex(checksum('\\x08\\x00\\x00\\x00\\x00\\x01\\x00\\x01'))
+    '0xf7fd'
+    '''
+    if len(data) % 2:
+        data += '\0'
+    total = sum(struct.unpack('>%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+def echo_request(icmp_id, sequence):
+    '''Return the ICMP echo request packet
+    >>> packet = echo_request(1, 1)
+    >>> len(packet), checksum(packet)
+    (56, 0)
+    '''
+    header = struct.pack(ICMP_HEADER_FORMAT, ICMP_ECHO_REQUEST, 0, 0, icmp_id,
+                         sequence)
+    return struct.pack(ICMP_HEADER_FORMAT, ICMP_ECHO_REQUEST, 0,
+                       checksum(header + ICMP_PAYLOAD), icmp_id,
+                       sequence) + ICMP_PAYLOAD
+
+def parse_echo_reply(data):
+    '''Return the (id, sequence) of the echo reply packet, None if the
+    packet is not an echo reply (the IP header is skipped if present)
+    >>> reply = struct.pack(ICMP_HEADER_FORMAT, ICMP_ECHO_REPLY, 0, 0, 7, 3)
+    >>> parse_echo_reply(reply)
+    (7, 3)
+    >>> parse_echo_reply('\\x45' + '\\x00' * 19 + reply)
+    (7, 3)
+    >>> parse_echo_reply(echo_request(7, 3))
+    '''
+    if data and ord(data[0]) >> 4 == 4:
+        # IPv4 header given by raw sockets (and datagram sockets on Mac)
+        data = data[(ord(data[0]) & 0x0F) * 4:]
+    if len(data) < ICMP_HEADER_SIZE:
+        return None
+    icmp_type, _, _, icmp_id, sequence = struct.unpack(
+                            ICMP_HEADER_FORMAT, data[:ICMP_HEADER_SIZE])
+    if icmp_type != ICMP_ECHO_REPLY:
+        return None
+    return icmp_id, sequence
+
+def open_icmp_socket():
+    '''Return a tuple of an ICMP socket and a flag set if replies must be
+    checked against the id of the requests (raw socket), None if no ICMP
+    socket can be opened'''
+    for sock_type, check_id in ((socket.SOCK_DGRAM, False),
+                                (socket.SOCK_RAW, True)):
+        try:
+            return socket.socket(socket.AF_INET, sock_type,
+                                 socket.IPPROTO_ICMP), check_id
+        except socket.error, mes:
+            config_pytomo.LOG.debug('Unable to open ICMP socket of type %d: '
+                                    '%s', sock_type, mes)
+    return None
+
+def rtt_stats(rtts):
+    '''Return the list of the min, avg, max and mdev of the RTT values
+    >>> rtt_stats([1.0, 3.0])
+    [1.0, 2.0, 3.0, 1.0]
+    '''
+    avg = sum(rtts) / len(rtts)
+    mdev = sqrt(max(0, sum(rtt * rtt for rtt in rtts) / len(rtts) - avg * avg))
+    return [min(rtts), avg, max(rtts), mdev]
+
+def native_ping(ip_addresses, ping_packets, icmp_socket, check_id):
+    '''Ping the ip addresses from the ICMP socket: one echo request is sent
+    to each address every PING_INTERVAL
+    Return a dict of ip address: [min, avg, max, mdev] (in ms)'''
+    with ICMP_IDS_LOCK:
+        icmp_id = ICMP_IDS.next() & 0xFFFF
+    # (ip address, sequence) -> time of the request
+    sent = dict()
+    rtts = dict((ip_address, []) for ip_address in ip_addresses)
+    start = time.time()
+    for sequence in xrange(ping_packets):
+        for ip_address in ip_addresses:
+            try:
+                icmp_socket.sendto(echo_request(icmp_id, sequence),
+                                   (ip_address, 0))
+            except socket.error, mes:
+                config_pytomo.LOG.debug('Unable to ping %s: %s',
+                                        ip_address, mes)
+                continue
+            sent[(ip_address, sequence)] = time.time()
+        next_round = start + (sequence + 1) * config_pytomo.PING_INTERVAL
+        if sequence == ping_packets - 1:
+            next_round = time.time() + config_pytomo.PING_TIMEOUT
+        while True:
+            remaining = next_round - time.time()
+            if remaining <= 0 or (not sent and sequence == ping_packets - 1):
+                break
+            readable, _, _ = select.select([icmp_socket], [], [], remaining)
+            if not readable:
+                continue
+            try:
+                data, (ip_address, _) = icmp_socket.recvfrom(2048)
+            except socket.error, mes:
+                if mes.args[0] == errno.EINTR:
+                    continue
+                raise
+            received = time.time()
+            reply = parse_echo_reply(data)
+            if not reply or (check_id and reply[0] != icmp_id):
+                continue
+            send_time = sent.pop((ip_address, reply[1]), None)
+            if send_time is not None:
+                rtts[ip_address].append(1000 * (received - send_time))
+    return dict((ip_address, rtt_stats(values) if values else None)
+                for ip_address, values in rtts.items())
+
+def ping_ips(ip_addresses, ping_packets=config_pytomo.PING_PACKETS):
+    '''Return a dict of ip address: list of the min, avg and max ping values
+    (None if no RTT could be measured)
+    All the addresses are pinged at the same time.'''
+    global NATIVE_PING
+    ip_addresses = list(set(ip_addresses))
+    if not ip_addresses:
+        return dict()
+    if NATIVE_PING is not False:
+        icmp_socket = open_icmp_socket()
+        NATIVE_PING = icmp_socket is not None
+        if icmp_socket:
+            try:
+                stats = native_ping(ip_addresses, ping_packets, *icmp_socket)
+            except socket.error, mes:
+                config_pytomo.LOG.error('Native ping failed: %s', mes)
+            else:
+                for ip_address, rtt_values in stats.items():
+                    if rtt_values:
+                        config_pytomo.LOG.debug(
+                            'RTT stats found for ip: %s (mdev %.3f ms)',
+                            ip_address, rtt_values[3])
+                        stats[ip_address] = rtt_values[:3]
+                    else:
+                        config_pytomo.LOG.info('No RTT stats found for ip: '
+                                               '%s', ip_address)
+                return stats
+            finally:
+                icmp_socket[0].close()
+        else:
+            config_pytomo.LOG.info('No ICMP socket: use the ping command')
+    return dict(lib_crawl_pool.run_workers(
+        lambda ip_address: (ip_address,
+                            command_ping(ip_address, ping_packets)),
+        ip_addresses, len(ip_addresses)))
+
 def ping_ip(ip_address, ping_packets=config_pytomo.PING_PACKETS):
-    "Return a list of the min, avg, max and mdev ping values"
+    "Return a list of the min, avg and max ping values"
+    return ping_ips([ip_address], ping_packets)[ip_address]
+
+def command_ping(ip_address, ping_packets=config_pytomo.PING_PACKETS):
+    "Return a list of the min, avg and max ping values of the ping command"
     if not config_pytomo.RTT:
         configure_ping_options(ping_packets)
         if not config_pytomo.RTT:
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 """
 Module to plot the data and generate the PNG/PDF image file
+The databases can also be given as the crawl tables exported by lib_columnar.
 """
 
 import sqlite3
@@ -8,9 +9,21 @@ import datetime
 import sys
 import os
 import cdfplot_new
+try:
+    from . import lib_database
+except ValueError:
+    import lib_database
+try:
+    from . import lib_columnar
+except ValueError:
+    import lib_columnar
 from optparse import OptionParser
 from collections import defaultdict
 from itertools import cycle
+try:
+    import numpy as np
+except ImportError:
+    np = None
 try:
     #from matplotlib.backends.backend_pdf import PdfPages
     import matplotlib as mpl
@@ -31,7 +44,11 @@ COLOR_DICT = {}
 for res in DNS_RESOLVERS:
     COLOR_DICT[res] = COLORS.next()
 
+# the values are averaged on INTERVAL minutes
 INTERVAL = 2
+# columns needed to compute the average throughput
+AVG_THP = 'AvgThp'
+AVG_THP_COLUMNS = ['DownloadBytes', 'DownloadTime']
 UNITS = {
     'DownloadTime' : 'sec',
     'DownloadBytes' : 'bytes',
@@ -130,6 +147,119 @@ def create_fig(db_name):
     #graph_num = cycle([1, 2, 3, 4, 5])
     return fig
 
+def load_data(cursor, table, column_names):
+    """Return a tuple (times, columns, resolvers) of all the records of the
+    table, read in one scan in the order of their timestamp:
+        times: int64 array of the timestamps in seconds from epoch (UTC)
+        columns: dict of the float array of each column (nan if no value)
+        resolvers: dict of the boolean mask of the records of each resolver
+    AvgThp (in kbps) is computed out of DownloadBytes and DownloadTime.
+    >>> cursor = sqlite3.connect(':memory:').cursor()
+    >>> _ = cursor.execute('CREATE TABLE crawl (ID TIMESTAMP, Resolver text, '
+    ...                    'PingMin real, DownloadBytes integer, '
+    ...                    'DownloadTime real)')
+    >>> _ = cursor.executemany('INSERT INTO crawl VALUES (?, ?, ?, ?, ?)',
+    ...         [('2012-06-25 14:55:30.1', 'google', '', 2000, 0),
+    ...          ('2012-06-25 14:54:57.422007', '_default_open_dns', 10,
+    ...           1000, 2)])
+    >>> times, columns, resolvers = load_data(cursor, 'crawl',
+    ...                                       ['PingMin', 'AvgThp'])
+    >>> times.tolist()
+    [1340636097, 1340636130]
+    >>> columns['PingMin'].tolist(), columns['AvgThp'].tolist()
+    ([10.0, nan], [4.0, nan])
+    >>> [resolvers[name].tolist() for name in DNS_RESOLVERS]
+    [[True, False], [False, True], [True, False]]
+    """
+    db_columns = database_columns(column_names)
+    # empty strings are missing values
+    cmd = ' '.join(("SELECT CAST(strftime('%s', ID) AS INTEGER), Resolver",
+                    ''.join(", NULLIF(%s, '')" % db_column
+                            for db_column in db_columns),
+                    "FROM", table, "WHERE ID IS NOT NULL ORDER BY ID"))
+    cursor.execute(cmd)
+    rows = cursor.fetchall()
+    if rows:
+        records = np.array(rows, dtype=object)
+    else:
+        records = np.empty((0, len(db_columns) + 2), dtype=object)
+    times = records[:, 0].astype(np.int64)
+    values = records[:, 2:].astype(float)
+    columns = derive_columns(dict(zip(db_columns, values.T)), column_names)
+    # the resolvers are matched like the LIKE '%name%' of sqlite on the
+    # distinct values only
+    names, categories = np.unique(np.char.lower(
+                            records[:, 1].astype(str)), return_inverse=True)
+    return times, columns, resolver_masks(names, categories)
+
+def load_columnar_data(table, column_names):
+    """Return the tuple (times, columns, resolvers) of load_data out of a
+    table exported by lib_columnar (lib_columnar.ColumnarTable)
+    Only the selected records are copied out of the memory-mapped columns.
+    """
+    times = np.asarray(table.column('ID'))
+    valid = ~np.isnan(times)
+    db_data = dict((db_column, np.asarray(table.column(db_column))[valid])
+                   for db_column in database_columns(column_names))
+    columns = derive_columns(db_data, column_names)
+    # the codes of the missing resolvers (-1) select the last name
+    names = np.char.lower(np.array(table.dictionary('Resolver') + [''],
+                                   dtype=unicode))
+    categories = np.asarray(table.column('Resolver'))[valid]
+    return times[valid].astype(np.int64), columns, resolver_masks(names,
+                                                                  categories)
+
+def database_columns(column_names):
+    '''Return the list of the database columns needed for the columns
+    >>> database_columns(['PingMin', 'AvgThp', 'DownloadTime'])
+    ['PingMin', 'DownloadBytes', 'DownloadTime']
+    '''
+    db_columns = []
+    for column_name in column_names:
+        for db_column in (AVG_THP_COLUMNS if column_name == AVG_THP
+                          else [column_name]):
+            if db_column not in db_columns:
+                db_columns.append(db_column)
+    return db_columns
+
+def derive_columns(db_data, column_names):
+    'Return the dict of the array of each column out of the database columns'
+    columns = dict()
+    for column_name in column_names:
+        if column_name == AVG_THP:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                column = (8 * db_data['DownloadBytes'] / db_data['DownloadTime']
+                          / 1000)
+            column[~np.isfinite(column)] = np.nan
+        else:
+            column = db_data[column_name]
+        columns[column_name] = column
+    return columns
+
+def resolver_masks(names, categories):
+    '''Return the dict of the boolean mask of the records of each resolver
+    out of the (lower case) resolver names and the index of the name of each
+    record'''
+    return dict((resolver, (np.char.find(names, resolver) >= 0)[categories])
+                for resolver in DNS_RESOLVERS)
+
+def interval_means(times, values, interval=INTERVAL):
+    """Return the arrays (times, means) of the values averaged on each
+    interval of minutes: the time of an interval is the one of its first value
+    The times must be sorted.
+    >>> times, means = interval_means(np.array([0, 30, 61, 150, 170]),
+    ...                               np.array([1., 3., 5., 2., 4.]), 1)
+    >>> times.tolist(), means.tolist()
+    ([0, 61, 150], [2.0, 5.0, 3.0])
+    """
+    if not len(times):
+        return times, values
+    groups = times // (60 * interval)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(groups)) + 1))
+    counts = np.diff(np.concatenate((starts, [len(values)])))
+    return (times[starts],
+            np.add.reduceat(values, starts) / counts)
+
 def plot_data(column_names, image_file, db_file=None, cdf=False):
     """Function to plot the data in the database. Creates sub plots for
      the column names.
@@ -137,67 +267,103 @@ def plot_data(column_names, image_file, db_file=None, cdf=False):
     if not db_file:
         from . import config_pytomo
         db_file = config_pytomo.DATABASE_TIMESTAMP
-    conn = sqlite3.connect(str(db_file),
-                           detect_types=sqlite3.PARSE_DECLTYPES)
-    cur = conn.cursor()
-    user_table = cur.execute('select name from sqlite_master '
-                             'where type = "table"').fetchall()[0][0]
+    if lib_columnar.is_columnar(db_file):
+        times, columns, resolvers = load_columnar_data(
+                    lib_columnar.ColumnarTable(db_file), list(column_names))
+    else:
+        conn = sqlite3.connect(str(db_file),
+                               detect_types=sqlite3.PARSE_DECLTYPES)
+        cur = conn.cursor()
+        user_table = lib_database.crawl_table_name(cur, first=True)
+        # indexes and resolver table of the current schema
+        lib_database.upgrade_schema(conn, user_table)
+        times, columns, resolvers = load_data(cur, user_table,
+                                              list(column_names))
+        conn.close()
     to_plot = defaultdict(dict)
     cdf_data = defaultdict(dict)
-    #find the number of resolvers used.
     for column_name in list(column_names):
         for resolver in DNS_RESOLVERS:
-            dates = []
-            if column_name == 'AvgThp':
-                cmd = ' '.join(("select strftime('%Y-%m-%d %H:%M:%S', ID),",
-                                "8*DownloadBytes/DownloadTime/1000",
-                                "from",
-                                user_table,
-                                "where Resolver LIKE",
-                                ''.join(("'%", resolver, "%'")),
-                                "AND DownloadBytes != '' ",
-                                "group by strftime('%Y%m%d%H%M',ID)"
-                               ))
-                cdf_cmd = ' '.join(("select 8*DownloadBytes/DownloadTime/1000",
-                                    "from", user_table,
-                                    "where Resolver LIKE",
-                                    ''.join(("'%", resolver, "%'")),
-                                    "AND DownloadBytes != '' "
-                                   ))
-            else:
-                cmd = ' '.join(("select strftime('%Y-%m-%d %H:%M:%S', ID),",
-                                "AVG(", column_name, ")",
-                                "from",
-                                user_table,
-                                "where Resolver LIKE",
-                                ''.join(("'%", resolver, "%'")),
-                                "AND",
-                                column_name,
-                                "!= ''",
-                                "group by strftime('%Y%m%d%H%M',ID)"
-                               ))
-                cdf_cmd = ' '.join(("select ", column_name,
-                                "from", user_table,
-                                "where Resolver LIKE",
-                                ''.join(("'%", resolver, "%'")),
-                                "AND", column_name, "!= ''"
-                               ))
-            cmd += "/" + str(INTERVAL) + ";"
-            cur.execute(cmd)
-            column_data = cur.fetchall()
-            try:
-                times_u, column_data = zip(*column_data)
-            except ValueError:
+            selected = resolvers[resolver] & ~np.isnan(columns[column_name])
+            if not selected.any():
                 continue
-            for _ in times_u:
-                dates.append(datetime.datetime.strptime(_,
-                                                        '%Y-%m-%d %H:%M:%S'))
-            to_plot[column_name][resolver] = (dates, column_data)
+            values = columns[column_name][selected]
+            interval_times, means = interval_means(times[selected], values)
+            to_plot[column_name][resolver] = (
+                                mpl.dates.epoch2num(interval_times), means)
             if cdf:
-                cur.execute(cdf_cmd)
-                cdf_data[column_name][resolver] = cur.fetchall()
+                cdf_data[column_name][resolver] = cdfplot_new.QuantileSketch(
+                                                            values.tolist())
     plot_function(to_plot, db_file, image_file, cdf_data)
 
+def cdf_sketches(db_file, column_names):
+    """Return the QuantileSketch of the values of each column and resolver of
+    the database (dict column -> resolver -> sketch), fed from the cursor
+    (or from the columns of a table exported by lib_columnar)
+    """
+    if lib_columnar.is_columnar(db_file):
+        _, columns, resolvers = load_columnar_data(
+                    lib_columnar.ColumnarTable(db_file), column_names)
+        sketches = defaultdict(dict)
+        for column_name in column_names:
+            for resolver in DNS_RESOLVERS:
+                values = columns[column_name][resolvers[resolver]]
+                sketches[column_name][resolver] = cdfplot_new.QuantileSketch(
+                                    values[~np.isnan(values)].tolist())
+        return sketches
+    conn = sqlite3.connect(str(db_file))
+    cur = conn.cursor()
+    user_table = lib_database.crawl_table_name(cur, first=True)
+    lib_database.upgrade_schema(conn, user_table)
+    sketches = defaultdict(dict)
+    for column_name in column_names:
+        if column_name == AVG_THP:
+            expression = '8*DownloadBytes/DownloadTime/1000'
+            not_empty = "DownloadBytes != ''"
+        else:
+            expression = column_name
+            not_empty = ' '.join((column_name, "!= ''"))
+        for resolver in DNS_RESOLVERS:
+            cur.execute(' '.join(("SELECT", expression, "FROM", user_table,
+                        "WHERE", lib_database.resolver_condition(cur,
+                                                        user_table, resolver),
+                        "AND", not_empty)))
+            sketch = cdfplot_new.QuantileSketch()
+            sketch.feed(cur)
+            sketches[column_name][resolver] = sketch
+    conn.close()
+    return sketches
+
+def plot_merged_cdf(column_names, image_file, db_files):
+    """Plot the cdf of the columns for the values of all the databases (their
+    sketches are merged)
+    """
+    merged = defaultdict(dict)
+    for db_file in db_files:
+        for column_name, resolvers in cdf_sketches(db_file,
+                                                   column_names).items():
+            for resolver, sketch in resolvers.items():
+                if resolver in merged[column_name]:
+                    merged[column_name][resolver].merge(sketch)
+                else:
+                    merged[column_name][resolver] = sketch
+    for column_name in column_names:
+        args = [(resolver, sketch) for resolver, sketch
+                in sorted(merged[column_name].items()) if len(sketch)]
+        if not args:
+            print ''.join(("No data in ", column_name))
+            continue
+        cdf_fig = cdfplot_new.cdfplotdata(args, loc='best',
+                          title='%s (%d databases)' % (column_name,
+                                                       len(db_files)),
+                          xlabel=('%s in %s'
+                          % (column_name, UNITS.get(column_name, ''))))
+        cdf_file = os.path.join(os.path.dirname(image_file),
+                               '_'.join(('cdf', column_name.lower(),
+                               os.path.basename(image_file))))
+        cdf_fig.savefig(cdf_file)
+        print 'cdf of %s saved to %s' % (column_name, cdf_file)
+
 def create_options(parser):
     "Add the different options to parser"
     parser.add_option("-w", "--image_file", dest = "image_file",
@@ -275,6 +441,11 @@ def create_options(parser):
                       dest = 'cdf',
                       action = 'store_true', default = False,
                       help = 'Plot CDF of the choosen indcators')
+    parser.add_option('-C', '--merged-cdf',
+                      dest = 'merged_cdf',
+                      action = 'store_true', default = False,
+                      help = ('Plot only the CDF of the choosen indicators '
+                              'for all the databases together'))
     parser.add_option('-v', '--verbose',
                       dest = 'verbose',
                       action = 'store_true', default = False,
@@ -292,7 +463,7 @@ def main(argv=None):
             " [-A BufferDurationAtEnd] [-g InitialRate]"
             " [-M MaxInstantThp]" "[-U] InitialData"
             " [-m PingMin] [-a PingAvg] [-x PingMax]"
-            " [-c] database"
+            " [-c] [-C] database [database ...]"
             )
     parser = OptionParser(usage=usage)
     create_options(parser)
@@ -306,6 +477,9 @@ def main(argv=None):
     if not options.image_file.endswith('.pdf'):
         print("Can only generate pdf files. Check the file extention")
         return(1)
+    if options.merged_cdf:
+        plot_merged_cdf(options.column_names, options.image_file, args)
+        return 0
     for db_nb, database in enumerate(args):
         out_file = os.path.join(os.path.dirname(options.image_file),
                                 '_'.join((str(db_nb),
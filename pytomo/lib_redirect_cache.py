@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Module to cache the cache server redirect chains of the videos
+
+   In loop mode the same videos are crawled again and again: their chain of
+   cache servers can be reused for some time instead of being retrieved
+   before each measurement (the delay to obtain it is then not measured).
+   A fraction of the lookups is still answered as a miss so that the chains
+   keep being measured.
+
+   Usage:
+       import pytomo.lib_redirect_cache as lib_redirect_cache
+       redirect_cache = lib_redirect_cache.RedirectCache(ttl=600)
+       key = ('youtube', 'RcmKbTR--iA', 'default', '8.8.8.8')
+       cached = redirect_cache.get(key)
+       if not cached:
+           redirect_cache.put(key, cache_servers)
+"""
+
+from __future__ import with_statement, absolute_import
+
+import random
+import threading
+import time
+from collections import OrderedDict
+from urlparse import urlsplit, parse_qs
+
+from . import config_pytomo
+
+def video_id(url):
+    '''Return the id of the video in the url: its v parameter if any (YouTube)
+    or the last part of its path
+    >>> video_id('http://www.youtube.com/watch?v=RcmKbTR--iA&feature=related')
+    'RcmKbTR--iA'
+    >>> video_id('http://www.dailymotion.com/video/xh4xr7_lol_fun/')
+    'xh4xr7_lol_fun'
+    '''
+    parsed_url = urlsplit(url)
+    values = parse_qs(parsed_url.query).get('v')
+    if values:
+        return values[0]
+    return parsed_url.path.rstrip('/').rsplit('/', 1)[-1]
+
+class RedirectCache(object):
+    '''Redirect chains kept ttl seconds, at most max_size (least recently
+    used are evicted)
+    refresh is the fraction of the lookups answered as misses to measure the
+    chain again.
+    The values not given are read in config_pytomo at each use (so that
+    they can be set by the command line options).
+    >>> redirect_cache = RedirectCache(ttl=60, max_size=2, refresh=0)
+    >>> redirect_cache.put('a', ['http://cache_a'])
+    >>> redirect_cache.put('b', ['http://cache_b'])
+    >>> redirect_cache.get('a')
+    ['http://cache_a']
+    >>> redirect_cache.put('c', ['http://cache_c'])
+    >>> redirect_cache.get('b'), len(redirect_cache)
+    (None, 2)
+    '''
+
+    def __init__(self, ttl=None, max_size=None, refresh=None):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._refresh = refresh
+        # key -> (chain, expiry time), in order of use
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        'Time to live (in seconds) of the chains: 0 disables the cache'
+        if self._ttl is None:
+            return config_pytomo.REDIRECT_CACHE_TTL
+        return self._ttl
+
+    @property
+    def max_size(self):
+        'Max nb of chains kept'
+        return self._max_size or config_pytomo.REDIRECT_CACHE_SIZE
+
+    @property
+    def refresh(self):
+        'Fraction of the lookups answered as misses'
+        if self._refresh is None:
+            return config_pytomo.REDIRECT_CACHE_REFRESH
+        return self._refresh
+
+    def get(self, key):
+        'Return the chain cached for the key, None if missing'
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if not entry:
+                return None
+            chain, expiry = entry
+            if expiry < time.time():
+                return None
+            if self.refresh and random.random() < self.refresh:
+                config_pytomo.LOG.debug('Refresh redirect chain of %s',
+                                        (key,))
+                return None
+            # most recently used is last
+            self._entries[key] = entry
+            return list(chain)
+
+    def put(self, key, chain):
+        'Cache the redirect chain'
+        if not chain or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (list(chain), time.time() + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
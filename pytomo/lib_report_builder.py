@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""Module to build the reports of the web interface in background
+
+   The plots, html pages and pdfs of a database are regenerated by a single
+   worker thread, off the request path: the web server only asks for a
+   rebuild and serves the pages of the latest completed build.
+   The rebuilds of a database still written by a crawl are debounced: they
+   wait for REPORT_DEBOUNCE seconds without change in the database, but at
+   most REPORT_MAX_DELAY seconds.
+
+   Usage:
+       import pytomo.lib_report_builder as lib_report_builder
+       report_builder = lib_report_builder.ReportBuilder('databases')
+       report_builder.request('databases/pytomo.db')
+       report = report_builder.report('databases/pytomo.db', wait=60)
+       report.pages['DownloadTime']
+"""
+
+from __future__ import with_statement, absolute_import
+
+import os
+import threading
+import time
+from collections import namedtuple
+from itertools import chain
+from sqlite3 import Error
+
+try:
+    from . import config_pytomo
+except ValueError:
+    import config_pytomo
+try:
+    from .lib_rrdtools import refresh_pytomo_rrd
+except ValueError:
+    from lib_rrdtools import refresh_pytomo_rrd
+try:
+    from .lib_database import PytomoDatabase
+except ValueError:
+    from lib_database import PytomoDatabase
+try:
+    from .lib_io import ALL_PLOTS, ALL_KEY, LINKS_KEY, DB_KEY, DB_EXTENSION, \
+    get_latest_specific_file, write_index, index_filename
+except ValueError:
+    from lib_io import ALL_PLOTS, ALL_KEY, LINKS_KEY, DB_KEY, DB_EXTENSION, \
+    get_latest_specific_file, write_index, index_filename
+
+# rrd needs minimum 3 points to plot graphs
+RRD_MIN_NR_POINTS = 3
+
+# completed build of a database
+# timestamp: start time of the database (None if not enough points)
+# pages: parameter -> lines of its html page
+# built: end time of the build
+# db_mtime, archive: modification time of the database and latest database of
+# the archive when the build started
+# error: message of the failure of the latest build (None if it succeeded),
+# the pages are then the ones of the previous build (if any)
+Report = namedtuple('Report', ['timestamp', 'pages', 'built', 'db_mtime',
+                               'archive', 'error'])
+
+def get_mtime(file_name):
+    '''Return the modification time of the file, None if it does not exist
+    >>> get_mtime('/non/existent/file')
+    '''
+    try:
+        return os.path.getmtime(file_name)
+    except (OSError, TypeError):
+        return None
+
+def build_report(database, db_dir):
+    '''Generate the plots and the html pages of the database and return its
+    start time (None if it has not enough points to plot)'''
+    try:
+        db_nr_rows = PytomoDatabase(database).count_rows()
+    except Error, mes:
+        db_nr_rows = RRD_MIN_NR_POINTS - 1
+        config_pytomo.LOG.error('Unable to extract data with error: %s'
+                                % mes)
+    # if database is has less than 3 points no graphs will be created
+    # (rrd limitation)
+    if db_nr_rows < RRD_MIN_NR_POINTS:
+        config_pytomo.LOG.warning('Database %s does not have enough points'
+                                  ' to create graphs' % database)
+        timestamp = None
+    else:
+        try:
+            timestamp = PytomoDatabase(database).fetch_start_time()
+        except Error, mes:
+            timestamp = None
+            config_pytomo.LOG.error('Unable to extract data with error:'
+                                    '%s' % mes)
+        config_pytomo.LOG.debug('RRD operations start...')
+        refresh_pytomo_rrd(database)
+        config_pytomo.LOG.debug('RRD operations end...')
+    write_index(timestamp, database, db_dir)
+    return timestamp
+
+def read_pages(timestamp):
+    'Return a dict of the lines of the html pages of each parameter'
+    pages = {}
+    for param in chain(ALL_PLOTS.keys(), ALL_PLOTS[ALL_KEY],
+                       [LINKS_KEY, DB_KEY]):
+        try:
+            with open(index_filename(param, timestamp), 'r') as f_index:
+                pages[param] = f_index.readlines()
+        except IOError:
+            config_pytomo.LOG.error('Template file of %s does not exist!'
+                                    % param)
+    return pages
+
+class ReportBuilder(object):
+    '''Background worker rebuilding the reports of the requested databases
+    At most one rebuild runs at a time.
+    >>> def failing_build(database, db_dir):
+    ...     raise ValueError('no data')
+    >>> report_builder = ReportBuilder('/non/existent', build=failing_build)
+    >>> report_builder.request('/non/existent/pytomo.db')
+    >>> report = report_builder.report('/non/existent/pytomo.db', wait=60)
+    >>> report.error, report.pages
+    ('no data', {})
+    '''
+
+    def __init__(self, db_dir, build=build_report):
+        self.db_dir = db_dir
+        self._build = build
+        # database -> latest completed Report
+        self._reports = dict()
+        # database -> time of the first request not yet served
+        self._pending = dict()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def report(self, database, wait=0):
+        '''Return the latest completed Report of the database, None if there
+        is none
+        If no build has completed yet, wait at most wait seconds for it.'''
+        deadline = time.time() + wait
+        with self._condition:
+            while database not in self._reports:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            return self._reports[database]
+
+    def is_outdated(self, database):
+        'Return True if the database changed since its latest report'
+        report = self._reports.get(database)
+        return (report is None
+                or get_mtime(database) != report.db_mtime
+                or self.archive_mtime() != report.archive)
+
+    def archive_mtime(self):
+        'Return the modification time of the latest database of the archive'
+        return get_mtime(get_latest_specific_file(self.db_dir, DB_EXTENSION))
+
+    def request(self, database):
+        'Ask for a rebuild of the database report if it is outdated'
+        if not self.is_outdated(database):
+            return
+        with self._condition:
+            self._pending.setdefault(database, time.time())
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run,
+                                                name='ReportBuilder')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify_all()
+
+    def _next_database(self):
+        '''Wait for a database to rebuild and return it once its debounce
+        time is over'''
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                # oldest request first
+                database, since = min(self._pending.items(),
+                                      key=lambda item: item[1])
+                if database not in self._reports:
+                    # nothing to serve yet: do not delay the first build
+                    del self._pending[database]
+                    return database
+                now = time.time()
+                db_age = now - (get_mtime(database) or 0)
+                delay = min(config_pytomo.REPORT_DEBOUNCE - db_age,
+                            config_pytomo.REPORT_MAX_DELAY - (now - since))
+                if delay <= 0:
+                    del self._pending[database]
+                    return database
+                # database still written by the crawl
+                self._condition.wait(delay)
+
+    def _run(self):
+        'Rebuild the requested reports one at a time'
+        while True:
+            database = self._next_database()
+            if not self.is_outdated(database):
+                continue
+            db_mtime = get_mtime(database)
+            archive = self.archive_mtime()
+            start = time.time()
+            try:
+                timestamp = self._build(database, self.db_dir)
+                pages = read_pages(timestamp)
+            except Exception, mes:
+                config_pytomo.LOG.exception('Unable to build the report of '
+                                            '%s: %s' % (database, mes))
+                # the waiting requests are answered at once, and the build
+                # is not retried until the database changes
+                with self._condition:
+                    previous = self._reports.get(database)
+                    if previous:
+                        failed = previous._replace(db_mtime=db_mtime,
+                                                   archive=archive,
+                                                   error=str(mes))
+                    else:
+                        failed = Report(None, dict(), time.time(), db_mtime,
+                                        archive, str(mes))
+                    self._reports[database] = failed
+                    self._condition.notify_all()
+                continue
+            with self._condition:
+                self._reports[database] = Report(timestamp, pages,
+                                                 time.time(), db_mtime,
+                                                 archive, None)
+                self._condition.notify_all()
+            config_pytomo.LOG.debug('Report of %s built in %.2fs'
+                                    % (database, time.time() - start))
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
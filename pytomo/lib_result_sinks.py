@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""Module to store the stats of the crawl in background
+
+   The stats of a video are formatted once into typed rows (StatsRow) and
+   handed to each sink of the result pipeline: the database, the result
+   file and the snmp tables.
+   Each sink has its own bounded queue and thread, so that a slow sink
+   (disk, snmp walks) does not delay the next measurement. The sinks
+   keeping the results (database, result file) block the crawl only when
+   their queue is full, the live sinks (snmp) drop the rows instead.
+   A new sink only has to implement write(rows) and be added to the list
+   given to the pipeline.
+
+   Usage:
+       import pytomo.lib_result_sinks as lib_result_sinks
+       pipeline = lib_result_sinks.ResultPipeline(format_rows,
+                                [lib_result_sinks.DatabaseSink(data_base),
+                                 lib_result_sinks.ResultStreamSink(
+                                                            result_stream)])
+       pipeline.start()
+       pipeline.add_stats(stats, cache_server_delay, url)
+       pipeline.wait()
+       pipeline.close()
+"""
+
+from __future__ import with_statement, absolute_import
+
+import threading
+import Queue
+
+from . import config_pytomo
+from .lib_crawl_pool import join_thread
+from .lib_timing import TIMINGS
+from .lib_result_stream import ROW_FIELDS, StatsRow
+
+class Sink(threading.Thread):
+    '''Thread writing the rows queued for a single destination
+    Subclasses implement write(rows) and may implement flush() (called when
+    the queue is empty) and close_sink() (called after the last rows).
+    If blocking is False, the rows are dropped when the queue is full.
+    The writes are timed as the phase of the sink.
+    >>> sink = _DocSink()
+    >>> sink.start()
+    >>> sink.put([StatsRow._make(xrange(len(ROW_FIELDS)))])
+    >>> sink.wait()
+    >>> [(row.ID, row.StatusCode) for row in sink.rows]
+    [(0, 28)]
+    >>> sink.close()
+    '''
+    blocking = True
+    phase = 'sink'
+
+    def __init__(self, max_pending=None, name=None):
+        threading.Thread.__init__(self, name=name or type(self).__name__)
+        self.daemon = True
+        if max_pending is None:
+            max_pending = config_pytomo.SINK_QUEUE_SIZE
+        self._queue = Queue.Queue(max_pending)
+        self.dropped = 0
+
+    def put(self, rows):
+        'Queue the rows to be written by the sink thread'
+        try:
+            self._queue.put(rows, self.blocking)
+        except Queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                config_pytomo.LOG.warn('%s is late: %d stats dropped',
+                                       self.name, self.dropped)
+
+    def write(self, rows):
+        'Write the rows to the destination'
+        raise NotImplementedError
+
+    def flush(self):
+        'Hook called when no rows are pending'
+        pass
+
+    def close_sink(self):
+        'Hook called once all the rows are written'
+        pass
+
+    def run(self):
+        while True:
+            rows = self._queue.get()
+            try:
+                if rows is None:
+                    self.close_sink()
+                    break
+                with TIMINGS.span(self.phase):
+                    self.write(rows)
+                if self._queue.empty():
+                    self.flush()
+            except Exception, mes:
+                # the sink must survive to write the next rows
+                config_pytomo.LOG.exception('%s unable to write stats: %s',
+                                            self.name, mes)
+            finally:
+                self._queue.task_done()
+
+    def wait(self):
+        'Wait until the rows queued are written'
+        self._queue.join()
+
+    def close(self):
+        'Write the pending rows and stop the thread'
+        if self.is_alive():
+            self._queue.put(None)
+            join_thread(self)
+
+class DatabaseSink(Sink):
+    '''Insert the rows in the crawl table of the PytomoDatabase
+    The batch of the database is committed whenever no rows are pending.'''
+    phase = 'db_insert'
+
+    def __init__(self, data_base, max_pending=None):
+        Sink.__init__(self, max_pending)
+        self.data_base = data_base
+
+    def write(self, rows):
+        self.data_base.insert_records(rows)
+
+    def flush(self):
+        self.data_base.flush()
+
+    def close_sink(self):
+        self.data_base.flush()
+
+class ResultStreamSink(Sink):
+    'Write the rows in the result file (lib_result_stream.RecordWriter)'
+    phase = 'result_file'
+
+    def __init__(self, result_stream, max_pending=None):
+        Sink.__init__(self, max_pending)
+        self.result_stream = result_stream
+
+    def write(self, rows):
+        self.result_stream.write(rows)
+
+    def close_sink(self):
+        self.result_stream.flush()
+
+class SnmpSink(Sink):
+    '''Register the rows in the snmp tables
+    url_rows is a lib_snmp_tables.WindowedRows, ip_counts and as_counts are
+    lib_snmp_tables.RollingCounter.
+    The timings of the phases are exported in phase_tables (list of the
+    (table, snmp type) of the name, count, total, mean and max columns).'''
+    blocking = False
+    phase = 'snmp_update'
+
+    def __init__(self, url_rows, ip_counts, as_counts, phase_tables=None,
+                 max_pending=None):
+        Sink.__init__(self, max_pending)
+        self.url_rows = url_rows
+        self.ip_counts = ip_counts
+        self.as_counts = as_counts
+        self.phase_tables = phase_tables
+
+    def write(self, rows):
+        for row in rows:
+            self.url_rows.register(row.Url, snmp_values(row))
+            self.ip_counts.add(row.IP)
+            self.as_counts.add(str(row.ASNumber))
+
+    def flush(self):
+        'Export the timings of the phases (from this thread)'
+        if not self.phase_tables:
+            return
+        for phase, values in TIMINGS.snmp_values():
+            for (table, snmp_type), value in zip(self.phase_tables,
+                                                 [phase] + values):
+                table.registerValue(phase, snmp_type, value)
+
+def snmp_values(row):
+    'Return the (snmp type, value) of each column of the snmp url tables'
+    hebexsnmptools = config_pytomo.hebexsnmptools
+    values = []
+    for snmp_type, idx in zip(config_pytomo.snmp_types,
+                              config_pytomo.STATS_IDX):
+        value = row[idx]
+        if snmp_type == hebexsnmptools.ASN_GAUGE:
+            value = int(value * 1000 if value else 0)
+        elif snmp_type == hebexsnmptools.ASN_INTEGER:
+            value = value if value else 0
+        elif idx == config_pytomo.TS_IDX:
+            value = value.strftime('%Y%m%d %H:%M:%S')
+        else:
+            value = value if value else ''
+        values.append((snmp_type, value))
+    return values
+
+class ResultPipeline(object):
+    '''Format the stats once and fan the rows out to the sinks
+    format_rows(stats, cache_server_delay, url) returns the list of
+    StatsRow of the stats; it is called under a lock so that the rows reach
+    all the sinks in the same order.
+    >>> sinks = [_DocSink(), _DocSink()]
+    >>> pipeline = ResultPipeline(lambda stats, delay, url: [url], sinks)
+    >>> pipeline.start()
+    >>> pipeline.add_stats(None, 0, 'http://youtu.be/a')
+    >>> pipeline.add_stats(None, 0, 'http://youtu.be/b')
+    >>> pipeline.close()
+    >>> [sink.rows for sink in sinks] #doctest: +NORMALIZE_WHITESPACE
+    [['http://youtu.be/a', 'http://youtu.be/b'],
+     ['http://youtu.be/a', 'http://youtu.be/b']]
+    '''
+
+    def __init__(self, format_rows, sinks):
+        self._format_rows = format_rows
+        self.sinks = list(sinks)
+        self._lock = threading.Lock()
+
+    def start(self):
+        'Start the thread of each sink'
+        for sink in self.sinks:
+            sink.start()
+
+    def add_stats(self, stats, cache_server_delay, url):
+        'Format the stats and queue the rows to each sink'
+        with self._lock:
+            rows = self._format_rows(stats, cache_server_delay, url)
+            if not rows:
+                return
+            for sink in self.sinks:
+                sink.put(rows)
+
+    def wait(self):
+        'Wait until the stats added are written by all the sinks'
+        for sink in self.sinks:
+            sink.wait()
+
+    def close(self):
+        'Write the pending stats and stop the sinks'
+        for sink in self.sinks:
+            sink.close()
+
+class _DocSink(Sink):
+    'Sink keeping the rows in a list for the doctests'
+
+    def __init__(self):
+        Sink.__init__(self, max_pending=10)
+        self.rows = []
+
+    def write(self, rows):
+        self.rows.extend(rows)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
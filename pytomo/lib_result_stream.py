@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""Module to write and read the result files of the crawl
+
+   The result file has one line per record of the crawl table (a JSON
+   array of the values of the StatsRow fields), after a header line (a JSON
+   object) giving the version of the format and the fields. A file can hold
+   several headers (crawls appended to the same file).
+   The timestamps (ID) are written as in the database:
+   'YYYY-MM-DD HH:MM:SS.ffffff'.
+   The lines are buffered and written when RESULT_BUFFER_SIZE bytes are
+   pending or RESULT_FLUSH_PERIOD seconds after the previous write. The files
+   whose name ends with .gz are compressed on the fly.
+
+   Usage:
+       import pytomo.lib_result_stream as lib_result_stream
+       result_stream = lib_result_stream.RecordWriter('pytomo.jsonl.gz')
+       result_stream.write(rows)
+       result_stream.close()
+       for row in lib_result_stream.read_records('pytomo.jsonl.gz'):
+           print row.Url, row.DownloadTime
+"""
+
+from __future__ import with_statement, absolute_import
+
+import datetime
+import gzip
+import json
+import time
+from collections import namedtuple
+
+from . import config_pytomo
+
+FORMAT_NAME = 'pytomo_results'
+FORMAT_VERSION = 1
+GZIP_EXTENSION = '.gz'
+# a record of the crawl table (one per IP address of the stats)
+ROW_FIELDS = ['ID', 'Service', 'Url', 'CacheUrl', 'CacheServerDelay', 'IP',
+              'Resolver', 'ResolveTime', 'ASNumber', 'PingMin', 'PingAvg',
+              'PingMax', 'DownloadTime', 'VideoType', 'VideoDuration',
+              'VideoLength', 'EncodingRate', 'DownloadBytes',
+              'DownloadInterruptions', 'InitialData', 'InitialRate',
+              'InitialPlaybackBuffer', 'BufferingDuration',
+              'PlaybackDuration', 'BufferDurationAtEnd', 'TimeTogetFirstByte',
+              'MaxInstantThp', 'RedirectUrl', 'StatusCode']
+StatsRow = namedtuple('StatsRow', ROW_FIELDS)
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def open_stream(file_name, mode='rb'):
+    'Open the result file, compressed if its name ends with GZIP_EXTENSION'
+    if file_name.endswith(GZIP_EXTENSION):
+        return gzip.open(file_name, mode)
+    return open(file_name, mode)
+
+def encode_value(value):
+    'Return the JSON value of the field (the timestamps as strings)'
+    if isinstance(value, datetime.datetime):
+        return str(value)
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+def parse_timestamp(value):
+    '''Return the datetime of the timestamp written by encode_value
+    >>> parse_timestamp('2011-05-06 15:30:50.103775')
+    datetime.datetime(2011, 5, 6, 15, 30, 50, 103775)
+    >>> parse_timestamp('2011-05-06 15:30:50')
+    datetime.datetime(2011, 5, 6, 15, 30, 50)
+    '''
+    if value is None:
+        return None
+    seconds, _, micro = value.partition('.')
+    timestamp = datetime.datetime.strptime(seconds, TIME_FORMAT)
+    if micro:
+        timestamp = timestamp.replace(microsecond=int(micro.ljust(6, '0')))
+    return timestamp
+
+class RecordWriter(object):
+    '''Buffered writer of the records in the result file (or stream)
+    The header is written before the first records.
+    >>> import StringIO
+    >>> stream = StringIO.StringIO()
+    >>> result_stream = RecordWriter(stream)
+    >>> row = StatsRow._make([datetime.datetime(2011, 5, 6, 15, 30, 50)]
+    ...                      + [None] * (len(ROW_FIELDS) - 2) + [200])
+    >>> result_stream.write([row, row._replace(Url='http://youtu.be/a')])
+    >>> stream.getvalue()
+    ''
+    >>> result_stream.flush()
+    >>> rows = list(read_records(StringIO.StringIO(stream.getvalue()),
+    ...                          parse_dates=True))
+    >>> rows[1].ID, rows[1].Url, rows[1].StatusCode
+    (datetime.datetime(2011, 5, 6, 15, 30, 50), u'http://youtu.be/a', 200)
+    >>> len(stream.getvalue().splitlines())
+    3
+    '''
+
+    def __init__(self, result_file, buffer_size=None, flush_period=None):
+        if isinstance(result_file, basestring):
+            self.stream = open_stream(result_file, 'ab')
+        else:
+            self.stream = result_file
+        self.buffer_size = buffer_size or config_pytomo.RESULT_BUFFER_SIZE
+        if flush_period is None:
+            flush_period = config_pytomo.RESULT_FLUSH_PERIOD
+        self.flush_period = flush_period
+        self._lines = []
+        self._pending = 0
+        self._last_flush = time.time()
+        self._header = False
+
+    def write(self, rows):
+        'Buffer the lines of the rows and write them if needed'
+        if not self._header:
+            self._append(json.dumps({'format': FORMAT_NAME,
+                                     'version': FORMAT_VERSION,
+                                     'fields': ROW_FIELDS},
+                                    separators=(',', ':')))
+            self._header = True
+        for row in rows:
+            self._append(json.dumps(row, default=encode_value,
+                                    separators=(',', ':')))
+        if (self._pending >= self.buffer_size
+            or time.time() - self._last_flush >= self.flush_period):
+            self.flush()
+
+    def _append(self, line):
+        'Buffer the line'
+        self._lines.append(line)
+        self._lines.append('\n')
+        self._pending += len(line) + 1
+
+    def flush(self):
+        'Write the buffered lines in the file'
+        if self._lines:
+            self.stream.write(''.join(self._lines))
+            self._lines = []
+            self._pending = 0
+        self.stream.flush()
+        self._last_flush = time.time()
+
+    def close(self):
+        'Write the buffered lines and close the file'
+        self.flush()
+        self.stream.close()
+
+def read_records(result_file, parse_dates=False):
+    '''Iterate on the records of the result file (or stream) as StatsRow
+    The ID are kept as strings (they sort in time order) unless parse_dates
+    is set. The file is read line by line: it is never loaded in memory.'''
+    if isinstance(result_file, basestring):
+        stream = open_stream(result_file, 'rb')
+    else:
+        stream = result_file
+    try:
+        positions = None
+        for line in stream:
+            if line.startswith('['):
+                values = json.loads(line)
+                if positions:
+                    values = [values[position] if position is not None
+                              else None for position in positions]
+                elif positions is None:
+                    raise ValueError('Record before the header in %s'
+                                     % result_file)
+                row = StatsRow._make(values)
+                if parse_dates:
+                    row = row._replace(ID=parse_timestamp(row.ID))
+                yield row
+            elif line.startswith('{'):
+                header = json.loads(line)
+                if (header.get('format') != FORMAT_NAME
+                    or header.get('version') != FORMAT_VERSION):
+                    raise ValueError('Unknown result format: %s %s'
+                                     % (header.get('format'),
+                                        header.get('version')))
+                # position of each field in the records of this crawl (empty
+                # if the fields are the same)
+                fields = header['fields']
+                positions = []
+                if fields != ROW_FIELDS:
+                    positions = [fields.index(field) if field in fields
+                                 else None for field in ROW_FIELDS]
+    finally:
+        if stream is not result_file:
+            stream.close()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -70,6 +70,7 @@ else:
               'For RHEL based systems: sudo yum install python-rrdtool\n')
 import time
 import math
+import threading
 from optparse import OptionParser
 from operator import itemgetter
 # only for logging
@@ -94,10 +95,12 @@ except ValueError:
 # file operations
 try:
     from .lib_io import TIMESTAMP_POSITION, NO_DB_RECORDS_UNITS, \
-    get_latest_file, rrd_filename, plot_filename
+    get_latest_file, rrd_filename, plot_filename, \
+    run_parallel, file_signature
 except ValueError:
     from lib_io import TIMESTAMP_POSITION, NO_DB_RECORDS_UNITS, \
-    get_latest_file, rrd_filename, plot_filename
+    get_latest_file, rrd_filename, plot_filename, \
+    run_parallel, file_signature
 
 # RRD parameters
 # RRD syncronise interval in seconds (plot cannot start exactly at start)
@@ -183,6 +186,21 @@ KILO_TRANS = 1000
 # easier to tranform rates to kbps
 KBPS_TRANS = 8e-3
 
+# maximum nb of samples given to each rrdtool.update call
+RRD_UPDATE_BATCH = 100
+# the RRA is sized for this factor times the time span of the data so that the
+# next updates fit in the same rrd (it is rebuilt when full)
+RRD_CAPACITY_FACTOR = 2
+
+def render_graph(graph):
+    '''Plot the graph of the rrdtool.graph arguments: return None if plotted,
+    the error message otherwise (run in the processes of the pool)'''
+    try:
+        rrdtool.graph(*graph)
+    except rrdtool.error, mes:
+        return str(mes)
+    return None
+
 def create_DS_types(parameters, heartbeat):
     '''Function to return a list of elements 'DS:ds-name:GAUGE:heartbeat:U:U'
     >>> HEARTBEAT = 100
@@ -270,9 +288,14 @@ def rrd_filename_escape_colon(rrd_file):
 
 class PytomoRRD:
     '''Pytomo class to interact with rrdtools
+    The rrd is maintained incrementally: refresh only reads the rows recorded
+    after the last one fed and update_pytomo_rrd appends them to the existing
+    rrd file.
     '''
 
     has_values = None
+    # inputs of the latest plots
+    plot_signature = None
 
     def __init__(self, db_file):
         '''Get the data and create the RRD (Round Robin Database).
@@ -295,44 +318,73 @@ class PytomoRRD:
         RRA CF-arguments: rra_rows - how many generations of data values are
             kept in an RRA; the CF is computed during
             (RRD_STEP * RRA_POINTS_AVG) * self.rra_rows (= total time plotted)
+        If the rrd file of the database already exists and can hold its data,
+        it is reused and only the rows after its last update are fed.
         '''
         # Intialize the logger for standalone testing Logging
         if not config_pytomo.LOG:
             self.logger_rrd()
         config_pytomo.LOG.info('=' * NR_REPEAT)
         config_pytomo.LOG.info("Parameters plotted by rrd: %s", PARAMETERS)
-        # retrieve desired data from the database in a list of tuples
+        self.db_file = db_file
+        self.load_pytomo_rrd()
+
+    def fetch_rows(self, since_rowid=None):
+        '''Return the rows of the database inserted after since_rowid (all
+        the rows if None), the epoch of their timestamps and the rowid of the
+        last row inserted, None on error'''
         try:
-            self.data = lib_database.PytomoDatabase(db_file).\
-                        fetch_all_parameters(PARAMETERS)
+            fetched = lib_database.PytomoDatabase(self.db_file).\
+                        fetch_new_parameters(PARAMETERS, since_rowid)
         except Error, mes:
             config_pytomo.LOG.error('Unable to extract data %s with  error:'
                                     '%s' % (str(PARAMETERS), mes))
+            return None
+        if fetched is None:
+            return None
+        rows, last_rowid = fetched
+        # the timestamp is the last element of each tuple in the data list
+        timestamps = map(lib_database.time_to_epoch,
+                                map(itemgetter(TIMESTAMP_POSITION), rows))
+        return rows, timestamps, last_rowid
+
+    def load_pytomo_rrd(self, reuse=True):
+        '''Read all the data of the database and create the rrd (or reuse the
+        existing one if reuse is set)'''
+        # pending rows to feed in the rrd and the epoch of their timestamps
+        self.data = []
+        self.timestamps = []
+        # rowid of the last row read from the database
+        self.last_rowid = None
+        # epoch of the last sample fed in the rrd
+        self.last_update = None
+        # number of unknown (None) values in the dataset for each parameter
+        self.unknown_values = [0] * len(PARAMETERS)
+        # retrieve desired data from the database in a list of tuples
+        fetched = self.fetch_rows()
+        if fetched is None:
             return
+        self.data, self.timestamps, self.last_rowid = fetched
         config_pytomo.LOG.info(' '.join(("Retrieved data for rrd.",
-                                "From database: ", os.path.basename(db_file))))
+                        "From database: ", os.path.basename(self.db_file))))
         # if no data is extracted from sqlite, no other operation is performed
         if not self.data:
             self.has_values = False
             config_pytomo.LOG.warn('No data could be extracted from the '
                                     '%s for the parameters: %s' %
-                                (os.path.basename(db_file), PARAMETERS))
+                                (os.path.basename(self.db_file), PARAMETERS))
             return
         # if there is only one point in the data, rrdtool cannot plot
         if len(self.data) == 1:
             self.has_values = False
             config_pytomo.LOG.warn('Only one point could be extracted from the '
                                     '%s for the parameters: %s' %
-                                (os.path.basename(db_file), str(PARAMETERS)))
+                            (os.path.basename(self.db_file), str(PARAMETERS)))
             return
         self.has_values = True
         #config_pytomo.LOG.debug("Data: %s", str(self.data))
-        # number of unknown (None) values in the dataset for each parameter
-        self.unknown_values = [0] * len(PARAMETERS)
-        # all the timestamps in the database
-        timestamps = map(lib_database.time_to_epoch,
-                                map(itemgetter(TIMESTAMP_POSITION), self.data))
-        # the timestamp is the last element of each tuple in the data list
+        self.count_unknown_values(self.data)
+        timestamps = self.timestamps
         # start time is the minimum timestamp (epoch) from the db - sync time
         self.start_time = timestamps[0] - RRD_PLOT_SYNC_TIME
         config_pytomo.LOG.debug("Start time rrd: %i", self.start_time)
@@ -346,15 +398,12 @@ class PytomoRRD:
         # when time changes in winter the clock goes back 1h, difference is < 1s
         min_time_diff = min(timestamp_dif) - RRD_STEP_SYNC_TIME
         if min_time_diff < 1:
-            RRD_STEP = 1
+            self.rrd_step = 1
         else:
-            RRD_STEP = min_time_diff
+            self.rrd_step = min_time_diff
         # time interval in seconds after which data is considered Unknown
         # maximum time difference between the data inserted
-        RRD_HEARTBEAT = max(timestamp_dif) + RRD_STEP_SYNC_TIME
-        # create the Data Sources for the rrd
-        self.data_sources = create_DS_types(PARAMETERS, RRD_HEARTBEAT)
-        config_pytomo.LOG.debug("Data sources: %s", self.data_sources)
+        self.heartbeat = max(timestamp_dif) + RRD_STEP_SYNC_TIME
         # rrd file has the first db time to epoch timestamp
         # RRA number of data generations kept
         try:
@@ -362,9 +411,54 @@ class PytomoRRD:
         except IOError:
             self.rrd_file = None
             config_pytomo.LOG.error("Could not get rrd file")
+        # image files have the first db time to epoch timestamp
+        self.rrd_plot_files = generate_plot_names(ALL_PARAM, timestamps[0])
+        if not reuse or not self.reuse_rrd():
+            self.create_rrd()
+
+    def reuse_rrd(self):
+        '''Take over the existing rrd file of the database if it has all the
+        data sources and can hold all the data: return True if reused'''
+        if not self.rrd_file or not os.path.exists(self.rrd_file):
+            return False
+        try:
+            info = rrdtool.info(self.rrd_file)
+            last_update = rrdtool.last(self.rrd_file)
+        except rrdtool.error, mes:
+            config_pytomo.LOG.debug('Could not read rrd %s: %s' %
+                                    (self.rrd_file, mes))
+            return False
+        rrd_step = info.get('step')
+        rra_rows = info.get('rra[0].rows')
+        heartbeats = [info.get('ds[%s].minimal_heartbeat' %
+                               parameter[:DS_NAME_MAX_LENGTH])
+                      for parameter in PARAMETERS]
+        if (not rrd_step or not rra_rows or None in heartbeats
+                or last_update < self.start_time
+                or (self.end_time - self.start_time) > rrd_step * rra_rows):
+            config_pytomo.LOG.debug('Rrd %s cannot be reused' %
+                                    os.path.basename(self.rrd_file))
+            return False
+        self.rrd_step = rrd_step
+        self.rra_rows = rra_rows
+        self.heartbeat = max(self.heartbeat, min(heartbeats))
+        self.tune_heartbeat(min(heartbeats))
+        self.last_update = last_update
+        config_pytomo.LOG.info(' '.join(("Reused rrd: ",
+                                            os.path.basename(self.rrd_file))))
+        return True
+
+    def create_rrd(self):
+        '''Create the rrd file sized for RRD_CAPACITY_FACTOR times the time
+        span of the data'''
+        # create the Data Sources for the rrd
+        self.data_sources = create_DS_types(PARAMETERS, self.heartbeat)
+        config_pytomo.LOG.debug("Data sources: %s", self.data_sources)
         # (RRD_STEP * RRA_POINTS_AVG) * self.rra_rows = total time plotted
-        self.rra_rows = math.ceil((self.end_time - self.start_time) /
-                                    RRD_STEP * RRA_POINTS_AVG)
+        # extra rows are kept for the next updates
+        self.rra_rows = math.ceil(RRD_CAPACITY_FACTOR *
+                                  (self.end_time - self.start_time) /
+                                  self.rrd_step * RRA_POINTS_AVG)
         # if there is only one database entry or if the time difference between
         # start, end is too small, there might be no generation of data kept
         if self.rra_rows < 1:
@@ -376,7 +470,7 @@ class PytomoRRD:
         # (min/max of 3 points for a specific interval, for example)
         rrdtool.create(self.rrd_file,
                         '--start', '%i' % self.start_time,
-                        '--step', '%i' % RRD_STEP,
+                        '--step', '%i' % self.rrd_step,
                         self.data_sources,
                         'RRA:%s:%f:%i:%i' %
                                     (CF_AVG, RRA_U_PERCENTAGE, RRA_POINTS_AVG,
@@ -394,14 +488,76 @@ class PytomoRRD:
         #                            (CF_LAST, RRA_U_PERCENTAGE, RRA_POINTS_LAST,
         #                                self.rra_rows)
                         )
+        self.last_update = None
         config_pytomo.LOG.info(' '.join(("Created rrd: ",
                                             os.path.basename(self.rrd_file))))
-        # image files have the first db time to epoch timestamp
-        self.rrd_plot_files = generate_plot_names(ALL_PARAM, timestamps[0])
+
+    def tune_heartbeat(self, current_heartbeat):
+        '''Set the heartbeat of the data sources of the rrd if it is larger
+        than current_heartbeat'''
+        if self.heartbeat <= current_heartbeat:
+            return
+        try:
+            rrdtool.tune(self.rrd_file, *['--heartbeat=%s:%i' %
+                            (parameter[:DS_NAME_MAX_LENGTH], self.heartbeat)
+                                          for parameter in PARAMETERS])
+        except rrdtool.error, mes:
+            config_pytomo.LOG.debug('Could not tune the rrd with error %s'
+                                    % mes)
+
+    def count_unknown_values(self, rows):
+        'Add the unknown (None) values of the rows to self.unknown_values'
+        for row in rows:
+            for index, parameter in enumerate(row[:TIMESTAMP_POSITION]):
+                if parameter is None:
+                    self.unknown_values[index] += 1
+
+    def refresh(self):
+        '''Read the rows recorded in the database since the last call and
+        return their number
+        The rrd is rebuilt if it cannot hold the new rows.'''
+        if not self.has_values:
+            self.load_pytomo_rrd()
+            return len(self.data)
+        fetched = self.fetch_rows(since_rowid=self.last_rowid)
+        if not fetched or not fetched[0]:
+            return 0
+        rows, timestamps, last_rowid = fetched
+        end_time = timestamps[-1] + RRD_PLOT_SYNC_TIME
+        if end_time - self.start_time > self.rrd_step * self.rra_rows:
+            config_pytomo.LOG.info('Rrd %s is full: rebuild it' %
+                                   os.path.basename(self.rrd_file))
+            self.load_pytomo_rrd()
+            return len(self.data)
+        previous = (self.timestamps[-1:] or
+                    ([self.last_update] if self.last_update else []))
+        if previous and timestamps[0] < previous[-1]:
+            # row inserted after a later measurement (several workers): the
+            # rrd only accepts increasing timestamps
+            config_pytomo.LOG.info('Rrd %s has later rows than the new ones: '
+                                   'rebuild it' %
+                                   os.path.basename(self.rrd_file))
+            self.load_pytomo_rrd(reuse=False)
+            return len(self.data)
+        self.count_unknown_values(rows)
+        self.last_rowid = last_rowid
+        self.end_time = end_time
+        all_timestamps = previous + timestamps
+        current_heartbeat = self.heartbeat
+        self.heartbeat = max([self.heartbeat] +
+                             [abs(a - b) + RRD_STEP_SYNC_TIME for a, b in
+                              zip(all_timestamps, all_timestamps[1:])])
+        self.tune_heartbeat(current_heartbeat)
+        self.data.extend(rows)
+        self.timestamps.extend(timestamps)
+        config_pytomo.LOG.debug('Read %i new rows for rrd' % len(rows))
+        return len(rows)
 
     def update_pytomo_rrd(self):
-        '''Insert data from the list of tuples (timestamp, parameter1, ...)
-        to the rrd.
+        '''Insert the pending data from the list of tuples (timestamp,
+        parameter1, ...) to the rrd.
+        The samples are given by RRD_UPDATE_BATCH in each rrdtool.update call;
+        the samples not after the last update of the rrd are skipped.
         '''
         if not self.has_values:
             config_pytomo.LOG.warn('RRD data update aborted')
@@ -409,30 +565,32 @@ class PytomoRRD:
         # insert into rrd all the values for the extracted parameters to plot
         # data[][TIMESTAMP_POSITION] is the timestamp
         # data[][:TIMESTAMP_POSITION] represents the parameters to plot
-        for row in self.data:
-            # transform timestamp to epoch in local time
+        sample_format = update_data_types(PARAMETERS)
+        samples = []
+        for row, timestamp in zip(self.data, self.timestamps):
+            # rrdtool only accepts increasing timestamps
             # TODO: check problems related to timezone
-            timestamp = row[TIMESTAMP_POSITION]
-            parameter_values = row[:TIMESTAMP_POSITION]
-            # function used in order to take advantage of the * operator and
-            # retrieve all the elements of an argument
-            identity = lambda *x: x
+            if self.last_update is not None and timestamp <= self.last_update:
+                continue
+            self.last_update = timestamp
+            samples.append(sample_format % ((timestamp,) +
+                        tuple(format_null_values(*row[:TIMESTAMP_POSITION]))))
+        for index in xrange(0, len(samples), RRD_UPDATE_BATCH):
+            batch = samples[index:index + RRD_UPDATE_BATCH]
             try:
-                rrdtool.update(self.rrd_file,
-                                update_data_types(parameter_values) %
-                                identity(lib_database.time_to_epoch(timestamp),
-                                    *format_null_values(*parameter_values)))
+                rrdtool.update(self.rrd_file, *batch)
             except rrdtool.error, mes:
                 config_pytomo.LOG.debug('Could not update the rrd with error'
-                                        ' %s' % mes)
-                continue
-            #config_pytomo.LOG.debug('Updated rrd data: (%s, %s)' %
-            #       (timestamp, str(format_null_values(*parameter_values))))
-            for index, parameter in enumerate(parameter_values):
-                if parameter is None:
-                    self.unknown_values[index] += 1
-                    #config_pytomo.LOG.debug('Updated unknown[%i]' %
-                    #                       index)
+                                        ' %s: update sample by sample' % mes)
+                for sample in batch:
+                    try:
+                        rrdtool.update(self.rrd_file, sample)
+                    except rrdtool.error, mes:
+                        config_pytomo.LOG.debug('Could not update the rrd '
+                                                'with error %s' % mes)
+        config_pytomo.LOG.debug('Fed %i samples in rrd' % len(samples))
+        self.data = []
+        self.timestamps = []
         config_pytomo.LOG.debug('Unknown values per parameter: %s' %
                                                     str(self.unknown_values))
 
@@ -457,6 +615,16 @@ class PytomoRRD:
         if not self.has_values:
             config_pytomo.LOG.warn('RRD data plot aborted')
             return 1
+        # the graphs only change with the data fed in the rrd
+        plot_signature = (self.rrd_file, self.last_update, self.start_time,
+                          self.end_time, tuple(self.unknown_values))
+        if (plot_signature == self.plot_signature
+                and all(signature and signature[1] for signature in
+                        map(file_signature, self.rrd_plot_files))):
+            config_pytomo.LOG.debug('RRD plots unchanged')
+            return
+        # arguments of the rrdtool.graph call of each plot
+        graphs = []
         # rrdtool graph does not accept ":" in the rrd filename path
         def_rrd_file = rrd_filename_escape_colon(self.rrd_file)
         # graphs that exist in db
@@ -477,7 +645,7 @@ class PytomoRRD:
             # all the points are plotted if RRA_POINTS_... = 1
             # to uncomment if other CF need to be applied on aggregated data
             # (min/max of 3 points for a specific interval, for example)
-            rrdtool.graph(self.rrd_plot_files[index],
+            graphs.append((self.rrd_plot_files[index],
                             '--start', '%i' % self.start_time,
                             '--end', '%i' % self.end_time,
                             '--vertical-label', '%s' % UNITS[parameter],
@@ -508,13 +676,10 @@ class PytomoRRD:
                             #    parameter[:DS_NAME_MAX_LENGTH], CF_LAST),
                             #'LINE%i:%s#%s:Last' % (RRD_PLOT_LINE,
                             #    RRD_PLOT_LAST_NAME, RRD_PLOT_LAST_COL)
-                            )
-            config_pytomo.LOG.info(' '.join(("The rrd plot was updated: ",
-                                os.path.basename(self.rrd_plot_files[index]))))
-            config_pytomo.LOG.info('=' * NR_REPEAT)
+                            ))
         # graph for average throughput:
         # avg_th [Kbps] = DownBytes [bytes] / DownTime [s] * 8 /1000
-        rrdtool.graph(self.rrd_plot_files[INDEX_DICT[AVG_TH_PARAM]],
+        graphs.append((self.rrd_plot_files[INDEX_DICT[AVG_TH_PARAM]],
                         '--start', '%i' % self.start_time,
                         '--end', '%i' % self.end_time,
                         '--vertical-label', '%s' %
@@ -542,13 +707,10 @@ class PytomoRRD:
                         'LINE%i:%s#%s' % (RRD_PLOT_LINE,
                                           AVG_TH_PARAM[:DS_NAME_MAX_LENGTH],
                                           RRD_PLOT_AVG_COL)
-                         )
-        config_pytomo.LOG.info(' '.join(("The rrd plot was updated: ",
-            os.path.basename(self.rrd_plot_files[INDEX_DICT[AVG_TH_PARAM]]))))
-        config_pytomo.LOG.info('=' * NR_REPEAT)
+                         ))
         # graph for indicator:
         # indicator = DownBytes[B] / DownTime[s] * 8 / 1000 / EncodingRate[kbps]
-        rrdtool.graph(self.rrd_plot_files[INDEX_DICT[INDICATOR_PARAM]],
+        graphs.append((self.rrd_plot_files[INDEX_DICT[INDICATOR_PARAM]],
                         '--start', '%i' % self.start_time,
                         '--end', '%i' % self.end_time,
                         '--vertical-label', '%s' %
@@ -580,13 +742,10 @@ class PytomoRRD:
                         'LINE%i:%s#%s' % (RRD_PLOT_LINE,
                                           INDICATOR_PARAM[:DS_NAME_MAX_LENGTH],
                                           RRD_PLOT_AVG_COL)
-                         )
-        config_pytomo.LOG.info(' '.join(("The rrd plot was updated: ",
-           os.path.basename(self.rrd_plot_files[INDEX_DICT[INDICATOR_PARAM]]))))
-        config_pytomo.LOG.info('=' * NR_REPEAT)
+                         ))
         # graph for magic parameter:
         # video_percentage = 1 IF DownInterruptions > 0, ELSE 0
-        rrdtool.graph(self.rrd_plot_files[INDEX_DICT[VIDEO_PERCENTAGE_PARAM]],
+        graphs.append((self.rrd_plot_files[INDEX_DICT[VIDEO_PERCENTAGE_PARAM]],
                         '--start', '%i' % self.start_time,
                         '--end', '%i' % self.end_time,
                         '--vertical-label', '%s' %
@@ -609,11 +768,17 @@ class PytomoRRD:
                         'LINE%i:%s#%s' % (RRD_PLOT_LINE_GENERALLY_ZERO,
                                     VIDEO_PERCENTAGE_PARAM[:DS_NAME_MAX_LENGTH],
                                     RRD_PLOT_AVG_COL)
-                         )
-        config_pytomo.LOG.info(' '.join(("The rrd plot was updated: ",
-            os.path.basename(self.rrd_plot_files[INDEX_DICT[AVG_TH_PARAM]]))))
-        config_pytomo.LOG.info('=' * NR_REPEAT)
-
+                         ))
+        # render the graphs in parallel
+        for graph, error in zip(graphs, run_parallel(render_graph, graphs)):
+            if error:
+                config_pytomo.LOG.error('Could not plot %s with error %s'
+                                        % (os.path.basename(graph[0]), error))
+                continue
+            config_pytomo.LOG.info(' '.join(("The rrd plot was updated: ",
+                                                os.path.basename(graph[0]))))
+            config_pytomo.LOG.info('=' * NR_REPEAT)
+        self.plot_signature = plot_signature
 
     @staticmethod
     def logger_rrd():
@@ -640,6 +805,26 @@ class PytomoRRD:
         handler.setFormatter(log_formatter)
         config_pytomo.LOG.addHandler(handler)
 
+# PytomoRRD of the databases already fed (key: database file)
+RRD_INSTANCES = {}
+RRD_INSTANCES_LOCK = threading.Lock()
+
+def refresh_pytomo_rrd(db_file):
+    '''Feed the new rows of the database in its rrd and plot it
+    The PytomoRRD of the database is kept between the calls so that the cost
+    depends on the data recorded since the previous call only.'''
+    with RRD_INSTANCES_LOCK:
+        pytomo_rrd = RRD_INSTANCES.get(db_file)
+        if pytomo_rrd is None:
+            pytomo_rrd = PytomoRRD(db_file)
+            RRD_INSTANCES[db_file] = pytomo_rrd
+        else:
+            pytomo_rrd.refresh()
+        pytomo_rrd.update_pytomo_rrd()
+        #pytomo_rrd.fetch_pytomo_rrd()
+        pytomo_rrd.plot_pytomo_rrd()
+    return pytomo_rrd
+
 def create_options(parser):
     ''' Add the different options to the parser'''
     parser.add_option('-v', '--verbose', dest='verbose',
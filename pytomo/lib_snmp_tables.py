@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""Module to keep the SNMP result tables bounded
+
+   The rows of the url tables are kept for the max_rows most recently
+   measured videos and for window seconds: older rows are evicted and their
+   oids removed from the SNMP dataset, so that the memory and the walks of a
+   probe looping for weeks stay bounded.
+   The nb of downloads per IP address and per AS is then counted on the same
+   window (a rolling count), and the rows of the addresses and AS not seen
+   in the window are removed too.
+   With neither max_rows nor window, the rows are kept and counted forever.
+
+   Usage:
+       import pytomo.lib_snmp_tables as lib_snmp_tables
+       url_rows = lib_snmp_tables.WindowedRows(url_tables, max_rows=1000)
+       url_rows.register(video_url, [(snmp_type, value), ...])
+       ip_counts = lib_snmp_tables.RollingCounter(ip_name_table, name_type,
+                                                  ip_count_table, count_type,
+                                                  max_events=1000)
+       ip_counts.add(video_ip)
+"""
+
+from __future__ import absolute_import
+
+import time
+from collections import OrderedDict, deque
+
+class WindowedRows(object):
+    '''Rows of SNMP tables indexed by the same key, kept for the max_rows
+    most recently registered keys and for window seconds (0 or None for no
+    limit)
+    The tables are hebexsnmptools.OidTable.
+    >>> tables = [_DocTable('Url'), _DocTable('IP')]
+    >>> url_rows = WindowedRows(tables, max_rows=2, window=60)
+    >>> url_rows.register('a', [(4, 'a'), (4, '1.1.1.1')], now=0)
+    >>> url_rows.register('b', [(4, 'b'), (4, '1.1.1.1')], now=10)
+    >>> url_rows.register('a', [(4, 'a'), (4, '2.2.2.2')], now=20)
+    >>> url_rows.register('c', [(4, 'c'), (4, '1.1.1.1')], now=30)
+    >>> sorted(tables[1].values.items())
+    [('a', '2.2.2.2'), ('c', '1.1.1.1')]
+    >>> url_rows.expire(now=85)
+    >>> list(url_rows), sorted(tables[0].values)
+    (['c'], ['c'])
+    '''
+
+    def __init__(self, tables, max_rows=None, window=None):
+        self.tables = tables
+        self.max_rows = max_rows
+        self.window = window
+        # key -> time of its last registration, least recent first
+        self._rows = OrderedDict()
+
+    def register(self, key, values, now=None):
+        '''Register the (type, value) of each table for the key and evict the
+        rows out of the window'''
+        if now is None:
+            now = time.time()
+        for table, (vtype, value) in zip(self.tables, values):
+            table.registerValue(key, vtype, value)
+        self._rows.pop(key, None)
+        self._rows[key] = now
+        self.expire(now)
+
+    def expire(self, now=None):
+        'Evict the least recently registered rows out of the window'
+        if now is None:
+            now = time.time()
+        while self._rows:
+            key, last_time = next(self._rows.iteritems())
+            if not ((self.max_rows and len(self._rows) > self.max_rows)
+                    or (self.window and last_time < now - self.window)):
+                break
+            del self._rows[key]
+            for table in self.tables:
+                table.unregisterValue(key)
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+class RollingCounter(object):
+    '''Nb of occurrences of the keys in the last max_events events and window
+    seconds (0 or None for no limit), exposed in SNMP tables: the name table
+    has a row for each key counted, the count table its count
+    counts is the dict of the count of each key.
+    >>> names, counts = _DocTable('Name'), _DocTable('Count')
+    >>> ip_counts = RollingCounter(names, 4, counts, 66, max_events=3)
+    >>> for event_nb, ip_address in enumerate(['1.1.1.1', '2.2.2.2',
+    ...                                        '1.1.1.1', '2.2.2.2']):
+    ...     ip_counts.add(ip_address, now=event_nb)
+    >>> sorted(counts.values.items()), sorted(names.values)
+    ([('1.1.1.1', 1), ('2.2.2.2', 2)], ['1.1.1.1', '2.2.2.2'])
+    >>> ip_counts.add('3.3.3.3', now=4)
+    >>> ip_counts.add('3.3.3.3', now=5)
+    >>> sorted(ip_counts.counts.items()), sorted(names.values)
+    ([('2.2.2.2', 1), ('3.3.3.3', 2)], ['2.2.2.2', '3.3.3.3'])
+    '''
+
+    def __init__(self, name_table, name_type, count_table, count_type,
+                 max_events=None, window=None, counts=None):
+        self.name_table = name_table
+        self.name_type = name_type
+        self.count_table = count_table
+        self.count_type = count_type
+        self.max_events = max_events
+        self.window = window
+        self.counts = counts if counts is not None else dict()
+        # (time, key) of the events counted, oldest first
+        self._events = deque()
+
+    def add(self, key, now=None):
+        'Count an occurrence of the key and forget the events out of window'
+        if now is None:
+            now = time.time()
+        if key not in self.counts:
+            self.counts[key] = 0
+            self.name_table.registerValue(key, self.name_type, key)
+        self.counts[key] += 1
+        if self.max_events or self.window:
+            self._events.append((now, key))
+            self.expire(now)
+        if key in self.counts:
+            self.count_table.registerValue(key, self.count_type,
+                                           self.counts[key])
+
+    def expire(self, now=None):
+        'Forget the oldest events out of the window'
+        if now is None:
+            now = time.time()
+        changed = set()
+        while self._events:
+            event_time, key = self._events[0]
+            if not ((self.max_events and len(self._events) > self.max_events)
+                    or (self.window and event_time < now - self.window)):
+                break
+            self._events.popleft()
+            self.counts[key] -= 1
+            changed.add(key)
+        for key in changed:
+            if self.counts[key]:
+                self.count_table.registerValue(key, self.count_type,
+                                               self.counts[key])
+            else:
+                del self.counts[key]
+                self.name_table.unregisterValue(key)
+                self.count_table.unregisterValue(key)
+
+class _DocTable(object):
+    'Table of values for the doctests (like hebexsnmptools.OidTable)'
+
+    def __init__(self, name):
+        self.name = name
+        self.values = dict()
+
+    def registerValue(self, indexes, vtype, value):
+        'Set the value of the row'
+        self.values[indexes] = value
+
+    def unregisterValue(self, indexes):
+        'Remove the row'
+        return self.values.pop(indexes, None) is not None
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
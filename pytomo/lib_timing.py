@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""Module to measure the time spent in each phase of the crawl
+
+   The phases (video info, redirects, dns, ping, download...) are timed
+   with spans (context managers) on a monotonic clock and aggregated in
+   histograms: per round (logged at the end of each round) and since the
+   start of the crawl (written next to the database for the web interface
+   and exposed in the snmp phase table).
+
+   Usage:
+       import pytomo.lib_timing as lib_timing
+       with lib_timing.TIMINGS.span('dns'):
+           ip_addresses = lib_dns.get_ip_addresses(host)
+       lib_timing.TIMINGS.add('metadata', parse_time)
+       lib_timing.TIMINGS.log_round(round_nb)
+       lib_timing.TIMINGS.dump('pytomo.db' + lib_timing.TIMINGS_EXTENSION)
+"""
+
+from __future__ import with_statement, absolute_import
+
+import bisect
+import ctypes
+import ctypes.util
+import json
+import os
+import sys
+import threading
+import time
+
+from . import config_pytomo
+
+# upper bounds (in seconds) of the buckets of the histograms (the last one has
+# no bound)
+HISTOGRAM_BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1,
+                    2, 5, 10, 20, 50, 100)
+# file written next to the database
+TIMINGS_EXTENSION = '.timings.json'
+# clock_gettime id on linux
+CLOCK_MONOTONIC = 1
+
+class _Timespec(ctypes.Structure):
+    'struct timespec of clock_gettime'
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def monotonic_clock():
+    '''Return a function giving the time (in seconds) of a monotonic clock:
+    clock_gettime on linux, time.clock on windows, time.time elsewhere'''
+    if sys.platform.startswith('win'):
+        return time.clock
+    if not sys.platform.startswith('linux'):
+        return time.time
+    for library in ('c', 'rt'):
+        try:
+            clock_gettime = ctypes.CDLL(ctypes.util.find_library(library),
+                                        use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+        timespec = _Timespec()
+        def monotonic():
+            'Return the time of the monotonic clock'
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec)):
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return timespec.tv_sec + timespec.tv_nsec * 1e-9
+        return monotonic
+    return time.time
+
+monotonic = monotonic_clock()
+
+class PhaseHistogram(object):
+    '''Histogram of the durations of a phase
+    >>> histogram = PhaseHistogram()
+    >>> for duration in (0.003, 0.004, 0.03, 1.5):
+    ...     histogram.add(duration)
+    >>> histogram.count, histogram.total, histogram.max
+    (4, 1.537, 1.5)
+    >>> histogram.quantile(0.5), histogram.quantile(0.9)
+    (0.005, 1.5)
+    '''
+
+    def __init__(self, bounds=HISTOGRAM_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        'Count the duration'
+        self.buckets[bisect.bisect_left(self.bounds, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def merge(self, other):
+        'Add the durations of the other histogram (same bounds)'
+        for index, nb_durations in enumerate(other.buckets):
+            self.buckets[index] += nb_durations
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        'Return the mean duration'
+        return self.total / self.count if self.count else 0.0
+
+    def quantile(self, fraction):
+        '''Return the upper bound of the bucket holding the quantile (the max
+        duration for the last bucket)'''
+        rank = fraction * self.count
+        seen = 0
+        for index, nb_durations in enumerate(self.buckets):
+            seen += nb_durations
+            if nb_durations and seen >= rank:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], self.max)
+                break
+        return self.max
+
+    def summary(self):
+        'Return a dict of the stats of the histogram'
+        return {'count': self.count, 'total': self.total,
+                'mean': self.mean(), 'max': self.max,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'buckets': self.buckets}
+
+class _Span(object):
+    'Context manager timing a phase'
+    __slots__ = ('timings', 'phase', 'start')
+
+    def __init__(self, timings, phase):
+        self.timings = timings
+        self.phase = phase
+        self.start = None
+
+    def __enter__(self):
+        self.start = self.timings.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timings.add(self.phase, self.timings.clock() - self.start)
+        return False
+
+class Timings(object):
+    '''Histograms of the durations of each phase, for the current round and
+    since the start
+    The spans can be used from any thread.
+    >>> timings = Timings()
+    >>> with timings.span('dns'):
+    ...     pass
+    >>> timings.add('dns', 0.2)
+    >>> timings.add('ping', 1.2)
+    >>> sorted(timings.end_round().items())[0][1].count
+    2
+    >>> timings.add('ping', 0.8)
+    >>> [(phase, histogram.count) for phase, histogram
+    ...  in sorted(timings.total.items())]
+    [('dns', 2), ('ping', 1)]
+    >>> [phase for phase in timings.round]
+    ['ping']
+    '''
+
+    def __init__(self, bounds=HISTOGRAM_BOUNDS, clock=None):
+        self.bounds = bounds
+        self.clock = clock or monotonic
+        # phase -> PhaseHistogram
+        self.round = dict()
+        self.total = dict()
+        self._lock = threading.Lock()
+
+    def span(self, phase):
+        'Return a context manager adding its duration to the phase'
+        return _Span(self, phase)
+
+    def add(self, phase, duration):
+        'Add a duration (in seconds) of the phase'
+        with self._lock:
+            histogram = self.round.get(phase)
+            if histogram is None:
+                histogram = self.round[phase] = PhaseHistogram(self.bounds)
+            histogram.add(duration)
+
+    def end_round(self):
+        '''Add the histograms of the round to the totals and return them
+        (the next round starts empty)'''
+        with self._lock:
+            round_histograms, self.round = self.round, dict()
+            for phase, histogram in round_histograms.iteritems():
+                if phase not in self.total:
+                    self.total[phase] = PhaseHistogram(self.bounds)
+                self.total[phase].merge(histogram)
+        return round_histograms
+
+    def log_round(self, round_nb=None, log=None):
+        'Log the durations of the phases in the round and end it'
+        log = log or config_pytomo.LOG
+        round_histograms = self.end_round()
+        if not round_histograms:
+            return round_histograms
+        lines = ['Phase timings of round %s:' % round_nb]
+        # the phases where most time was spent first
+        for phase, histogram in sorted(round_histograms.items(),
+                                       key=lambda item: -item[1].total):
+            lines.append('%-16s n=%-5d total=%8.2fs mean=%8.1fms '
+                         'p50<=%7.0fms p90<=%7.0fms max=%8.1fms'
+                         % (phase, histogram.count, histogram.total,
+                            1e3 * histogram.mean(),
+                            1e3 * histogram.quantile(0.5),
+                            1e3 * histogram.quantile(0.9),
+                            1e3 * histogram.max))
+        log.info('\n'.join(lines))
+        return round_histograms
+
+    def snapshot(self):
+        'Return a dict of the summaries of the phases since the start'
+        with self._lock:
+            phases = dict((phase, histogram.summary())
+                          for phase, histogram in self.total.iteritems())
+        return {'bounds': self.bounds, 'updated': time.time(),
+                'phases': phases}
+
+    def dump(self, file_name):
+        'Write the snapshot in the JSON file (replaced atomically)'
+        tmp_file = '.'.join((file_name, 'tmp'))
+        try:
+            with open(tmp_file, 'w') as f_timings:
+                json.dump(self.snapshot(), f_timings)
+            if sys.platform.startswith('win') and os.path.exists(file_name):
+                os.remove(file_name)
+            os.rename(tmp_file, file_name)
+        except (IOError, OSError), mes:
+            config_pytomo.LOG.error('Unable to write the timings in %s: %s',
+                                    file_name, mes)
+
+    def snmp_values(self):
+        '''Return the (phase, [count, total, mean, max]) of the phases since
+        the start, the times in milliseconds'''
+        with self._lock:
+            return [(phase, [histogram.count,
+                             int(round(histogram.total * 1e3)),
+                             int(round(histogram.mean() * 1e3)),
+                             int(round(histogram.max * 1e3))])
+                    for phase, histogram in self.total.iteritems()]
+
+# timings of the crawl
+TIMINGS = Timings()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
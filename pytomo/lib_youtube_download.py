@@ -43,6 +43,7 @@ from cgi import parse_qs
 
 from . import config_pytomo
 from . import lib_general_download
+from . import lib_http_pool
 
 class YoutubeIE(lib_general_download.InfoExtractor):
     """Information extractor for youtube.com."""
@@ -128,15 +129,10 @@ class YoutubeIE(lib_general_download.InfoExtractor):
         for el_type in ['&el=embedded', '&el=detailpage', '&el=vevo', '']:
             video_info_url = ('http://www.youtube.com/get_video_info?\
 &video_id=%s%s&ps=default&eurl=&gl=US&hl=en' % (video_id, el_type))
-            request = urllib2.Request(video_info_url, None,
-                                      config_pytomo.STD_HEADERS)
-            if config_pytomo.PROXIES:
-                proxy = urllib2.ProxyHandler(config_pytomo.PROXIES)
-                opener = urllib2.build_opener(proxy)
-                urllib2.install_opener(opener)
             try:
-                video_info_webpage = urllib2.urlopen(request,
-                                     timeout=config_pytomo.URL_TIMEOUT).read()
+                # the variants are requested on the same connection
+                video_info_webpage = lib_http_pool.open_url(
+                                                        video_info_url).read()
                 video_info = parse_qs(video_info_webpage)
                 if 'token' in video_info:
                     break
@@ -56,7 +56,6 @@ from __future__ import with_statement, absolute_import, print_function
 
 import sys
 from urlparse import urlsplit
-from pprint import pprint
 import logging
 import datetime
 from time import strftime, timezone
@@ -73,8 +72,7 @@ from os.path import abspath, dirname, sep
 from sys import path
 import tarfile
 import re
-from operator import concat, itemgetter, eq
-from sqlite3 import Error
+from operator import concat, eq
 #from ast import literal_eval
 import json
 
@@ -84,11 +82,6 @@ PACKAGE_DIR = dirname(abspath(path[0]))
 #PUBLIC_IP_FINDER = 'http://automation.whatismyip.com/n09230945.asp'
 #PUBLIC_IP_FINDER = 'http://ipogre.com/linux.php'
 PUBLIC_IP_FINDER = r'http://stat.ripe.net/data/whats-my-ip/data.json'
-AS_REQUEST_URL = r'http://stat.ripe.net/data/routing-status/data.json?resource='
-# to store the request on /24 prefixes
-CACHED_PREFIXES = dict()
-# give a default fake value for convenience
-CACHED_PREFIXES['0.0.0'] = 0
 
 IP_MATCH_PATTERN = ('^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}'
                     '([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])$')
@@ -134,6 +127,13 @@ from . import lib_youtube_api
 from . import lib_dailymotion_api
 from . import lib_links_extractor
 from . import lib_data_centralisation
+from . import lib_crawl_pool
+from . import lib_as_cache
+from . import lib_redirect_cache
+from . import lib_snmp_tables
+from . import lib_result_sinks
+from . import lib_result_stream
+from . import lib_timing
 from . import translation_cache_url
 
 if config_pytomo.PLOT:
@@ -142,6 +142,17 @@ if config_pytomo.PLOT:
 # default service is YouTube
 SERVICE = 'YouTube'
 
+# limit the parallel downloads on each cache server
+SERVER_SLOTS = lib_crawl_pool.ServerSlots()
+# urls already crawled: loaded from the database at the start of the crawl
+CRAWLED_URLS = lib_database.CrawledUrls()
+# AS of the IP prefixes: stored next to the database
+AS_CACHE = lib_as_cache.AsCache()
+# redirect chains of the videos (if REDIRECT_CACHE_TTL is set)
+REDIRECT_CACHE = lib_redirect_cache.RedirectCache()
+# time spent in each phase of the crawl
+TIMINGS = lib_timing.TIMINGS
+
 def select_libraries(url):
     ''' Return the libraries to use for dowloading and retrieving specific
     links'''
@@ -210,7 +221,21 @@ def compute_stats(url, cache_uri, do_download_stats, redirect_url=None,
     if config_pytomo.CRAWL_SERVICE.lower() == YOUTUBE_SERVICE:
         cache_url = translation_cache_url.translate_cache_url(cache_url)
     #cache_urn = '?'.join((parsed_uri.path, parsed_uri.query))
-    ip_addresses = lib_dns.get_ip_addresses(parsed_uri.netloc)
+    with TIMINGS.span('dns'):
+        ip_addresses = lib_dns.get_ip_addresses(parsed_uri.netloc)
+    # the IPs already crawled for this cache url are skipped
+    measured_ips = set()
+    to_measure = []
+    for (ip_address, resolver, req_time) in ip_addresses:
+        if ip_address in measured_ips and config_pytomo.SKIP_COMPUTED:
+            config_pytomo.LOG.debug('Skip IP already crawled: %s',
+                                    ip_address)
+            continue
+        measured_ips.add(ip_address)
+        to_measure.append((ip_address, resolver, req_time))
+    # the ASes are resolved during the measurements
+    for ip_address in measured_ips:
+        AS_CACHE.request(ip_address)
     # in case there is a problem in the DNS, for the variables to be bound
     if redirect_url:
         parsed_uri = urlsplit(redirect_url)
@@ -219,20 +244,20 @@ def compute_stats(url, cache_uri, do_download_stats, redirect_url=None,
             redirect_url = translation_cache_url.translate_cache_url(
                                                                    redirect_url)
     redirect_list = []
-    for (ip_address, resolver, req_time) in ip_addresses:
+    # all the IPs measured are pinged at once
+    with TIMINGS.span('ping'):
+        all_ping_times = lib_ping.ping_ips(list(measured_ips))
+    for (ip_address, resolver, req_time) in to_measure:
         config_pytomo.LOG.debug('Compute stats for IP: %s', ip_address)
         timestamp = datetime.datetime.now()
-        if ip_address in current_stats and config_pytomo.SKIP_COMPUTED:
-            config_pytomo.LOG.debug('Skip IP already crawled: %s',
-                                    ip_address)
-            continue
-        ping_times = lib_ping.ping_ip(ip_address)
+        ping_times = all_ping_times.get(ip_address)
         if do_download_stats and ('default' in resolver
                                   or config_pytomo.DOWNLOAD_FROM_EXTRA_IPS):
-            (download_stats, new_redirect_url,
-             status_code) = compute_download_stats(resolver, ip_address,
-                                                   cache_uri, current_stats,
-                                                   do_full_crawl=do_full_crawl)
+            with SERVER_SLOTS.slot(ip_address):
+                (download_stats, new_redirect_url,
+                 status_code) = compute_download_stats(resolver, ip_address,
+                                                    cache_uri, current_stats,
+                                                    do_full_crawl=do_full_crawl)
             redirect_list.append(new_redirect_url)
         else:
             download_stats, new_redirect_url = None, None
@@ -240,20 +265,13 @@ def compute_stats(url, cache_uri, do_download_stats, redirect_url=None,
             proxy = urllib2.ProxyHandler(config_pytomo.PROXIES)
             opener = urllib2.build_opener(proxy)
             urllib2.install_opener(opener)
-        # we do consider only /24 prefixes
-        prefix = '.'.join(ip_address.split('.')[0:3])
-        if prefix not in CACHED_PREFIXES:
-            try:
-                # HARD CODED fields of json data
-                as_nb = int(json.load(urllib2.urlopen(
-                    AS_REQUEST_URL + ip_address,
-                timeout=config_pytomo.AS_URL_TIMEOUT))['data']['last_seen']['origin'])
-                CACHED_PREFIXES[prefix] = as_nb
-                config_pytomo.LOG.debug('IP %s resolved as AS: %d',
-                                        ip_address, as_nb)
-            except Exception, mes:
-                config_pytomo.LOG.exception(mes)
-                prefix = '0.0.0'
+        with TIMINGS.span('as_lookup'):
+            as_nb = AS_CACHE.lookup(ip_address,
+                                    wait=config_pytomo.AS_LOOKUP_WAIT)
+        if as_nb is None:
+            config_pytomo.LOG.debug('AS of IP %s not resolved yet', ip_address)
+            # give a default fake value for convenience
+            as_nb = 0
         if not status_code and redirect_url:
             # should not happen, but guess a 302 in this case
             config_pytomo.LOG.debug('no status code found with this '
@@ -261,7 +279,7 @@ def compute_stats(url, cache_uri, do_download_stats, redirect_url=None,
             status_code = config_pytomo.HTTP_REDIRECT_FOUND
         current_stats[ip_address] = [timestamp, ping_times, download_stats,
                                      redirect_url, resolver, req_time,
-                                     CACHED_PREFIXES[prefix], status_code]
+                                     as_nb, status_code]
     # check if cache_url is the same independently of DNS: YES only depend on
     # video id
     #assert reduce(eq, redirect_list)
@@ -284,10 +302,11 @@ def compute_download_stats(resolver, ip_address, cache_uri, current_stats,
 #    if 'default' in resolver:
 #    config_pytomo.LOG.debug('trying url without IP')
     try:
+        # timed as connect, download and metadata phases
         status_code, download_stats, redirect_url = (
-                lib_general_download.get_download_stats(cache_uri,
-                                        ip_address, download_time=d_time))
-                                                #redirect=redirect))
+            lib_general_download.get_download_stats(cache_uri,
+                                    ip_address, download_time=d_time))
+                                            #redirect=redirect))
     except (urllib2.HTTPError, ), nested_err:
         config_pytomo.LOG.exception(nested_err)
         # do nothing
@@ -556,16 +575,59 @@ def set_up_snmp():
         config_pytomo.snmp_tables.append(config_pytomo.urlStatusCodeTable)
         config_pytomo.snmp_types.append(hebexsnmptools.ASN_INTEGER)
 
+        # rows of the latest videos only (if the tables are bounded)
+        config_pytomo.snmp_url_rows = lib_snmp_tables.WindowedRows(
+                                config_pytomo.snmp_tables,
+                                max_rows=config_pytomo.SNMP_TABLE_SIZE,
+                                window=config_pytomo.SNMP_TABLE_WINDOW)
+        # the counts on a window can decrease
+        if config_pytomo.SNMP_TABLE_SIZE or config_pytomo.SNMP_TABLE_WINDOW:
+            count_type = hebexsnmptools.ASN_GAUGE
+        else:
+            count_type = hebexsnmptools.ASN_COUNTER64
+
         #Statistics by ip
         config_pytomo.IpNameTable = config_pytomo.dataset.addTable(config_pytomo.snmp_pytomoIpName, hebexsnmptools.TABLE_INDEX_STRING)
         config_pytomo.IpCountTable = config_pytomo.dataset.addTable(config_pytomo.snmp_pytomoIpCount, hebexsnmptools.TABLE_INDEX_STRING)
-        config_pytomo.IpCountType =  hebexsnmptools.ASN_COUNTER64
+        config_pytomo.IpCountType =  count_type
         config_pytomo.IpNameType =  hebexsnmptools.ASN_OCTET_STR
+        config_pytomo.snmp_ip_counts = lib_snmp_tables.RollingCounter(
+                                config_pytomo.IpNameTable,
+                                config_pytomo.IpNameType,
+                                config_pytomo.IpCountTable,
+                                config_pytomo.IpCountType,
+                                max_events=config_pytomo.SNMP_TABLE_SIZE,
+                                window=config_pytomo.SNMP_TABLE_WINDOW,
+                                counts=config_pytomo.DOWNLOADED_BY_IP)
 		#Statistics by AS
         config_pytomo.ASNameTable = config_pytomo.dataset.addTable(config_pytomo.snmp_pytomoASName, hebexsnmptools.TABLE_INDEX_STRING)
         config_pytomo.ASCountTable = config_pytomo.dataset.addTable(config_pytomo.snmp_pytomoASCount, hebexsnmptools.TABLE_INDEX_STRING)
-        config_pytomo.ASCountType = hebexsnmptools.ASN_COUNTER64
+        config_pytomo.ASCountType = count_type
         config_pytomo.ASNameType =  hebexsnmptools.ASN_OCTET_STR
+        config_pytomo.snmp_as_counts = lib_snmp_tables.RollingCounter(
+                                config_pytomo.ASNameTable,
+                                config_pytomo.ASNameType,
+                                config_pytomo.ASCountTable,
+                                config_pytomo.ASCountType,
+                                max_events=config_pytomo.SNMP_TABLE_SIZE,
+                                window=config_pytomo.SNMP_TABLE_WINDOW,
+                                counts=config_pytomo.DOWNLOADED_BY_AS)
+        # time spent in each phase of the crawl: name, count, total, mean,
+        # max (in ms)
+        config_pytomo.snmp_phases = []
+        for oid, snmp_type in ((config_pytomo.snmp_pytomoPhaseName,
+                                hebexsnmptools.ASN_OCTET_STR),
+                               (config_pytomo.snmp_pytomoPhaseCount,
+                                hebexsnmptools.ASN_COUNTER64),
+                               (config_pytomo.snmp_pytomoPhaseTotalTime,
+                                hebexsnmptools.ASN_COUNTER64),
+                               (config_pytomo.snmp_pytomoPhaseMeanTime,
+                                hebexsnmptools.ASN_GAUGE),
+                               (config_pytomo.snmp_pytomoPhaseMaxTime,
+                                hebexsnmptools.ASN_GAUGE)):
+            config_pytomo.snmp_phases.append((config_pytomo.dataset.addTable(
+                                    oid, hebexsnmptools.TABLE_INDEX_STRING),
+                                              snmp_type))
 
 
 def check_out_files(file_pattern, directory, timestamp):
@@ -646,67 +708,48 @@ class MaxUrlException(Exception):
     'Class to stop crawling when the max nb of urls has been attained'
     pass
 
-def add_stats(stats, cache_server_delay, url, result_stream=None, data_base=None):
-    '''Insert the stats in the db and update the crawled urls
+def get_service(url):
+    '''Return the name of the service of the url
+    >>> get_service('http://www.youtube.com/watch?v=RcmKbTR--iA')
+    'YouTube'
     '''
-    if result_stream:
-        pprint(stats, stream=result_stream)
+    if YOUTUBE_SERVICE in url:
+        return 'YouTube'
+    elif DAILYMOTION_SERVICE in url:
+        return 'Dailymotion'
+    else:
+        return 'Unknown'
+
+def stats_rows(stats, cache_server_delay, url):
+    '''Return the stats formatted as lib_result_sinks.StatsRow and update the
+    crawled urls'''
+    rows = [lib_result_sinks.StatsRow._make(row)
+            for row in format_stats(stats, cache_server_delay,
+                                    service=get_service(url))]
+    CRAWLED_URLS.add_rows(rows)
+    return rows
+
+def result_sinks(result_stream=None, data_base=None):
+    'Return the list of the sinks storing the stats of the crawl'
+    sinks = []
     if data_base:
-        if YOUTUBE_SERVICE in url:
-            service = 'YouTube'
-        elif DAILYMOTION_SERVICE in url:
-            service = 'Dailymotion'
-        else:
-            service = 'Unknown'
-        for row in format_stats(stats, cache_server_delay, service=service):
-            data_base.insert_record(row)
+        sinks.append(lib_result_sinks.DatabaseSink(data_base))
+    if result_stream:
+        sinks.append(lib_result_sinks.ResultStreamSink(result_stream))
     if config_pytomo.SNMP:
-        format_gauge = lambda x: int(x * 1000 if x else 0)
-        format_datetime = lambda x: x.strftime('%Y%m%d %H:%M:%S')
-        format_int = lambda x: x if x else 0
-        identity = lambda x: x if x else ''
-        formatted_stats = format_stats(stats, cache_server_delay,service=service)
-
-        for stats_line in formatted_stats:
-            video_url = stats_line[config_pytomo.URL_IDX]
-            video_ip = stats_line[config_pytomo.IP_IDX]
-            video_as = str(stats_line[config_pytomo.AS_IDX])
-            for table, snmp_type, idx in zip(config_pytomo.snmp_tables,
-                                             config_pytomo.snmp_types,
-                                             config_pytomo.STATS_IDX):
-                if snmp_type == config_pytomo.hebexsnmptools.ASN_GAUGE:
-                    formatter = format_gauge
-                elif snmp_type == config_pytomo.hebexsnmptools.ASN_INTEGER:
-                    formatter = format_int
-                elif idx == config_pytomo.TS_IDX:
-                    formatter = format_datetime
-                else:
-                    formatter = identity
-                table.registerValue(video_url, snmp_type,
-                        formatter(stats_line[idx]))
-
-            if not config_pytomo.DOWNLOADED_BY_IP.has_key(video_ip):
-                config_pytomo.DOWNLOADED_BY_IP[video_ip] = 0
-                config_pytomo.IpNameTable.registerValue(video_ip, config_pytomo.IpNameType, video_ip)
-            if not config_pytomo.DOWNLOADED_BY_AS.has_key(video_as):
-                config_pytomo.DOWNLOADED_BY_AS[video_as] = 0
-                config_pytomo.ASNameTable.registerValue(video_as, config_pytomo.ASNameType, video_as)
-
-            config_pytomo.DOWNLOADED_BY_IP[video_ip] += 1
-            config_pytomo.DOWNLOADED_BY_AS[video_as] += 1
-
-            config_pytomo.IpCountTable.registerValue(video_ip, config_pytomo.IpCountType , config_pytomo.DOWNLOADED_BY_IP[video_ip] )
-            config_pytomo.ASCountTable.registerValue(video_as, config_pytomo.ASCountType , config_pytomo.DOWNLOADED_BY_AS[video_as] )
-
-
-
+        sinks.append(lib_result_sinks.SnmpSink(config_pytomo.snmp_url_rows,
+                                    config_pytomo.snmp_ip_counts,
+                                    config_pytomo.snmp_as_counts,
+                                    phase_tables=config_pytomo.snmp_phases))
+    return sinks
 
 def retrieve_cache_urls(url, lib_download, hd_first=False):
     ''' Return the list of cache url servers for a given video.
     The last element is the server from which the actual video is downloaded.
     '''
     # cache url server dependent on the service
-    cache_uri = lib_download.get_cache_url(url, hd_first=hd_first)
+    with TIMINGS.span('video_info'):
+        cache_uri = lib_download.get_cache_url(url, hd_first=hd_first)
     if not cache_uri:
         return []
     # list of cache urls
@@ -714,8 +757,9 @@ def retrieve_cache_urls(url, lib_download, hd_first=False):
     nb_redirects = 0
     redirect_links.append(cache_uri)
     # try to connect to the cache url, check if there are more redirects
-    response = lib_links_extractor.retrieve_header(cache_uri,
-                                                   follow_redirect=False)
+    with TIMINGS.span('redirect_head'):
+        response = lib_links_extractor.retrieve_header(cache_uri,
+                                                       follow_redirect=False)
     while (response and nb_redirects <= config_pytomo.MAX_NB_REDIRECT):
         config_pytomo.LOG.debug('response_code: %s', response.code)
         # no redirect
@@ -723,8 +767,9 @@ def retrieve_cache_urls(url, lib_download, hd_first=False):
             break
         redirect_server = response.location
         redirect_links.append(redirect_server)
-        response = lib_links_extractor.retrieve_header(redirect_server,
-                                                       follow_redirect=False)
+        with TIMINGS.span('redirect_head'):
+            response = lib_links_extractor.retrieve_header(redirect_server,
+                                                        follow_redirect=False)
         cache_uri = redirect_server
         nb_redirects += 1
     if nb_redirects > config_pytomo.MAX_NB_REDIRECT:
@@ -733,6 +778,28 @@ def retrieve_cache_urls(url, lib_download, hd_first=False):
         return []
     return redirect_links
 
+def get_cache_servers(url, lib_download, hd_first=False):
+    '''Return the cache servers of the video and the delay to retrieve them
+    The chains are reused from REDIRECT_CACHE if it is enabled: the delay is
+    then None (not measured).
+    '''
+    key = None
+    if REDIRECT_CACHE.ttl > 0:
+        key = (get_service(url), lib_redirect_cache.video_id(url),
+               'hd' if hd_first else 'default',
+               lib_dns.get_default_name_servers())
+        cached = REDIRECT_CACHE.get(key)
+        if cached:
+            config_pytomo.LOG.debug('Reuse cached redirect chain of %s', url)
+            return cached, None
+    start_cache_server_time = time.time()
+    cache_servers = retrieve_cache_urls(url, lib_download, hd_first=hd_first)
+    end_cache_server_time = time.time()
+    cache_server_delay = end_cache_server_time - start_cache_server_time
+    if key:
+        REDIRECT_CACHE.put(key, cache_servers)
+    return cache_servers, cache_server_delay
+
 def check_full_download(len_crawled_urls):
     'Check if the urls should be fully downloaded'
     if (config_pytomo.FREQ_FULL_DOWNLOAD
@@ -741,16 +808,11 @@ def check_full_download(len_crawled_urls):
     else:
         return False
 
-def crawl_link(url, next_urls, result_stream, data_base, related, loop,
-               hd_first=False):
-    '''Crawl the link and return the next urls'''
-    try:
-        crawled_urls = map(itemgetter(-1),
-                       data_base.fetch_single_parameter_with_stats(PARAM_URL))
-    except Error, mes:
-        config_pytomo.LOG.error('Unable to extract data %s with error: %s',
-                                PARAM_URL, mes)
-        return next_urls
+def crawl_link(url, next_urls, writer, related, loop, hd_first=False):
+    '''Crawl the link and return the next urls
+    The stats are stored by the result pipeline (writer).
+    '''
+    crawled_urls = CRAWLED_URLS
     if not loop and len(crawled_urls) >= config_pytomo.MAX_CRAWLED_URLS:
         config_pytomo.LOG.debug('Reached max crawls')
         raise MaxUrlException()
@@ -767,9 +829,6 @@ def crawl_link(url, next_urls, result_stream, data_base, related, loop,
         sys.stdout.write('Completed %d urls\n' % len(crawled_urls))
         sys.stdout.flush()
         #print('Completed %d urls' % len(crawled_urls))
-    if result_stream:
-        config_pytomo.LOG.debug('Printing to result_stream')
-        print(sep=config_pytomo.SEP_LINE, file=result_stream)
     stats = None
     redirect_list = []
     download_libs = select_libraries(url)
@@ -779,10 +838,8 @@ def crawl_link(url, next_urls, result_stream, data_base, related, loop,
         config_pytomo.LOG.error('Could not select libraries to compute'
                                 ' statistics for %s', url)
         return next_urls
-    start_cache_server_time = time.time()
-    cache_servers = retrieve_cache_urls(url, lib_download, hd_first=hd_first)
-    end_cache_server_time = time.time()
-    cache_server_delay = end_cache_server_time - start_cache_server_time
+    cache_servers, cache_server_delay = get_cache_servers(url, lib_download,
+                                                          hd_first=hd_first)
     config_pytomo.LOG.debug('For url=%s the cache urls are %s',
                             url, cache_servers)
     if not cache_servers:
@@ -797,7 +854,7 @@ def crawl_link(url, next_urls, result_stream, data_base, related, loop,
             config_pytomo.LOG.error('Error retrieving stats for: %s',
                                     cache_server)
         if stats:
-            add_stats(stats, cache_server_delay, url, result_stream, data_base)
+            writer.add_stats(stats, cache_server_delay, url)
         else:
             config_pytomo.LOG.info('no stats for url: %s', cache_server)
         if redirect_list:
@@ -813,7 +870,7 @@ def crawl_link(url, next_urls, result_stream, data_base, related, loop,
     except TypeError:
         config_pytomo.LOG.error('Error retrieving stats for: %s', cache_server)
     if stats:
-        add_stats(stats, cache_server_delay, url, result_stream, data_base)
+        writer.add_stats(stats, cache_server_delay, url)
         # wait only if there were stats retrieved
         time.sleep(config_pytomo.DELAY_BETWEEN_REQUESTS)
     else:
@@ -827,7 +884,7 @@ def crawl_link(url, next_urls, result_stream, data_base, related, loop,
         stats, redirect_list = compute_stats(url, cache_server, True,
                                              do_full_crawl=do_full_crawl)
         if stats:
-            add_stats(stats, cache_server_delay, url, result_stream, data_base)
+            writer.add_stats(stats, cache_server_delay, url)
             # wait only if there were stats retrieved
             time.sleep(config_pytomo.DELAY_BETWEEN_REQUESTS)
         else:
@@ -838,8 +895,9 @@ def crawl_link(url, next_urls, result_stream, data_base, related, loop,
                                     'account')
     if (related and len(next_urls) < config_pytomo.MAX_CRAWLED_URLS):
         try:
-            related_urls = set(filter(None,
-                                      lib_api.get_related_urls(url,
+            with TIMINGS.span('related_urls'):
+                related_urls = set(filter(None,
+                                          lib_api.get_related_urls(url,
                                                config_pytomo.MAX_PER_PAGE,
                                                config_pytomo.MAX_PER_URL)))
         except TypeError:
@@ -847,9 +905,12 @@ def crawl_link(url, next_urls, result_stream, data_base, related, loop,
         next_urls = next_urls.union(related_urls)
     return next_urls
 
-def crawl_links(input_links, result_stream=None,
-                data_base=None, related=True, loop=False, hd_first=False):
-    '''Wrapper to crawl each input link'''
+def crawl_links(input_links, writer, related=True, loop=False,
+                hd_first=False, workers=1):
+    '''Wrapper to crawl each input link
+    The result pipeline (writer) stores the stats, and the links are crawled
+    by workers threads if there are more than one.
+    '''
     next_urls = set()
     # When a redirect occurs, the database should store in the
     # 'Url' field the first link that caused redirection and then statistics
@@ -858,9 +919,17 @@ def crawl_links(input_links, result_stream=None,
     #                        downloaded
     # - ping statistics: for each cache server (intermediate and final)
     config_pytomo.LOG.debug('input_links: %s', input_links)
-    for url in input_links:
-        next_urls = crawl_link(url, next_urls, result_stream, data_base,
-                               related, loop, hd_first=hd_first)
+    if workers > 1:
+        crawl_function = lambda url: crawl_link(url, set(), writer,
+                                                related, loop,
+                                                hd_first=hd_first)
+        for related_urls in lib_crawl_pool.run_workers(crawl_function,
+                                                       input_links, workers):
+            next_urls = next_urls.union(related_urls)
+    else:
+        for url in input_links:
+            next_urls = crawl_link(url, next_urls, writer, related, loop,
+                                   hd_first=hd_first)
     if not loop:
         next_urls = next_urls.difference(input_links)
     else:
@@ -868,8 +937,9 @@ def crawl_links(input_links, result_stream=None,
     config_pytomo.LOG.debug('next_urls: %s', next_urls)
     return next_urls
 
-def do_rounds(input_links, result_stream, data_base, db_file,
-              image_file, related=True, loop=False, hd_first=False):
+def do_rounds(input_links, writer, data_base, db_file,
+              image_file, related=True, loop=False, hd_first=False,
+              workers=1):
     '''Perform the rounds of crawl'''
     max_rounds = config_pytomo.MAX_ROUNDS
     for round_nb in xrange(max_rounds):
@@ -888,15 +958,17 @@ def do_rounds(input_links, result_stream, data_base, db_file,
                                config_pytomo.EXTRA_NAME_SERVERS_CC)
         #config_pytomo.LOG.debug(input_links)
         try:
-            input_links = crawl_links(input_links, result_stream,
-                                      data_base, related=related, loop=loop,
-                                      hd_first=hd_first)
+            input_links = crawl_links(input_links, writer, related=related,
+                                      loop=loop, hd_first=hd_first,
+                                      workers=workers)
         except ValueError:
             # AO 20120926 TODO: check if this catches exception of crawled_urls
             # extraction from database
             config_pytomo.LOG.debug('not able to retrieve stats from url')
             # no sleep here: check if it's ok
             continue
+        finally:
+            end_round_timings(round_nb, db_file)
         # early exit if no more links
         if not input_links:
             break
@@ -905,13 +977,27 @@ def do_rounds(input_links, result_stream, data_base, db_file,
                                 config_pytomo.DELAY_BETWEEN_REQUESTS)
         # The plot is redrawn everytime the database is updated
         if config_pytomo.PLOT:
-            lib_plot.plot_data(db_file, config_pytomo.COLUMN_NAMES,
-                               image_file)
+            writer.wait()
+            if data_base:
+                data_base.flush()
+            with TIMINGS.span('plot'):
+                lib_plot.plot_data(config_pytomo.COLUMN_NAMES, image_file,
+                                   db_file=db_file)
+
+def end_round_timings(round_nb, db_file=None):
+    '''Log the time spent in each phase during the round and write the
+    timings since the start next to the database'''
+    TIMINGS.log_round(round_nb)
+    if db_file:
+        TIMINGS.dump(''.join((db_file, lib_timing.TIMINGS_EXTENSION)))
 
 def do_crawl(result_stream=None, db_file=None, timestamp=None,
-             image_file=None, loop=False, related=True, hd_first=False):
+             image_file=None, loop=False, related=True, hd_first=False,
+             workers=1):
     '''Crawls the urls given by the url_file
     up to max_rounds are performed or max_visited_urls
+    The stats are stored in background by the result pipeline.
+    With more than one worker, the videos are crawled in parallel.
     '''
     if not db_file and not result_stream and not config_pytomo.SNMP:
         config_pytomo.LOG.critical('Cannot start crawl because no file can '
@@ -929,6 +1015,9 @@ def do_crawl(result_stream=None, db_file=None, timestamp=None,
         data_base = lib_database.PytomoDatabase(
                                             config_pytomo.DATABASE_TIMESTAMP)
         data_base.create_pytomo_table(config_pytomo.TABLE_TIMESTAMP)
+        # records are committed by batches until the handle is closed
+        data_base.start_batch()
+    CRAWLED_URLS.seed(data_base)
 #    max_per_page = config_pytomo.MAX_PER_PAGE
 #    max_per_url = config_pytomo.MAX_PER_URL
     config_pytomo.LOG.debug('STATIC_URL_LIST: %s',
@@ -958,21 +1047,34 @@ def do_crawl(result_stream=None, db_file=None, timestamp=None,
         if data_base:
             data_base.close_handle()
         return
+    if workers > 1:
+        config_pytomo.LOG.warn('Parallel crawl with %d workers', workers)
+    writer = lib_result_sinks.ResultPipeline(stats_rows,
+                                    result_sinks(result_stream, data_base))
+    writer.start()
+    if db_file:
+        AS_CACHE.open(sep.join((dirname(db_file),
+                                config_pytomo.AS_CACHE_FILE)))
     try:
         if loop:
             while True:
-                do_rounds(input_links, result_stream, data_base, db_file,
+                do_rounds(input_links, writer, data_base, db_file,
                           image_file, related=related, loop=loop,
-                          hd_first=hd_first)
+                          hd_first=hd_first, workers=workers)
         else:
-            do_rounds(input_links, result_stream, data_base, db_file,
-                      image_file, related=related, loop=loop, hd_first=hd_first)
+            do_rounds(input_links, writer, data_base, db_file,
+                      image_file, related=related, loop=loop, hd_first=hd_first,
+                      workers=workers)
             # next round input are related links of the current input_links
     #   input_links = get_next_round_urls(lib_api, input_links, max_per_page,
     #                                            max_per_url)
     except MaxUrlException:
         config_pytomo.LOG.warn('Stopping crawl because %d urls have been '
                                'crawled', config_pytomo.MAX_CRAWLED_URLS)
+    finally:
+        # store the stats already computed
+        writer.close()
+        AS_CACHE.close()
     if data_base:
         data_base.close_handle()
     config_pytomo.LOG.warn('Crawl finished\n' + config_pytomo.SEP_LINE)
@@ -1149,6 +1251,35 @@ def create_options(parser):
                       help=('Tries to fetch video in HD (implemented only for'
                             'YouTube)'),
                       default=config_pytomo.CENTRALISE_DATA)
+    parser.add_option('--workers', dest='WORKERS', type='int',
+                      help=('Number of videos crawled in parallel '
+                            '(default %d)' % config_pytomo.WORKERS),
+                      default=config_pytomo.WORKERS)
+    parser.add_option('--max-per-server', dest='MAX_DOWNLOADS_PER_SERVER',
+                      type='int',
+                      help=('Max number of parallel downloads on the same '
+                            'cache server (default %d)'
+                            % config_pytomo.MAX_DOWNLOADS_PER_SERVER),
+                      default=config_pytomo.MAX_DOWNLOADS_PER_SERVER)
+    parser.add_option('--redirect-cache-ttl', dest='REDIRECT_CACHE_TTL',
+                      type='int',
+                      help=('Reuse the cache servers of a video for this '
+                            'time in seconds, useful in loop mode: the '
+                            'CacheServerDelay of the measurements reusing them '
+                            'is NULL (default %d: disabled)'
+                            % config_pytomo.REDIRECT_CACHE_TTL),
+                      default=config_pytomo.REDIRECT_CACHE_TTL)
+    parser.add_option('--snmp-rows', dest='SNMP_TABLE_SIZE', type='int',
+                      help=('Keep the SNMP rows of this number of videos, '
+                            'the IP and AS counts are then gauges on the '
+                            'same window (default %d, 0 for all)'
+                            % config_pytomo.SNMP_TABLE_SIZE),
+                      default=config_pytomo.SNMP_TABLE_SIZE)
+    parser.add_option('--snmp-window', dest='SNMP_TABLE_WINDOW', type='int',
+                      help=('Keep the SNMP rows of the videos measured in this '
+                            'time in seconds (default %d, 0 for no limit)'
+                            % config_pytomo.SNMP_TABLE_WINDOW),
+                      default=config_pytomo.SNMP_TABLE_WINDOW)
 
 
 def check_options(parser, options):
@@ -1162,6 +1293,9 @@ def check_options(parser, options):
         parser.error('Incorrect Service.\n'
                      "Choose from: 'youtube', 'dailymotion' "
                      "(default '%s')" % config_pytomo.CRAWL_SERVICE)
+    if options.WORKERS < 1 or options.MAX_DOWNLOADS_PER_SERVER < 1:
+        parser.error('The number of workers and of downloads per server must '
+                     'be at least 1')
 
 def write_options_to_config(options):
     'Write read options to config_pytomo'
@@ -1396,6 +1530,8 @@ def main(version=None, argv=None):
              '[-P max_per_page] '
              '[-s {youtube, dailymotion}] '
              '[--snmp] '
+             '[--snmp-rows nb_videos] '
+             '[--snmp-window seconds] '
              '[-t time_frame] '
              '[-n ping_packets] '
              '[-D download_time] '
@@ -1409,6 +1545,9 @@ def main(version=None, argv=None):
              '[--download-extra-dns] '
              '[-L log_level] '
              '[-f, --input_file input_file_list] '
+             '[--workers nb_workers] '
+             '[--max-per-server max_downloads_per_server] '
+             '[--redirect-cache-ttl seconds] '
              '[input_urls]')
     parser = OptionParser(usage=usage)
     create_options(parser)
@@ -1480,7 +1619,7 @@ def main(version=None, argv=None):
     result_stream = None
     # memory monitoring module
     if result_file:
-        result_stream = open(result_file, 'w')
+        result_stream = lib_result_stream.RecordWriter(result_file)
     if input_urls:
         config_pytomo.STATIC_URL_LIST = (config_pytomo.STATIC_URL_LIST
                                          + input_urls)
@@ -1499,7 +1638,8 @@ def main(version=None, argv=None):
         do_crawl(result_stream=result_stream, db_file=db_file,
                  image_file=image_file, timestamp=timestamp,
                  loop=config_pytomo.LOOP, related=config_pytomo.RELATED,
-                 hd_first=config_pytomo.HD_FIRST)
+                 hd_first=config_pytomo.HD_FIRST,
+                 workers=config_pytomo.WORKERS)
     except config_pytomo.BlackListException:
         err_mes = ('Crawl detected by YouTube: '
                    'log to YouTube and enter captcha')
@@ -1510,10 +1650,10 @@ def main(version=None, argv=None):
         config_pytomo.LOG.critical('Crawl interrupted by user')
     except Exception, mes:
         config_pytomo.LOG.exception('Uncaught exception: %s', mes)
-    config_pytomo.LOG.debug(CACHED_PREFIXES)
+    config_pytomo.LOG.debug('%d AS prefixes in cache', len(AS_CACHE))
     if config_pytomo.PLOT:
-        lib_plot.plot_data(db_file, config_pytomo.COLUMN_NAMES,
-                           image_file)
+        lib_plot.plot_data(config_pytomo.COLUMN_NAMES, image_file,
+                           db_file=db_file)
     if result_file:
         result_stream.close()
     log_md5_results(result_file, db_file)
@@ -15,6 +15,7 @@ import sys
 import os
 import logging
 import time
+import datetime
 from itertools import chain
 # webpy
 try:
@@ -28,24 +29,26 @@ except (ValueError):
     import config_pytomo
 # rrd library to interact with
 try:
-    from .lib_rrdtools import PytomoRRD, create_options
+    from .lib_rrdtools import create_options
 except (ValueError):
-    from lib_rrdtools import PytomoRRD, create_options
-# database connection
+    from lib_rrdtools import create_options
+# reports built in background
 try:
-    from .lib_database import PytomoDatabase
+    from .lib_report_builder import ReportBuilder
 except (ValueError):
-    from lib_database import PytomoDatabase
-from sqlite3 import Error
+    from lib_report_builder import ReportBuilder
 # file operations
 try:
     from .lib_io import ALL_PLOTS, ALL_KEY, LINKS_KEY, MAIN_KEY, DB_KEY, \
-    DB_EXTENSION, get_latest_specific_file, write_index, \
-    check_templates_exist, index_filename
+    DB_EXTENSION, get_latest_specific_file, start_pool
 except (ValueError):
     from lib_io import ALL_PLOTS, ALL_KEY, LINKS_KEY, MAIN_KEY, DB_KEY, \
-    DB_EXTENSION, get_latest_specific_file, write_index, \
-    check_templates_exist, index_filename
+    DB_EXTENSION, get_latest_specific_file, start_pool
+# timings of the phases of the crawl
+try:
+    from .lib_timing import TIMINGS_EXTENSION
+except (ValueError):
+    from lib_timing import TIMINGS_EXTENSION
 # to check if files/dirs exist and set name
 try:
     from .start_pytomo import check_out_files, configure_log_file
@@ -55,8 +58,6 @@ except ValueError:
 # port range to run the server
 MIN_PORT = 1024
 MAX_PORT = 65535
-# refresh time in seconds to reload the main page
-REFRESH_TIME = 90
 # first line in the html to be displayed in the browser
 START_RENDERING = 1
 # global directory where the databases are stored (can be changed if the user
@@ -64,11 +65,14 @@ START_RENDERING = 1
 DB_DIR = config_pytomo.DATABASE_DIR
 #DATABASE = config_pytomo.DATABASE
 DATABASE = get_latest_specific_file(DB_DIR, DB_EXTENSION)
-# rrd needs minimum 3 points to plot graphs
-RRD_MIN_NR_POINTS = 3
+# rebuilds the plots and pages in background
+REPORT_BUILDER = ReportBuilder(DB_DIR)
 
 if not config_pytomo.LOG:
     configure_log_file('http_server')
+# the processes rendering the reports are forked before the threads of the
+# server and of the report builder
+start_pool()
 
 # the main page (index)
 # static objects found under folders below in the current dir
@@ -78,9 +82,26 @@ URLS = (
                               config_pytomo.RRD_PLOT_DIR), 'Static',
     '/(%s)/(.*)' % (config_pytomo.PDF_DIR), 'Pdf',
     '/%s(.*)' % config_pytomo.DOC_DIR, 'Doc',
+    '/timings', 'Timings',
     '/(.*)', 'Index'
     )
 
+def check_modified(date, etag):
+    '''Set the Last-Modified and ETag headers of the response (date is in
+    seconds from epoch) and raise NotModified if the browser has this version
+    '''
+    web.modified(date=datetime.datetime.utcfromtimestamp(int(date)),
+                 etag=etag)
+
+def check_file_modified(file_name):
+    'Set the cache headers of the file (raise NotModified if cached)'
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return
+    check_modified(stat.st_mtime, '%x-%x' % (int(stat.st_mtime),
+                                             stat.st_size))
+
 class Index:
     ''' Class that serves the main page.
     Will search for a .html file under the folder set in render below.
@@ -108,68 +129,44 @@ class Index:
                                     ' user')
             database = DATABASE
         config_pytomo.LOG.debug('Database: %s' % database)
-        try:
-            db_nr_rows = PytomoDatabase(database).count_rows()
-        except Error, mes:
-            db_nr_rows = RRD_MIN_NR_POINTS - 1
-            config_pytomo.LOG.error('Unable to extract data with error: %s'
-                                               % mes)
-        # if database is has less than 3 points no graphs will be created
-        # (rrd limitation)
-        if db_nr_rows < RRD_MIN_NR_POINTS:
-            config_pytomo.LOG.warning('Database %s does not have enough points'
-                                      ' to create graphs' % database)
-            timestamp = None
-            write_index(timestamp, database, DB_DIR)
-        else:
-            try:
-                timestamp = PytomoDatabase(database).fetch_start_time()
-            except Error, mes:
-                timestamp = None
-                config_pytomo.LOG.error('Unable to extract data with error:'
-                                        '%s' % mes)
-            latest_db = get_latest_specific_file(DB_DIR, DB_EXTENSION)
-            # check if:
-            # the modification time of the db has changed in the REFRESH_TIME s
-            # or if template files don't exist
-            # or if there is a new database that is not in the db archive list
-            if (((time.time() - os.path.getmtime(database)) < REFRESH_TIME)
-                    or not check_templates_exist(timestamp)
-                    or (os.path.getmtime(index_filename(DB_KEY, timestamp))
-                        < os.path.getmtime(latest_db))):
-                config_pytomo.LOG.debug('RRD operations start...')
-                pytomo_rrd = PytomoRRD(database)
-                pytomo_rrd.update_pytomo_rrd()
-                #pytomo_rrd.fetch_pytomo_rrd()
-                pytomo_rrd.plot_pytomo_rrd()
-                config_pytomo.LOG.debug('RRD operations end...')
-                write_index(timestamp, database, DB_DIR)
-        config_pytomo.LOG.debug('Start rendering page...')
-        # these headers allow browsers to display the page
-        web.header('Content-type','text/html')
-        web.header('Transfer-Encoding','chunked')
+        # the plots and pages are rebuilt in background if the database changed
+        REPORT_BUILDER.request(database)
+        report = REPORT_BUILDER.report(database,
+                                       wait=config_pytomo.REPORT_WAIT)
+        if not report:
+            config_pytomo.LOG.error('No report could be built for %s'
+                                    % database)
+            raise web.internalerror('No report could be built for the '
+                                    'database')
+        if report.error and not report.pages:
+            raise web.internalerror('The report of the database could not be '
+                                    'built: %s' % report.error)
         # if the user provides a legitimate link, it will be displayed
         # otherwise the main graphs will be displayed
         # parameter is taken from the link, for example:
         # http://127.0.0.1:5555/PlaybackDuration
         # has as parameter PlaybackDuration
         # on the main page (no parameter) the main plots are displayed
-        if (parameter in chain(ALL_PLOTS[ALL_KEY], ALL_PLOTS.keys(),
-                               [LINKS_KEY, DB_KEY])):
-            template_file = index_filename(parameter, timestamp)
-        else:
-            template_file = index_filename(MAIN_KEY, timestamp)
-        try:
-            f_index = open(template_file, 'r')
-        except IOError:
-            config_pytomo.LOG.error('Template file %s does not exist!' %
-                                    template_file)
-        config_pytomo.LOG.debug('Template file is open: %s' % template_file)
+        if (parameter not in chain(ALL_PLOTS[ALL_KEY], ALL_PLOTS.keys(),
+                                   [LINKS_KEY, DB_KEY])):
+            parameter = MAIN_KEY
+        page = report.pages.get(parameter)
+        if page is None:
+            config_pytomo.LOG.error('Template file of %s does not exist!' %
+                                    parameter)
+            raise web.notfound()
+        # the pages of a build do not change: the browser can keep them
+        check_modified(report.built, '%s-%x-%s' % (report.timestamp,
+                                                   int(report.built * 1000),
+                                                   parameter.strip()))
+        config_pytomo.LOG.debug('Start rendering page...')
+        # these headers allow browsers to display the page
+        web.header('Content-type','text/html')
+        web.header('Transfer-Encoding','chunked')
         # skip the first line that allows to process the parameter given by the
         # link
-        for line in f_index.readlines()[START_RENDERING:]:
+        for line in page[START_RENDERING:]:
             yield line
-        f_index.close()
         config_pytomo.LOG.debug('End rendering page...')
 
 class Static:
@@ -182,6 +179,7 @@ class Static:
 
     def GET(self, media, filename):
         '''Retrieves the static objects located in the main page.'''
+        check_file_modified(media + '/' + filename)
         try:
             self.object_path = open(media + '/' + filename, 'rb')
         except IOError, mes:
@@ -205,6 +203,30 @@ class Doc:
             return
         yield self.object_path.read()
 
+class Timings:
+    ''' Class that serves the time spent in each phase of the crawl of the
+    database (JSON written by the crawl at the end of each round).
+    '''
+    def GET(self):
+        '''Retrieves the timings of the database given as parameter (the
+        latest database by default)
+        Only the databases of the database directory can be given.'''
+        try:
+            database = os.path.join(DB_DIR,
+                                    os.path.basename(web.input().db))
+        except AttributeError:
+            database = DATABASE
+        timings_file = ''.join((database, TIMINGS_EXTENSION))
+        check_file_modified(timings_file)
+        try:
+            with open(timings_file, 'rb') as f_timings:
+                timings = f_timings.read()
+        except IOError, mes:
+            config_pytomo.LOG.error('No timings for %s: %s' % (database, mes))
+            raise web.notfound()
+        web.header('Content-type', 'application/json')
+        return timings
+
 class Pdf:
     ''' Class that serves the PDF reports.
     Will search for elements under the directories mentioned in urls related to
@@ -217,6 +239,7 @@ class Pdf:
         '''Retrieves the static objects located in the main page.'''
         # these headers allow browsers to display the page
         web.header('Content-type','application/octet-stream')
+        check_file_modified(media + '/' + filename)
         try:
             self.object_path = open(media + '/' + filename, 'rb')
         except IOError, mes:
@@ -294,6 +317,7 @@ def main(argv=None):
     if options.db_dir_name:
         global DB_DIR
         DB_DIR = options.db_dir_name
+        REPORT_BUILDER.db_dir = DB_DIR
     global DATABASE
     # if database is specified
     if options.db_name:
@@ -311,7 +335,8 @@ def main(argv=None):
     # globals() dictionary as second parameter, so application would only
     # work with port number as option (no -v or anything else)
     app = web.application(URLS, {'Static': Static, 'Pdf': Pdf, 'Doc': Doc,
-                                 'Index': Index}, autoreload=True)
+                                 'Timings': Timings, 'Index': Index},
+                          autoreload=True)
     # parameter is taken from the link, for example:
     # http://127.0.0.1:5555/PlaybackDuration
     # has as parameter PlaybackDuration
@@ -339,7 +364,8 @@ def main(argv=None):
 
 # for running with gunicorn as: gunicorn  pytomo.webpage:wsgi_app
 wsgi_app = web.application(URLS, {'Static': Static, 'Pdf': Pdf, 'Doc': Doc,
-                             'Index': Index}, autoreload=True).wsgifunc()
+                             'Timings': Timings, 'Index': Index},
+                           autoreload=True).wsgifunc()
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -47,6 +47,9 @@ Use './start_server.py PORT_NR' to start the graphical web server that displays
 the plots on the desired PORT_NR.
 You can check the options with './start_server.py -h'.
 Do not change the RRD_PLOT_DIR, RRD_DIR in pytomo/config_pytomo.py.
+
+Use './start_aggregate.py INCOMING_DIR' on the centralisation server to append
+the new archives received from the probes into one aggregate database.
 """
 
 VERSION = '3.0.5'
@@ -70,7 +73,8 @@ if __name__ == '__main__':
                      'pytomo/web', 'pytomo/web/contrib',
                      'pytomo/web/wsgiserver', 'pytomo/fpdf'],
         'scripts': ['bin/pytomo', 'start_crawl.py',
-                    'bin/pytomo_web_interface', 'start_server.py'],
+                    'bin/pytomo_web_interface', 'start_server.py',
+                    'start_aggregate.py'],
         'long_description': open('README.txt').read(),
         'platforms': ['Linux', 'Windows', 'Mac'],
         'license': LICENSE,